@@ -1,11 +1,14 @@
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine
 import pandas as pd
+import numpy as np
 import warnings
 import boto3
 import json
 import os
 
+from shared import tracing, resample, db
+from shared.series import TimeMatrix, valid_key
+
 # ignore warnings
 warnings.filterwarnings("ignore")
 bucketname = os.environ.get("MJ_STATUS_BUCKET")
@@ -13,28 +16,43 @@ bucketname = os.environ.get("MJ_STATUS_BUCKET")
 s3 = boto3.client("s3")
 # db
 MJ_ETL_DB = os.environ.get("MJ_ETL_DB")
-engine = create_engine(MJ_ETL_DB)
-metrics_query = "SELECT * FROM metrics WHERE date_id >= '{before}' AND date_id < '{after}'"
+engine = db.engine(MJ_ETL_DB)
+# same columns as the legacy metrics table, the fetch time range prunes monthly partitions
+metrics_query = """
+SELECT
+    (s.ts AT TIME ZONE 'UTC')::date AS date_id,
+    s.ts AT TIME ZONE 'UTC' AS timestamp_id,
+    n.name,
+    s.sampled AT TIME ZONE 'UTC' AS date,
+    s.value
+FROM metric_samples s JOIN metric_names n ON n.id = s.name_id
+WHERE s.ts >= '{before} 00:00+00' AND s.ts < '{after} 00:00+00'
+"""
 events_query = "SELECT * FROM events WHERE date_id >= '{before}' AND date_id < '{after}'"
 
 
+@tracing.traced()
 def query_metrics(before, after):
     try:
-        df_metrics = pd.read_sql(metrics_query.format(before=before, after=after), con=engine)
+        with db.connect(engine) as conn:
+            df_metrics = pd.read_sql(metrics_query.format(before=before, after=after), con=conn)
     except BaseException as e:
         print(e)
         df_metrics = None
     return df_metrics
 
+@tracing.traced()
 def query_events(before, after):
     try:
-        df_events = pd.read_sql(events_query.format(before=before, after=after), con=engine)
+        with db.connect(engine) as conn:
+            df_events = pd.read_sql(events_query.format(before=before, after=after), con=conn)
     except BaseException as e:
         print(e)
         df_events = None
     return df_events
 
 
+@tracing.traced()
 def extract_events(df: pd.DataFrame):
     # zero events in a batch / day
     if df.shape[0] == 0:
@@ -42,7 +60,7 @@ def extract_events(df: pd.DataFrame):
     # encode to binary flags
     for title in df['short_title'].unique():
         for type in df['type'].unique():
-            df[f"{type}_{title}"] = df[['short_title', 'type']].apply(lambda x: 1 if x[0] == title and x[1] == type else 0, axis=1)
+            df[f"{type}_{title}"] = df[['short_title', 'type']].apply(lambda x: 1 if x.iloc[0] == title and x.iloc[1] == type else 0, axis=1)
     # keep only time columns
     df = df.drop(columns=['alert_id', 'short_title', 'type', 'label'])
     # compute time difference in seconds
@@ -64,29 +82,36 @@ def extract_events(df: pd.DataFrame):
     return features_df.to_dict(orient='list')
     
 
-def extract_metrics(df: pd.DataFrame, kind="relax"):
-    # convert to hour:minutes
-    df["time"] = pd.to_datetime(df["timestamp_id"]).dt.strftime("%H:%M")
-    # parse metric kind (relax or fast) from original name
-    df["kind"] = df["name"].str.split(".").map(lambda x: x[2])
+@tracing.traced()
+def extract_metrics(df: pd.DataFrame, kind="relax", day: str = None, policy: resample.Policy = "interpolate"):
+    # parse metric kind (relax or fast) and a less verbose label once per distinct name, not per row
+    codes, names = pd.factorize(df["name"])
+    parts = [name.split(".") for name in names]
+    kinds = np.array([p[2] for p in parts])
+    labels = np.array(["".join(p[4:]).replace("job_type_", "") for p in parts])
     # get only specified kind
-    df = df.loc[df["kind"] == kind]
-    # create less verbose label from name
-    df["label"] = (
-        df["name"]
-        .str.split(".")
-        .map(lambda x: "".join(x[4:]).replace("job_type_", ""))
+    rows = (kinds == kind)[codes]
+    if not rows.any():
+        return {}, {}
+    # several names can share a label, columns are the distinct labels of the kind in order of appearance
+    columns, label_names = pd.factorize(labels[codes[rows]])
+    start = np.datetime64(pd.Timestamp(pd.to_datetime(df["date_id"][rows]).min() if day is None else day).date())
+    # align fetch times onto the 96 samples of the day, missed fetches are filled by policy
+    values, valid = resample.resample(
+        df["timestamp_id"].to_numpy(dtype="datetime64[s]")[rows],
+        df["value"].to_numpy()[rows],
+        start,
+        columns=columns,
+        n_columns=len(label_names),
+        policy=policy,
     )
-    # get only relevant data
-    data_df = df[["label", "time", "value"]]
-    # convert to custom json format (timestamp is assumed from position, 96 samples per file)
-    data = {}
-    for label in data_df["label"].unique():
-        y = data_df.loc[data_df["label"] == label]
-        data[label] = list(y["value"].values)
-    return data
+    # 1 where every label was sampled
+    day_series = TimeMatrix(values, resample.grid(start), label_names, valid.all(axis=1))
+    # convert to custom json format (timestamp is the position on the 15 minute grid), the mask goes to its own file
+    return day_series.to_day(), day_series.to_valid()
 
 
+@tracing.invocation("analytics")
 def lambda_handler(event: dict, context):
     kind = event.get("kind", "relax")
     time = event.get("date", "yesterday")
@@ -115,23 +140,34 @@ def lambda_handler(event: dict, context):
     metrics_df = query_metrics(before=before, after=after)
     if metrics_df is None:
         return {"statusCode": 404, "body": json.dumps("No data if metrics")}
-    metrics = extract_metrics(metrics_df, kind=kind)
-    s3_response = s3.put_object(
-        Body=json.dumps(metrics),
-        Bucket=bucket,
-        Key=f"metrics/{kind}/{before}_{after}.json",
-    )
+    metrics, valid = extract_metrics(metrics_df, kind=kind, day=before)
+    key = f"metrics/{kind}/{before}_{after}.json"
+    body, valid_body = json.dumps(metrics), json.dumps(valid)
+    tracing.count("metric_rows", metrics_df.shape[0])
+    tracing.count("s3_put_bytes", len(body) + len(valid_body))
+    with tracing.span("s3_put"):
+        # the mask first, a reader that sees the new day also finds its mask
+        s3.put_object(Body=valid_body, Bucket=bucket, Key=valid_key(key))
+        s3_response = s3.put_object(
+            Body=body,
+            Bucket=bucket,
+            Key=key,
+        )
     print("metrics", s3_response['ResponseMetadata']['HTTPStatusCode'])
     # Events
     events_df = query_events(before=before, after=after)
     if events_df is None:
         return {"statusCode": 404, "body": json.dumps("No data if events")}
     events = extract_events(events_df)
-    s3_response = s3.put_object(
-        Body=json.dumps(events),
-        Bucket=bucket,
-        Key=f"metrics/events/{before}_{after}.json",
-    )
+    body = json.dumps(events)
+    tracing.count("event_rows", events_df.shape[0])
+    tracing.count("s3_put_bytes", len(body))
+    with tracing.span("s3_put"):
+        s3_response = s3.put_object(
+            Body=body,
+            Bucket=bucket,
+            Key=f"metrics/events/{before}_{after}.json",
+        )
     print("events", s3_response['ResponseMetadata']['HTTPStatusCode'])
     return {
         "statusCode": 200,
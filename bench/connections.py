@@ -0,0 +1,159 @@
+"""
+Concurrent simulated Lambda invocations against Postgres, to compare connection handling.
+
+Every container is a process that runs its invocations back to back, like a warm Lambda during a
+backfill. Invocations come in two bursts, between them the containers sit frozen and the parent
+terminates their idle connections like a pooler or NAT idle timeout would. The parent also samples
+the server side connections of the run. Modes:
+
+- legacy: default engine, create_all on every invocation (the handlers before shared/db.py)
+- queue: shared/db.py pooled engine, one schema check per container
+- null: shared/db.py with NullPool, meant to sit behind PgBouncer (pass its url with --pooler)
+
+    python bench/connections.py --containers 32 --invocations 20
+"""
+from multiprocessing import get_context
+from time import perf_counter, sleep
+import threading
+import argparse
+import json
+import sys
+import os
+
+import numpy as np
+
+from run import ROOT, load_module, postgres
+
+MODES = ("legacy", "queue", "null")
+QUERY = "SELECT count(*) FROM metric_samples WHERE ts >= now() - interval '1 day'"
+
+
+def container(mode: str, url: str, invocations: int, work_ms: float, barrier, results):
+    """One warm container, the handler work is a query and a sleep while holding the connection"""
+    from sqlalchemy import create_engine, event, text
+
+    os.environ["AWS_LAMBDA_FUNCTION_NAME"] = f"mj-bench-{mode}"
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ["MJ_ETL_DB"] = url
+    sys.path.insert(0, str(ROOT))
+    from shared import db
+
+    etl = load_module("mj_etl", ROOT / "etl" / "app.py")
+    if mode == "legacy":
+        engine = create_engine(url, connect_args={"application_name": f"mj-bench-{mode}"})
+        connects = [0]
+        event.listen(engine, "connect", lambda *_: connects.__setitem__(0, connects[0] + 1))
+    else:
+        engine = db.engine(url, pool=mode)
+    latencies, errors = [], 0
+    barrier.wait()
+    for i in range(invocations):
+        if i == invocations // 2:
+            # frozen between bursts, the parent drops idle connections meanwhile
+            barrier.wait()
+            barrier.wait()
+        t0 = perf_counter()
+        try:
+            if mode == "legacy":
+                etl.Base.metadata.create_all(engine, tables=etl.TABLES)
+                with engine.connect() as conn:
+                    conn.execute(text(QUERY)).scalar()
+                    sleep(work_ms / 1000)
+            else:
+                db.ensure_schema(engine, etl.Base.metadata, etl.TABLES)
+                with db.connect(engine) as conn:
+                    conn.execute(text(QUERY)).scalar()
+                    sleep(work_ms / 1000)
+        except Exception:
+            errors += 1
+        latencies.append((perf_counter() - t0) * 1000)
+    stats = db.stats() if mode != "legacy" else {"connects": connects[0]}
+    results.put({"latencies": latencies, "errors": errors, "connects": stats["connects"], "acquire_ms": stats.get("acquire_ms")})
+
+
+def sample_connections(url: str, application: str, stop: threading.Event, kill: threading.Event, out: dict):
+    """Peak server connections of a mode, terminates the idle ones once kill is set and clears it"""
+    import psycopg2
+
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    while not stop.is_set():
+        cur.execute("SELECT count(*) FROM pg_stat_activity WHERE application_name = %s", (application,))
+        out["peak"] = max(out.get("peak", 0), cur.fetchone()[0])
+        if kill.is_set():
+            cur.execute(
+                "SELECT count(pg_terminate_backend(pid)) FROM pg_stat_activity WHERE application_name = %s AND state = 'idle'",
+                (application,),
+            )
+            out["killed"] = cur.fetchone()[0]
+            kill.clear()
+        sleep(0.005)
+    conn.close()
+
+
+def run_mode(mode: str, url: str, containers: int, invocations: int, work_ms: float, server_url: str) -> dict:
+    ctx = get_context("spawn")
+    barrier, results = ctx.Barrier(containers + 1), ctx.Queue()
+    processes = [
+        ctx.Process(target=container, args=(mode, url, invocations, work_ms, barrier, results)) for _ in range(containers)
+    ]
+    for p in processes:
+        p.start()
+    stop, kill, server = threading.Event(), threading.Event(), {}
+    sampler = threading.Thread(target=sample_connections, args=(server_url, f"mj-bench-{mode}", stop, kill, server))
+    sampler.start()
+    barrier.wait()
+    t0 = perf_counter()
+    barrier.wait()
+    seconds = perf_counter() - t0
+    kill.set()
+    while kill.is_set():
+        sleep(0.005)
+    barrier.wait()
+    t0 = perf_counter()
+    out = [results.get() for _ in processes]
+    seconds += perf_counter() - t0
+    for p in processes:
+        p.join()
+    stop.set()
+    sampler.join()
+    latencies = np.concatenate([o["latencies"] for o in out])
+    acquired = [o["acquire_ms"] for o in out if o["acquire_ms"] is not None]
+    return {
+        "invocations": len(latencies),
+        "seconds": seconds,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "errors": sum(o["errors"] for o in out),
+        "client_connects": sum(o["connects"] for o in out),
+        "mean_acquire_ms": sum(acquired) / len(latencies) if acquired else None,
+        "peak_server_connections": server.get("peak", 0),
+        "killed_idle": server.get("killed", 0),
+    }
+
+
+def run(containers: int, invocations: int, work_ms: float, modes: tuple[str], pooler: str = None) -> dict:
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with postgres() as db_url:
+        os.environ["MJ_ETL_DB"] = db_url
+        sys.path.insert(0, str(ROOT))
+        etl = load_module("mj_etl", ROOT / "etl" / "app.py")
+        etl.Base.metadata.create_all(etl.engine, tables=etl.TABLES)
+        report = {"containers": containers, "invocations": invocations, "work_ms": work_ms}
+        for mode in modes:
+            # the sampler always watches Postgres, null mode connects through the pooler when given
+            url = pooler if mode == "null" and pooler else db_url
+            report[mode] = run_mode(mode, url, containers, invocations, work_ms, db_url)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Connection handling under concurrent invocations")
+    parser.add_argument("--containers", default=32, type=int)
+    parser.add_argument("--invocations", default=20, type=int, help="per container")
+    parser.add_argument("--work-ms", default=20.0, type=float, help="time a handler holds its connection")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--pooler", default=None, help="PgBouncer url for the null mode")
+    argv = parser.parse_args()
+    print(json.dumps(run(argv.containers, argv.invocations, argv.work_ms, tuple(argv.modes.split(",")), argv.pooler), indent=2))
@@ -0,0 +1,117 @@
+"""
+Synthetic status feed, shaped like the responses fetch/mj-fetch.py gets from the status API.
+
+Wait times follow a daily cycle per metric with slow episodes above the clip ceiling, incidents
+come from analytics/events_types.json and stay open for a while before they resolve.
+"""
+from datetime import date, datetime, timedelta
+from typing import Iterator
+from pathlib import Path
+import json
+
+import numpy as np
+
+SAMPLES_PER_DAY = 96
+FEED_FMT = "%Y-%m-%dT%H:%M:%S.%fZ"
+TIMESTAMP_FMT = "%Y-%m-%dT%H:%M:%SZ"
+EVENT_TYPES = Path(__file__).parents[1] / "analytics" / "events_types.json"
+
+
+def metric_names(count: int) -> list[str]:
+    """Names like jobs.time_to_start.relax.30min.job_type_v5_diffusion, relax and fast alternating"""
+    families = ["v5_diffusion", "v4_diffusion", "v4_upscale", "v4_anim", "kdpt_diffusion"]
+    return [
+        f"jobs.time_to_start.{'relax' if i % 2 == 0 else 'fast'}.{'30min' if i % 2 == 0 else '10min'}"
+        f".job_type_{families[(i // 2) % len(families)]}{'' if i < 2 * len(families) else f'_{i // (2 * len(families))}'}"
+        for i in range(count)
+    ]
+
+
+class StatusFeed:
+    def __init__(self, metrics: int = 10, incidents_per_day: float = 2.0, missed: float = 0.0, seed: int = 0) -> None:
+        self.rng = np.random.default_rng(seed)
+        self.names = metric_names(metrics)
+        n = len(self.names)
+        relax = np.array(["relax" in name for name in self.names])
+        # minutes of wait, relax queues are slower and peak at different hours
+        self.base = np.where(relax, 4.0, 0.5) * self.rng.uniform(0.5, 1.5, n)
+        self.amplitude = self.base * self.rng.uniform(0.3, 0.9, n)
+        self.phase = self.rng.uniform(0, 2 * np.pi, n)
+        self.incidents_per_day = incidents_per_day
+        self.missed = missed  # share of fetches that fail, the same share fires twice
+        self.alerts = json.loads(EVENT_TYPES.read_text())
+        self.level = np.zeros(n)
+        self.episodes: list[tuple[date, int, int, np.ndarray]] = []  # (day, first sample, end, metrics) of slow episodes
+
+    def day_values(self, day: date) -> np.ndarray:
+        """(samples, metrics) wait times of one day"""
+        n = len(self.names)
+        t = np.arange(SAMPLES_PER_DAY)[:, None]
+        weekly = 1 + 0.2 * np.sin(2 * np.pi * (day.toordinal() % 7) / 7)
+        cycle = self.base + self.amplitude * np.sin(2 * np.pi * t / SAMPLES_PER_DAY + self.phase)
+        # random walk of the load, carried over to the next day
+        walk = self.level + np.cumsum(self.rng.normal(0, 0.05, (SAMPLES_PER_DAY, n)), axis=0)
+        self.level = walk[-1] * 0.9
+        values = np.clip(cycle * weekly * np.exp(walk), 0, None)
+        # slow episodes, an hour or two above the clip ceiling on a few metrics
+        for _ in range(self.rng.poisson(1.0)):
+            start = int(self.rng.integers(0, SAMPLES_PER_DAY))
+            cols = self.rng.choice(n, max(1, n // 5), replace=False)
+            end = min(start + int(self.rng.integers(4, 9)), SAMPLES_PER_DAY)
+            values[start:end, cols] += self.rng.uniform(15, 40)
+            self.episodes.append((day, start, end, cols))
+        return values
+
+    def day_incidents(self, day: date) -> list[dict]:
+        """Incidents opened on a day, with the sample range while they are open"""
+        titles = sorted({a["short_title"] for a in self.alerts})
+        incidents = []
+        for _ in range(self.rng.poisson(self.incidents_per_day)):
+            title = titles[self.rng.integers(len(titles))]
+            start = int(self.rng.integers(0, SAMPLES_PER_DAY - 1))
+            incidents.append(
+                {
+                    "alert_id": int(self.rng.integers(10**8, 2 * 10**8)),
+                    "short_title": title,
+                    "type": "error" if self.rng.random() < 0.3 else "warning",
+                    "opened": datetime.combine(day, datetime.min.time()) + timedelta(minutes=15 * start, seconds=int(self.rng.integers(0, 900))),
+                    "start": start + 1,
+                    "end": min(start + 1 + int(self.rng.integers(1, 12)), SAMPLES_PER_DAY),
+                }
+            )
+        return incidents
+
+    def day(self, day: date) -> Iterator[tuple[str, dict]]:
+        """(fetch timestamp, feed response) every 15 minutes of a day"""
+        values = self.day_values(day)
+        incidents = self.day_incidents(day)
+        midnight = datetime.combine(day, datetime.min.time())
+        fires = np.ones(SAMPLES_PER_DAY, dtype=int)
+        if self.missed > 0:
+            fires[self.rng.random(SAMPLES_PER_DAY) < self.missed] = 0
+            fires[self.rng.random(SAMPLES_PER_DAY) < self.missed] += 1
+        for i in np.repeat(np.arange(SAMPLES_PER_DAY), fires).tolist():
+            fetched = midnight + timedelta(minutes=15 * i, seconds=int(30 + 400 * self.rng.random()))
+            stamp = fetched.strftime(FEED_FMT)
+            events = [
+                {
+                    "alert_id": str(incident["alert_id"]),
+                    "date": incident["opened"].strftime(FEED_FMT),
+                    "day": incident["opened"].strftime("%Y-%m-%d"),
+                    "short_title": incident["short_title"],
+                    "label": "Resolved" if i == incident["end"] - 1 else "Investigating",
+                    "type": "success" if i == incident["end"] - 1 else incident["type"],
+                }
+                for incident in incidents
+                if incident["start"] <= i < incident["end"]
+            ]
+            metrics = [
+                {"name": name, "value": f"{value:.4f}", "date": stamp}
+                for name, value in zip(self.names, values[i])
+            ]
+            yield fetched.strftime(TIMESTAMP_FMT), {"status": "success", "events": events, "metrics": metrics}
+
+    def days(self, first: date, count: int) -> Iterator[tuple[date, Iterator[tuple[str, dict]]]]:
+        for d in range(count):
+            day = first + timedelta(days=d)
+            yield day, self.day(day)
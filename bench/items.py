@@ -0,0 +1,143 @@
+"""
+Status table item size and decode throughput, version 1 string maps vs packed version 2 items.
+
+Items are built the way fetch/mj-fetch.py writes them, serialized to the DynamoDB wire format and
+decoded the way etl/app.py reads them. Sizes follow the DynamoDB item size rules, capacity units
+are per write and per day of eventually consistent reads:
+
+    python bench/items.py --metrics 10,100,1000
+    python bench/items.py --payload response.json   # a saved status API response
+"""
+from datetime import date, timedelta
+from time import perf_counter
+from decimal import Decimal
+from pathlib import Path
+import argparse
+import json
+import math
+import os
+
+from boto3.dynamodb.types import Binary, TypeSerializer
+
+from feed import SAMPLES_PER_DAY, StatusFeed
+from run import ROOT, load_module
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+# the ETL module builds its engine at import, nothing connects
+os.environ.setdefault("MJ_ETL_DB", "postgresql://bench@localhost/bench")
+fetch = load_module("mj_fetch", ROOT / "fetch" / "mj-fetch.py")
+etl = load_module("mj_etl", ROOT / "etl" / "app.py")
+codec = fetch.codec
+serializer = TypeSerializer()
+
+
+def value_size(value) -> int:
+    """Bytes of an attribute value by the DynamoDB item size rules"""
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, (bytes, Binary)):
+        return len(bytes(value))
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, float, Decimal)):
+        digits = len(str(value).replace("-", "").replace(".", "").lstrip("0")) or 1
+        return 1 + math.ceil(digits / 2)
+    if isinstance(value, dict):
+        return 3 + sum(len(k.encode()) + value_size(v) + 1 for k, v in value.items())
+    return 3 + sum(value_size(v) + 1 for v in value)
+
+
+def item_size(item: dict) -> int:
+    return sum(len(k.encode()) + value_size(v) for k, v in item.items())
+
+
+def build(data: dict, timestamp: str, version: int, dictionaries: dict) -> dict:
+    """Item as put_item writes it, new name dictionaries of version 2 items go to dictionaries"""
+    item = {"date": timestamp[:10], "timestamp": timestamp, "status": data["status"], "events": data["events"]}
+    if version == 1:
+        return {**item, "metrics": data["metrics"]}
+    names, packed = codec.encode_metrics(data["metrics"], timestamp)
+    if packed["names"] not in dictionaries:
+        dictionaries[packed["names"]] = codec.encode_names(names)
+    return {**item, **packed}
+
+
+def wire(item: dict) -> dict:
+    return {k: serializer.serialize(v) for k, v in item.items()}
+
+
+def decode(items: list[dict]) -> int:
+    """Metric rows the ETL gets out of a day of query results"""
+    items = etl.parse_dynamodb_items(items)
+    legacy = [
+        {"date_id": item["date"], "timestamp_id": item["timestamp"], **m}
+        for item in items
+        if codec.version(item) == 1
+        for m in item["metrics"]
+    ]
+    rows = etl.parse_obj_as(list[etl.MetricSchema], legacy)
+    return len(rows) + len(etl.decode_samples([item for item in items if codec.version(item) > 1]))
+
+
+def measure(day: list[tuple[str, dict]], version: int) -> dict:
+    dictionaries = {}
+    t0 = perf_counter()
+    items = [build(data, timestamp, version, dictionaries) for timestamp, data in day]
+    encode_s = perf_counter() - t0
+    for key, dictionary in dictionaries.items():
+        etl.NAMES[key] = codec.decode_names(dictionary)
+    sizes = [item_size(item) for item in items]
+    wire_items = [wire(item) for item in items]
+    t0 = perf_counter()
+    rows = decode(wire_items)
+    decode_s = perf_counter() - t0
+    return {
+        "item_bytes": sum(sizes) / len(sizes),
+        "dictionary_bytes": sum(item_size(d) for d in dictionaries.values()),
+        "wcu_per_put": sum(math.ceil(s / 1024) for s in sizes) / len(sizes),
+        # eventually consistent query, 4KB per unit, half a unit each
+        "rcu_per_day": math.ceil(sum(sizes) / 4096) / 2,
+        "encode_us_per_item": encode_s / len(items) * 1e6,
+        "decode_rows_per_s": rows / decode_s,
+        "codec": items[0].get("codec", "strings"),
+    }
+
+
+def compare(day: list[tuple[str, dict]]) -> dict:
+    v1, v2 = measure(day, 1), measure(day, 2)
+    return {
+        "metrics": len(day[0][1]["metrics"]),
+        "v1": v1,
+        "v2": v2,
+        "size_ratio": v1["item_bytes"] / v2["item_bytes"],
+        "decode_speedup": v2["decode_rows_per_s"] / v1["decode_rows_per_s"],
+    }
+
+
+def feed_day(metrics: int, seed: int) -> list[tuple[str, dict]]:
+    day = date.today() - timedelta(days=1)
+    return [(timestamp, fetch.parse_data(response)) for timestamp, response in StatusFeed(metrics=metrics, seed=seed).day(day)]
+
+
+def payload_day(path: Path) -> list[tuple[str, dict]]:
+    """A day of fetches of one saved response, every 15 minutes"""
+    response = json.loads(path.read_text())
+    day = date.today() - timedelta(days=1)
+    out = []
+    for i in range(SAMPLES_PER_DAY):
+        timestamp = f"{day}T{i // 4:02d}:{i % 4 * 15:02d}:30Z"
+        out.append((timestamp, fetch.parse_data(json.loads(json.dumps(response)))))
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Status item encoding bench")
+    parser.add_argument("--metrics", default="10,100,1000", help="comma separated metric counts of the synthetic feed")
+    parser.add_argument("--payload", default=None, type=Path, help="saved status API response instead of the feed")
+    parser.add_argument("--seed", default=0, type=int)
+    argv = parser.parse_args()
+    if argv.payload is not None:
+        report = {str(argv.payload): compare(payload_day(argv.payload))}
+    else:
+        report = {n: compare(feed_day(int(n), argv.seed)) for n in argv.metrics.split(",")}
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,127 @@
+"""
+Replay of historical days through the streaming detector of fetch/detector.py.
+
+Replays the synthetic feed, with its slow episodes as ground truth, or the `metrics/{kind}/` day files
+analytics publishes (--history, e.g. the ml data/relax download), one tick at a time, and reports
+the update latency per tick, the state size and what was flagged:
+
+    python bench/replay.py --days 30 --metrics 10,1000,5000
+    python bench/replay.py --history ../ml/data/relax
+"""
+from datetime import date, datetime, timedelta
+from time import perf_counter
+from pathlib import Path
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from feed import StatusFeed
+from run import ROOT
+
+sys.path.insert(0, str(ROOT / "fetch"))
+import detector  # noqa: E402
+
+VALID_KEY = "valid"
+
+
+def replay(ticks, detect: detector.Detector) -> tuple[list[detector.Alert], np.ndarray]:
+    """Feed (timestamp, names, values) ticks, returns the alerts and the update latencies in ms"""
+    alerts, latencies = [], []
+    for timestamp, names, values in ticks:
+        t0 = perf_counter()
+        alerts.extend(detect.update(names, values, timestamp))
+        latencies.append((perf_counter() - t0) * 1000)
+    return alerts, np.array(latencies)
+
+
+def feed_ticks(feed: StatusFeed, first: date, days: int):
+    for _, responses in feed.days(first, days):
+        for timestamp, response in responses:
+            metrics = response["metrics"]
+            yield timestamp, [m["name"] for m in metrics], [float(m["value"]) for m in metrics]
+
+
+def history_ticks(path: Path):
+    """
+    Ticks of day files named {day}_{next day}.json, positional samples every 15 minutes, without the
+    samples their companion validity file under ../valid/{kind}/ flags as not fetched
+    """
+    for file in sorted(path.glob("*.json")):
+        day = datetime.strptime(file.name[:10], "%Y-%m-%d")
+        data = json.loads(file.read_text())
+        companion = path.parent / "valid" / path.name / file.name
+        valid = json.loads(companion.read_text())[VALID_KEY] if companion.is_file() else None
+        names = list(data)
+        values = np.array([data[n] for n in names], dtype=np.float64).T
+        for i, row in enumerate(values):
+            if valid is not None and not valid[i]:
+                continue
+            timestamp = (day + timedelta(minutes=detector.MINUTES_PER_SAMPLE * i, seconds=30)).strftime(detector.TIMESTAMP_FMT)
+            yield timestamp, names, row
+
+
+def latency_report(latencies: np.ndarray, detect: detector.Detector, alerts: list) -> dict:
+    return {
+        "ticks": len(latencies),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "max_ms": float(latencies.max()),
+        "state_kb": detect.nbytes / 1024,
+        "state_kb_per_metric": detect.nbytes / 1024 / max(1, len(detect.names)),
+        "serialized_kb": len(detect.to_bytes()) / 1024,
+        "alerts": len(alerts),
+        "reasons": {r: sum(r in a["reasons"] for a in alerts) for r in ("slow", "spike", "shift")},
+    }
+
+
+def episode_report(feed: StatusFeed, alerts: list[detector.Alert]) -> dict:
+    """Share of slow episodes flagged, ticks to the first alert and alerts outside episodes"""
+    column = {name: i for i, name in enumerate(feed.names)}
+    flagged = {(detector.tick_of(a["timestamp"]), column[a["name"]]) for a in alerts}
+    inside, delays, found = set(), [], 0
+    for day, start, end, cols in feed.episodes:
+        first = detector.tick_of(datetime.combine(day, datetime.min.time()).strftime(detector.TIMESTAMP_FMT))
+        cells = {(first + t, int(c)) for t in range(start, end) for c in cols}
+        inside |= cells
+        hits = [t - first - start for t, c in cells & flagged]
+        if hits:
+            found += 1
+            delays.append(min(hits))
+    outside = [a for a in alerts if (detector.tick_of(a["timestamp"]), column[a["name"]]) not in inside]
+    return {
+        "episodes": len(feed.episodes),
+        "detected": found,
+        "median_delay_ticks": float(np.median(delays)) if delays else None,
+        "max_delay_ticks": int(max(delays)) if delays else None,
+        "alerts_outside_episodes": len(outside),
+        "outside_not_slow": sum("slow" not in a["reasons"] for a in outside),
+    }
+
+
+def run(days: int, metrics: list[int], missed: float, seed: int, history: Path = None) -> dict:
+    if history is not None:
+        detect = detector.Detector()
+        alerts, latencies = replay(history_ticks(history), detect)
+        return {"history": str(history), **latency_report(latencies, detect, alerts)}
+    report = {"days": days}
+    first = date.today() - timedelta(days=days)
+    for n in metrics:
+        feed = StatusFeed(metrics=n, missed=missed, seed=seed)
+        detect = detector.Detector()
+        alerts, latencies = replay(feed_ticks(feed, first, days), detect)
+        report[n] = {**latency_report(latencies, detect, alerts), **episode_report(feed, alerts)}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Streaming detector replay")
+    parser.add_argument("--days", default=30, type=int)
+    parser.add_argument("--metrics", default="10,1000,5000", help="comma separated metric counts")
+    parser.add_argument("--missed", default=0.02, type=float)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--history", default=None, type=Path, help="directory of metrics day files")
+    argv = parser.parse_args()
+    metrics = [int(n) for n in argv.metrics.split(",")]
+    print(json.dumps(run(argv.days, metrics, argv.missed, argv.seed, argv.history), indent=2))
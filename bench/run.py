@@ -0,0 +1,205 @@
+"""
+End-to-end offline run of the pipeline, fetch -> etl -> analytics -> ml, on a synthetic status feed.
+
+AWS is mocked in process with moto unless AWS_ENDPOINT_URL points to local stand-ins (DynamoDB-local,
+MinIO), Postgres is a throwaway testing.postgresql instance unless MJ_BENCH_DB names one. Every stage
+runs its real handlers, per stage throughput, latency and peak memory are printed as one JSON object:
+
+    pip install -r bench/requirements.txt
+    python bench/run.py --days 14 --metrics 10 --out bench.json
+"""
+from contextlib import contextmanager, nullcontext
+from datetime import date, timedelta
+from time import perf_counter
+from pathlib import Path
+import importlib.util
+import tracemalloc
+import argparse
+import resource
+import tempfile
+import json
+import sys
+import os
+
+import numpy as np
+
+from feed import StatusFeed
+
+ROOT = Path(__file__).parents[1]
+sys.path.insert(0, str(ROOT))  # stages import the shared modules
+sys.path.insert(0, str(ROOT / "fetch"))  # and the fetch handler its detector
+STAGES = ("fetch", "etl", "analytics", "ml")
+ML_MIN_DAYS = 10  # sliding window folds need 6 days of validation and test samples
+
+
+class StageStats:
+    """Latency of every invocation, records handled and peak memory of one stage"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.latencies = []
+        self.records = 0
+        self.seconds = 0.0
+        self.peak_mb = 0.0
+
+    @contextmanager
+    def run(self):
+        tracemalloc.reset_peak()
+        t0 = perf_counter()
+        yield self
+        self.seconds += perf_counter() - t0
+        self.peak_mb = max(self.peak_mb, tracemalloc.get_traced_memory()[1] / 2**20)
+
+    @contextmanager
+    def invocation(self, records: int = 0):
+        t0 = perf_counter()
+        yield
+        self.latencies.append((perf_counter() - t0) * 1000)
+        self.records += records
+
+    def report(self) -> dict:
+        latencies = np.array(self.latencies or [np.nan])
+        return {
+            "invocations": len(self.latencies),
+            "records": self.records,
+            "seconds": self.seconds,
+            "records_per_s": self.records / self.seconds if self.seconds else None,
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "peak_mb": self.peak_mb,
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+
+def load_module(name: str, path: Path):
+    """Import a stage script by path, etl and analytics are both called app.py"""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@contextmanager
+def postgres():
+    """URL of a throwaway database"""
+    if os.environ.get("MJ_BENCH_DB"):
+        yield os.environ["MJ_BENCH_DB"]
+        return
+    import testing.postgresql
+
+    with testing.postgresql.Postgresql() as db:
+        yield db.url()
+
+
+def aws():
+    """moto in process unless local endpoints are configured"""
+    if os.environ.get("AWS_ENDPOINT_URL"):
+        return nullcontext()
+    from moto import mock_aws
+
+    return mock_aws()
+
+
+def run(
+    days: int, metrics: int, incidents: float, missed: float, stages: tuple[str], ml_steps: int, predictions: int, seed: int
+) -> dict:
+    feed = StatusFeed(metrics=metrics, incidents_per_day=incidents, missed=missed, seed=seed)
+    # the ml stage reads days relative to now, so the history ends yesterday
+    first = date.today() - timedelta(days=days)
+    dates = [first + timedelta(days=d) for d in range(days)]
+    bucket = "mj-bench"
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    os.environ["MJ_STATUS_DYNAMODB_TABLE"] = "mj-bench-status"
+    os.environ["MJ_STATUS_BUCKET"] = bucket
+    report = {"days": days, "metrics": metrics, "stages": {}}
+    tracemalloc.start()
+    with postgres() as db_url, aws(), tempfile.TemporaryDirectory() as workdir:
+        os.environ["MJ_ETL_DB"] = db_url
+        os.chdir(workdir)
+        # stage modules read their environment at import
+        fetch = load_module("mj_fetch", ROOT / "fetch" / "mj-fetch.py")
+        etl = load_module("mj_etl", ROOT / "etl" / "app.py")
+        analytics = load_module("mj_analytics", ROOT / "analytics" / "app.py")
+        analytics.s3.create_bucket(Bucket=bucket)
+        if "fetch" in stages:
+            stats = StageStats("fetch")
+            with stats.run():
+                table = fetch.create_table_if_not_exists(fetch.tablename)
+                for _, responses in feed.days(first, days):
+                    for timestamp, response in responses:
+                        with stats.invocation(len(response["metrics"]) + len(response["events"])):
+                            data = fetch.parse_data(response)
+                            fetch.detect(data, timestamp)
+                            fetch.put_item(table, data, timestamp)
+            report["stages"]["fetch"] = stats.report()
+        if "etl" in stages:
+            stats = StageStats("etl")
+            with stats.run():
+                for day in dates:
+                    with stats.invocation(metrics * 96):
+                        etl.lambda_handler({"date": day.isoformat()}, None)
+            report["stages"]["etl"] = stats.report()
+        if "analytics" in stages:
+            stats = StageStats("analytics")
+            with stats.run():
+                for day in dates:
+                    with stats.invocation(metrics * 96):
+                        analytics.lambda_handler(
+                            {"date": f"{day}_{day + timedelta(days=1)}", "kind": "relax", "bucket": bucket}, None
+                        )
+            report["stages"]["analytics"] = stats.report()
+        if "ml" in stages and days < ML_MIN_DAYS:
+            report["stages"]["ml"] = {"skipped": f"needs at least {ML_MIN_DAYS} days"}
+        elif "ml" in stages:
+            report["stages"].update(run_ml(bucket, days, ml_steps, predictions))
+    tracemalloc.stop()
+    return report
+
+
+def run_ml(bucket: str, days: int, steps: int, predictions: int) -> dict:
+    """Fit on the published day files, then serve predictions from the registry"""
+    sys.path.insert(0, str(ROOT / "ml"))
+    import app
+    from app.__main__ import lambda_handler
+
+    paths = {"bucket": bucket, "models": "models", "metrics": "metrics/relax", "events": "metrics/events", "output": "predictions"}
+    event = {"model": "dense", "action": {"type": "fit", "start": days, "end": 0}, "paths": paths, "steps": steps}
+    store = app.Store(s3_bucket=bucket, models_path="models", metrics_path="metrics/relax", events_path="metrics/events")
+    fit = StageStats("ml_fit")
+    with fit.run():
+        source = app.DataSource(store, start=days, end=0)
+        flow = app.ModelFlow(event, source)
+        df = flow.load_data()
+        with fit.invocation(df.shape[0]):
+            model, std, mean, perf = flow.fit(df)
+            app.Registry(store).save(model, std, mean, flow.metadata(source, perf), flow.training_stats(df))
+    serve = StageStats("ml_predict")
+    predict = {**event, "action": {"type": "predict", "start": 1 + steps // 96, "end": 0}}
+    with serve.run():
+        for _ in range(predictions):
+            with serve.invocation(steps):
+                lambda_handler(predict, None)
+    return {"ml_fit": fit.report(), "ml_predict": serve.report()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Offline pipeline benchmark")
+    parser.add_argument("--days", default=14, type=int, help="Days of synthetic feed, ending yesterday")
+    parser.add_argument("--metrics", default=10, type=int, help="Metric names in the feed")
+    parser.add_argument("--incidents", default=2.0, type=float, help="Incidents per day")
+    parser.add_argument("--missed", default=0.0, type=float, help="Share of missed (and of duplicate) fetches")
+    parser.add_argument("--stages", default=",".join(STAGES), type=str, help="Comma separated stages to run")
+    parser.add_argument("--ml-steps", default=24, type=int, help="Input and forecast window of the ml stage")
+    parser.add_argument("--predictions", default=10, type=int, help="Warm predict invocations")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--out", default=None, type=str, help="Also write the report to this file")
+    argv = parser.parse_args()
+    stages = tuple(s for s in argv.stages.split(",") if s)
+    assert set(stages) <= set(STAGES), f"stages are {STAGES}"
+    out = Path(argv.out).resolve() if argv.out else None
+    report = run(argv.days, argv.metrics, argv.incidents, argv.missed, stages, argv.ml_steps, argv.predictions, argv.seed)
+    print(json.dumps(report, indent=2))
+    if out is not None:
+        out.write_text(json.dumps(report, indent=2))
@@ -0,0 +1,115 @@
+"""
+Analytics query latency and storage size of the legacy `metrics` table against the partitioned layout.
+
+Fills the legacy table with generated samples, migrates it with etl/util_partition.py and times the
+day and month queries of analytics/app.py on both layouts:
+
+    python bench/schema.py --days 180 --metrics 50
+"""
+from datetime import date, timedelta
+from time import perf_counter
+import argparse
+import json
+import sys
+import os
+
+import pandas as pd
+import numpy as np
+
+from feed import metric_names
+from run import ROOT, load_module, postgres
+
+LEGACY_QUERY = "SELECT * FROM metrics WHERE date_id >= '{before}' AND date_id < '{after}'"
+
+
+def fill_legacy(engine, days: int, metrics: int, first: date):
+    """One sample per metric every 15 minutes, inserted server side"""
+    from sqlalchemy import text
+
+    with engine.connect() as conn:
+        conn.execute(
+            text(
+                """
+                INSERT INTO metrics (date_id, timestamp_id, name, date, value)
+                SELECT to_char(t, 'YYYY-MM-DD'), t + interval '30 seconds', n, t, round((random() * 10)::numeric, 4)
+                FROM generate_series(CAST(:first AS timestamp), CAST(:last AS timestamp), interval '15 minutes') t
+                CROSS JOIN unnest(CAST(:names AS text[])) n
+                ORDER BY t
+                """
+            ),
+            {"first": first, "last": first + timedelta(days=days) - timedelta(minutes=15), "names": metric_names(metrics)},
+        )
+        conn.commit()
+
+
+def timed(engine, query: str, repeat: int) -> dict:
+    """Median and best latency of pd.read_sql, like analytics runs it"""
+    times = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        df = pd.read_sql(query, con=engine)
+        times.append((perf_counter() - t0) * 1000)
+    return {"rows": df.shape[0], "median_ms": float(np.median(times)), "min_ms": float(np.min(times))}
+
+
+def size_mb(engine, table: str) -> float:
+    from sqlalchemy import text
+
+    with engine.connect() as conn:
+        return conn.execute(
+            text(
+                "SELECT coalesce(sum(pg_total_relation_size(relid)), pg_total_relation_size(CAST(:t AS regclass))) / 2 ^ 20 "
+                "FROM pg_partition_tree(CAST(:t AS regclass))"
+            ),
+            {"t": table},
+        ).scalar()
+
+
+def run(days: int, metrics: int, repeat: int) -> dict:
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    first = date.today() - timedelta(days=days)
+    with postgres() as db_url:
+        os.environ["MJ_ETL_DB"] = db_url
+        sys.path.insert(0, str(ROOT / "etl"))
+        import util_partition
+
+        etl = sys.modules["app"]
+        analytics = load_module("mj_analytics", ROOT / "analytics" / "app.py")
+        etl.Metric.__table__.create(etl.engine, checkfirst=True)
+        t0 = perf_counter()
+        fill_legacy(etl.engine, days, metrics, first)
+        fill_s = perf_counter() - t0
+        t0 = perf_counter()
+        util_partition.migrate()
+        migrate_s = perf_counter() - t0
+        day = first + timedelta(days=days // 2)
+        month = date(day.year, day.month, 1)
+        ranges = {
+            "day": (day, day + timedelta(days=1)),
+            "month": (month, etl.next_month(month)),
+        }
+        report = {
+            "days": days,
+            "metrics": metrics,
+            "fill_s": fill_s,
+            "migrate_s": migrate_s,
+            "size_mb": {
+                "legacy": size_mb(etl.engine, "metrics"),
+                "partitioned": size_mb(etl.engine, "metric_samples") + size_mb(etl.engine, "metric_names"),
+            },
+        }
+        for name, (before, after) in ranges.items():
+            report[name] = {
+                "legacy": timed(etl.engine, LEGACY_QUERY.format(before=before, after=after), repeat),
+                "partitioned": timed(etl.engine, analytics.metrics_query.format(before=before, after=after), repeat),
+            }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Metrics schema benchmark")
+    parser.add_argument("--days", default=180, type=int)
+    parser.add_argument("--metrics", default=50, type=int)
+    parser.add_argument("--repeat", default=5, type=int)
+    argv = parser.parse_args()
+    print(json.dumps(run(argv.days, argv.metrics, argv.repeat), indent=2))
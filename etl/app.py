@@ -1,7 +1,7 @@
 """
 This module is responsible for parsing the data from the DynamoDb stream and storing in Postgres SQL database.
 """
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
 from pydantic import BaseModel, parse_obj_as
 from typing import TypedDict
 import boto3
@@ -9,9 +9,11 @@ import os
 
 from sqlalchemy.orm import mapped_column, Mapped, DeclarativeBase
 from sqlalchemy.dialects.postgresql import insert as pg_insert
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import MetaData, ForeignKey, Index, Identity, SmallInteger, REAL, DateTime, Text, select, text
 from typing_extensions import Annotated
 
+from shared import tracing, db, codec
+
 
 DB_URL = os.environ.get("MJ_ETL_DB")
 tablename = os.environ.get("MJ_STATUS_DYNAMODB_TABLE")
@@ -39,6 +41,8 @@ class Event(Base):
 
 
 class Metric(Base):
+    """Legacy layout, one row per sample with the full name. Read by util_partition.py only."""
+
     __tablename__ = "metrics"
 
     date_id: Mapped[strpk]
@@ -48,6 +52,33 @@ class Metric(Base):
     value: Mapped[float]
 
 
+class MetricName(Base):
+    """Dimension of metric names, samples reference the small int id"""
+
+    __tablename__ = "metric_names"
+
+    id: Mapped[int] = mapped_column(SmallInteger, Identity(), primary_key=True)
+    name: Mapped[str] = mapped_column(Text, unique=True)
+
+
+class MetricSample(Base):
+    """
+    One metric value per fetch, range partitioned by month of the fetch time `ts`.
+    Rows arrive in time order, so BRIN indexes on time stay a few pages per partition.
+    """
+
+    __tablename__ = "metric_samples"
+    __table_args__ = (
+        Index("metric_samples_ts_brin", "ts", postgresql_using="brin"),
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
+
+    ts: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True)
+    name_id: Mapped[int] = mapped_column(SmallInteger, ForeignKey("public.metric_names.id"), primary_key=True)
+    sampled: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    value: Mapped[float] = mapped_column(REAL)
+
+
 class NewImage(TypedDict):
     date: str
     timestamp: str
@@ -102,6 +133,7 @@ class MetricSchema(BaseModel):
         orm_mode = True
 
 
+@tracing.traced()
 def parse_dynamodb_items(items: list[dict[str, dict]]) -> list[dict[str, dict]]:
     # parse client response
     for item in items:
@@ -111,57 +143,141 @@ def parse_dynamodb_items(items: list[dict[str, dict]]) -> list[dict[str, dict]]:
             item[key] = [{a: b['S'] for a, b in i['M'].items()} for i in v] if isinstance(v, list) else v
     return items
 
-engine = create_engine(DB_URL)
+
+def item_names(ids: set[str]) -> dict[str, list[str]]:
+    """
+    Name dictionaries of version 2 items, fetched once per warm container. Strongly consistent reads,
+    fetch writes a dictionary just before the first item that uses it. Missing ones are left out.
+    """
+    for key in ids - NAMES.keys():
+        response = client.get_item(
+            TableName=tablename,
+            Key={"date": {"S": codec.NAMES_PARTITION}, "timestamp": {"S": key}},
+            ConsistentRead=True,
+        )
+        if "Item" in response:
+            NAMES[key] = codec.decode_names(parse_dynamodb_items([response["Item"]])[0])
+    return NAMES
+
+
+@tracing.traced()
+def decode_samples(items: list[dict]) -> list[dict]:
+    """Sample rows of version 2 items, straight from the packed arrays"""
+    names = item_names({item["names"] for item in items})
+    missing = [item for item in items if item["names"] not in names]
+    if missing:
+        # without its dictionary an item can't be decoded, the rest of the day still loads
+        tracing.count("items_without_names", len(missing))
+        print(f"Skipping {len(missing)} items without a name dictionary: {sorted({item['names'] for item in missing})}")
+    rows = []
+    for item in items:
+        if item["names"] not in names:
+            continue
+        values, offsets = codec.decode_metrics(item)
+        ts = datetime.strptime(item["timestamp"], codec.TIMESTAMP_FMT).replace(tzinfo=timezone.utc)
+        rows.extend(
+            {"ts": ts, "name": name, "sampled": ts + timedelta(seconds=offset), "value": value}
+            for name, value, offset in zip(names[item["names"]], values, offsets)
+        )
+    return rows
+
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def next_month(day: date) -> date:
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def ensure_partitions(conn, days: set[date]):
+    """Create the monthly metric_samples partitions covering days, once per warm container"""
+    months = sorted({month_start(d) for d in days} - PARTITIONS)
+    if months:
+        # concurrent invocations of a new month would race on the catalog, held until commit
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('metric_samples_partitions'))"))
+    for month in months:
+        conn.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS public.metric_samples_{month:%Y_%m} PARTITION OF public.metric_samples "
+                f"FOR VALUES FROM ('{month} 00:00+00') TO ('{next_month(month)} 00:00+00')"
+            )
+        )
+        PARTITIONS.add(month)
+
+
+def metric_ids(conn, names: set[str]) -> dict[str, int]:
+    """Ids of metric names, new names are added to the dimension"""
+    missing = names - NAME_IDS.keys()
+    if missing:
+        conn.execute(pg_insert(MetricName).on_conflict_do_nothing(), [{"name": n} for n in sorted(missing)])
+        rows = conn.execute(select(MetricName.name, MetricName.id).where(MetricName.name.in_(missing)))
+        NAME_IDS.update({name: id for name, id in rows})
+    return NAME_IDS
+
+
+engine = db.engine(DB_URL)
 client = boto3.client("dynamodb")
+# kept across warm invocations
+NAME_IDS: dict[str, int] = {}
+NAMES: dict[str, list[str]] = {}
+PARTITIONS: set[date] = set()
+TABLES = [Event.__table__, MetricName.__table__, MetricSample.__table__]
 
 
+@tracing.invocation("etl")
 def lambda_handler(event, context):
-    #  create tables if not exist
     if event.get('action') == 'test':
         return {"Status": "Success"}
+    #  create tables if not exist, once per container
     try:
-        Base.metadata.create_all(engine)
+        db.ensure_schema(engine, Base.metadata, TABLES)
     except BaseException as e:
         print(e)
-    # date to query
+    # date to query: today, yesterday (default) or an explicit YYYY-MM-DD
     today = datetime.today()
     if event.get("date") == "today":
         date = today.strftime("%Y-%m-%d")
-    else:
+    elif event.get("date") in (None, "yesterday"):
         date = (today - timedelta(days=1)).strftime("%Y-%m-%d")
+    else:
+        date = datetime.strptime(event["date"], "%Y-%m-%d").strftime("%Y-%m-%d")
     # from dynamodb
     lastEvaluatedKey = None
     items = []
     # https://www.beabetterdev.com/2021/10/20/dynamodb-scan-query-not-returning-data/
-    while True:
-        if lastEvaluatedKey == None:
-            response = client.query(
-                TableName=tablename,
-                KeyConditionExpression='#date = :dt',
-                ExpressionAttributeValues={":dt": {"S": date}},
-                ExpressionAttributeNames={"#date": "date"},
-            )
-        else:
-            response = client.query(
-                TableName=tablename,
-                KeyConditionExpression='#date = :dt',
-                ExpressionAttributeValues={":dt": {"S": date}},
-                ExpressionAttributeNames={"#date": "date"},
-                ExclusiveStartKey=lastEvaluatedKey # In subsequent calls, provide the ExclusiveStartKey
-            )
-        items.extend(response['Items'])
-        if 'LastEvaluatedKey' in response:
-            lastEvaluatedKey = response['LastEvaluatedKey']
-        else:
-            break
+    with tracing.span("dynamodb_query"):
+        while True:
+            if lastEvaluatedKey == None:
+                response = client.query(
+                    TableName=tablename,
+                    KeyConditionExpression='#date = :dt',
+                    ExpressionAttributeValues={":dt": {"S": date}},
+                    ExpressionAttributeNames={"#date": "date"},
+                )
+            else:
+                response = client.query(
+                    TableName=tablename,
+                    KeyConditionExpression='#date = :dt',
+                    ExpressionAttributeValues={":dt": {"S": date}},
+                    ExpressionAttributeNames={"#date": "date"},
+                    ExclusiveStartKey=lastEvaluatedKey # In subsequent calls, provide the ExclusiveStartKey
+                )
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' in response:
+                lastEvaluatedKey = response['LastEvaluatedKey']
+            else:
+                break
     items = parse_dynamodb_items(items)
+    tracing.count("items", len(items))
     print("Items received from DynamoDB:", len(items))
     if len(items) == 0:
         return {"Status": "No data"}
-    # parse
+    # parse, legacy items through the schema, packed ones straight from their arrays
     all_metrics = [
         {"date_id": item["date"], "timestamp_id": item["timestamp"], **m}
         for item in items
+        if codec.version(item) == 1
         for m in item["metrics"]
     ]
     all_events = [
@@ -169,14 +285,25 @@ def lambda_handler(event, context):
         for item in items
         for e in item["events"]
     ]
-    metrics_py = parse_obj_as(list[MetricSchema], all_metrics)
-    events_py = parse_obj_as(list[EventSchema], all_events)
-    print(len(metrics_py), len(events_py))
+    with tracing.span("validate"):
+        metrics_py = parse_obj_as(list[MetricSchema], all_metrics)
+        events_py = parse_obj_as(list[EventSchema], all_events)
+    samples = [{"ts": m.timestamp_id, "name": m.name, "sampled": m.date, "value": m.value} for m in metrics_py]
+    samples += decode_samples([item for item in items if codec.version(item) > 1])
+    print(len(samples), len(events_py))
     # to sql
-    with engine.connect() as conn:
-        if len(metrics_py) > 0:
+    tracing.count("metric_rows", len(samples))
+    tracing.count("event_rows", len(events_py))
+    with tracing.span("insert"), db.connect(engine) as conn:
+        if len(samples) > 0:
+            ensure_partitions(conn, {s["ts"].date() for s in samples})
+            ids = metric_ids(conn, {s["name"] for s in samples})
             conn.execute(
-                pg_insert(Metric).on_conflict_do_nothing(), [m.dict() for m in metrics_py]
+                pg_insert(MetricSample).on_conflict_do_nothing(),
+                [
+                    {"ts": s["ts"], "name_id": ids[s["name"]], "sampled": s["sampled"], "value": s["value"]}
+                    for s in samples
+                ],
             )
         if len(events_py) > 0:
             conn.execute(
@@ -187,4 +314,5 @@ def lambda_handler(event, context):
     return {"Status": "Success"}
 
 
-lambda_handler({"action": "fix", "date": "today"}, None)
\ No newline at end of file
+if __name__ == "__main__":
+    lambda_handler({"action": "fix", "date": "today"}, None)
\ No newline at end of file
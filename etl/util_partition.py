@@ -0,0 +1,69 @@
+"""
+Rewrite the legacy `metrics` table into `metric_names` + the monthly partitions of `metric_samples`.
+
+Run from this directory once, it can be rerun safely (inserts skip existing rows):
+
+    PYTHONPATH=.. python util_partition.py            # copy and verify
+    PYTHONPATH=.. python util_partition.py --drop     # then drop the legacy table
+"""
+from datetime import date
+import argparse
+
+from sqlalchemy import text
+
+from app import Base, TABLES, engine, ensure_partitions, month_start, next_month
+
+
+def months(first: date, last: date) -> list[date]:
+    out = [month_start(first)]
+    while out[-1] < month_start(last):
+        out.append(next_month(out[-1]))
+    return out
+
+
+def migrate(drop: bool = False):
+    Base.metadata.create_all(engine, tables=TABLES)
+    with engine.connect() as conn:
+        first, last = conn.execute(text("SELECT min(timestamp_id)::date, max(timestamp_id)::date FROM metrics")).one()
+        if first is None:
+            print("Legacy table is empty")
+            return
+        ensure_partitions(conn, set(months(first, last)))
+        conn.execute(
+            text("INSERT INTO metric_names (name) SELECT DISTINCT name FROM metrics ORDER BY name ON CONFLICT DO NOTHING")
+        )
+        conn.commit()
+        # a month per transaction, legacy timestamps are UTC without a zone
+        for month in months(first, last):
+            result = conn.execute(
+                text(
+                    """
+                    INSERT INTO metric_samples (ts, name_id, sampled, value)
+                    SELECT m.timestamp_id AT TIME ZONE 'UTC', n.id, m.date AT TIME ZONE 'UTC', m.value
+                    FROM metrics m JOIN metric_names n ON n.name = m.name
+                    WHERE m.timestamp_id >= :start AND m.timestamp_id < :end
+                    ORDER BY m.timestamp_id
+                    ON CONFLICT DO NOTHING
+                    """
+                ),
+                {"start": month, "end": next_month(month)},
+            )
+            conn.commit()
+            print(f"{month:%Y-%m}: {result.rowcount} rows")
+        legacy = conn.execute(text("SELECT count(*) FROM metrics")).scalar()
+        samples = conn.execute(text("SELECT count(*) FROM metric_samples")).scalar()
+        print(f"legacy rows {legacy}, sample rows {samples}")
+        if samples < legacy:
+            raise RuntimeError("Rows are missing from metric_samples, the legacy table was kept")
+        conn.execute(text("ANALYZE metric_names"))
+        conn.execute(text("ANALYZE metric_samples"))
+        if drop:
+            conn.execute(text("DROP TABLE metrics"))
+            print("Dropped the legacy table")
+        conn.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Metrics partitioning migration")
+    parser.add_argument("--drop", action="store_true", help="Drop the legacy table after a verified copy")
+    migrate(parser.parse_args().drop)
@@ -0,0 +1,184 @@
+"""
+Streaming slow wait detector, updated with every fetched sample.
+
+State is a set of preallocated arrays with a row per metric: EWMA mean and variance, a CUSUM of the
+standardized rise over the EWMA and a ring buffer with the last day of samples for the rolling
+quantile. An update touches only the rows of the sampled metrics, memory is constant per metric and
+rows double when new metric names show up.
+
+Flags of a metric on the tick its sample arrives:
+- slow: the wait is at or above the slow threshold, the definition the ML backtests use
+- spike: above the rolling quantile of the last day and several EWMA deviations out
+- shift: the CUSUM crossed its limit, a sustained rise too small to be a spike
+"""
+from datetime import datetime
+from typing import TypedDict
+import json
+import io
+
+import numpy as np
+
+from shared.waits import SLOW_WAIT
+
+MINUTES_PER_SAMPLE = 15
+WINDOW = 24 * 60 // MINUTES_PER_SAMPLE  # ring buffer length, a day of ticks
+TIMESTAMP_FMT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class Alert(TypedDict):
+    name: str
+    timestamp: str
+    value: float
+    ewma: float
+    quantile: float
+    cusum: float
+    reasons: list[str]
+
+
+def tick_of(timestamp: str) -> int:
+    """15 minute tick since the epoch of a fetch timestamp"""
+    seconds = (datetime.strptime(timestamp, TIMESTAMP_FMT) - datetime(1970, 1, 1)).total_seconds()
+    return int(seconds // (MINUTES_PER_SAMPLE * 60))
+
+
+class Detector:
+    # per metric rows, resized together
+    ROWS = ("mean", "var", "cusum", "count", "last_tick", "ring", "ring_tick")
+    PARAMS = ("window", "span", "quantile", "z_limit", "k", "h", "slow", "min_samples", "min_sd")
+
+    def __init__(
+        self,
+        capacity: int = 64,
+        window: int = WINDOW,
+        span: int = 16,
+        quantile: float = 0.95,
+        z_limit: float = 3.0,
+        k: float = 1.5,
+        h: float = 6.0,
+        slow: float = SLOW_WAIT,
+        min_samples: int = 8,
+        min_sd: float = 0.25,
+    ) -> None:
+        """
+        span: EWMA span in ticks. quantile: rolling quantile a spike must exceed. z_limit: EWMA
+        deviations of a spike. k, h: CUSUM allowance and decision limit in deviations. min_samples:
+        ticks before spikes and shifts are flagged. min_sd: deviation floor in minutes, flat series
+        would flag any change otherwise.
+        """
+        self.window = window
+        self.span = span
+        self.quantile = quantile
+        self.z_limit = z_limit
+        self.k = k
+        self.h = h
+        self.slow = slow
+        self.min_samples = min_samples
+        self.min_sd = min_sd
+        self.alpha = 2 / (span + 1)
+        self.names: list[str] = []
+        self.index: dict[str, int] = {}
+        self.mean = np.zeros(capacity)
+        self.var = np.zeros(capacity)
+        self.cusum = np.zeros(capacity)
+        self.count = np.zeros(capacity, dtype=np.int64)
+        self.last_tick = np.full(capacity, -1, dtype=np.int64)
+        self.ring = np.full((capacity, window), np.nan, dtype=np.float32)
+        self.ring_tick = np.full((capacity, window), -1, dtype=np.int32)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.ROWS)
+
+    def _grow(self, size: int):
+        capacity = len(self.mean)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name in self.ROWS:
+            old = getattr(self, name)
+            fill = np.nan if name == "ring" else -1 if name in ("last_tick", "ring_tick") else 0
+            new = np.full((capacity,) + old.shape[1:], fill, dtype=old.dtype)
+            new[: len(old)] = old
+            setattr(self, name, new)
+
+    def rows(self, names: list[str]) -> np.ndarray:
+        """Row of every name, new names get a row"""
+        for name in names:
+            if name not in self.index:
+                self.index[name] = len(self.names)
+                self.names.append(name)
+        self._grow(len(self.names))
+        return np.fromiter((self.index[name] for name in names), dtype=np.int64, count=len(names))
+
+    def rolling_quantile(self, rows: np.ndarray, tick: int) -> tuple[np.ndarray, np.ndarray]:
+        """Quantile of the ring samples of the last window ticks and their count"""
+        values = self.ring[rows]
+        values[(self.ring_tick[rows] <= tick - self.window) | np.isnan(values)] = np.inf
+        n = np.isfinite(values).sum(axis=1)
+        ordered = np.sort(values, axis=1)
+        rank = np.clip(np.ceil(self.quantile * n).astype(np.int64) - 1, 0, self.window - 1)
+        q = np.take_along_axis(ordered, rank[:, None], axis=1)[:, 0].astype(np.float64)
+        return np.where(n > 0, q, np.nan), n
+
+    def update(self, names: list[str], values, timestamp: str) -> list[Alert]:
+        """Add one fetch, samples of a tick a metric already has are ignored. Returns the alerts."""
+        tick = tick_of(timestamp)
+        rows = self.rows(names)
+        x = np.asarray(values, dtype=np.float64)
+        fresh = (self.last_tick[rows] < tick) & np.isfinite(x)
+        rows, x = rows[fresh], x[fresh]
+        quantile, n = self.rolling_quantile(rows, tick)
+        mean, var, count = self.mean[rows], self.var[rows], self.count[rows]
+        first = count == 0
+        d = np.where(first, 0.0, x - mean)
+        z = d / np.maximum(np.sqrt(var), self.min_sd)
+        ready = count >= self.min_samples
+        cusum = np.where(ready, np.maximum(0.0, self.cusum[rows] + z - self.k), 0.0)
+        slow = x >= self.slow
+        spike = ready & (n >= self.min_samples) & (x > quantile) & (z >= self.z_limit)
+        shift = cusum > self.h
+        # state for the next tick, a crossed CUSUM starts over
+        self.mean[rows] = np.where(first, x, mean + self.alpha * d)
+        self.var[rows] = (1 - self.alpha) * (var + self.alpha * d * d)
+        self.cusum[rows] = np.where(shift, 0.0, cusum)
+        self.count[rows] = count + 1
+        self.last_tick[rows] = tick
+        self.ring[rows, tick % self.window] = x
+        self.ring_tick[rows, tick % self.window] = tick
+        alerts = []
+        for i in np.flatnonzero(slow | spike | shift).tolist():
+            alerts.append(
+                {
+                    "name": self.names[rows[i]],
+                    "timestamp": timestamp,
+                    "value": float(x[i]),
+                    "ewma": float(mean[i]),
+                    "quantile": float(quantile[i]),
+                    "cusum": float(cusum[i]),
+                    "reasons": [r for r, flag in (("slow", slow[i]), ("spike", spike[i]), ("shift", shift[i])) if flag],
+                }
+            )
+        return alerts
+
+    def to_bytes(self) -> bytes:
+        """npz of the used rows, names and parameters"""
+        n = len(self.names)
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            names=np.array(self.names, dtype=str),
+            params=np.array(json.dumps({p: getattr(self, p) for p in self.PARAMS})),
+            **{name: getattr(self, name)[:n] for name in self.ROWS},
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, body: bytes) -> "Detector":
+        with np.load(io.BytesIO(body)) as state:
+            names = state["names"].tolist()
+            detector = cls(capacity=max(64, len(names)), **json.loads(state["params"].item()))
+            detector.rows(names)
+            for name in cls.ROWS:
+                getattr(detector, name)[: len(names)] = state[name]
+        return detector
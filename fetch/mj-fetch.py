@@ -5,6 +5,9 @@ import boto3
 import json
 import os
 
+from shared import tracing, codec
+import detector
+
 
 class EventBridgeData(TypedDict):
     url: str
@@ -21,7 +24,19 @@ class StatusData(TypedDict):
 dynamodb = boto3.resource("dynamodb")
 tablename = os.environ.get("MJ_STATUS_DYNAMODB_TABLE")
 client = boto3.client("dynamodb")
+s3 = boto3.client("s3")
 TIMESTAMP_FMT = "%Y-%m-%dT%H:%M:%SZ"
+# item layout written, 1 for the original list of string maps
+ITEM_VERSION = int(os.environ.get("MJ_ITEM_VERSION", codec.VERSION))
+# name dictionaries this container already wrote
+NAMES_WRITTEN: set[str] = set()
+# detector state lives in the warm container, and in this bucket between cold starts when set
+DETECTOR_BUCKET = os.environ.get("MJ_DETECTOR_BUCKET")
+DETECTOR_KEY = "detector/state.npz"
+DETECTOR: detector.Detector | None = None
+# state is written back every this many updates and on alerts, a cold start loses at most the ticks since
+DETECTOR_WRITE_EVERY = int(os.environ.get("MJ_DETECTOR_WRITE_EVERY", 4))
+DETECTOR_UPDATES = 0
 
 
 def table_exists(tablename):
@@ -53,16 +68,20 @@ def create_table_if_not_exists(tablename: str):
     return tablename
 
 
+@tracing.traced()
 def fetch_data(url: str):
     """Fetch data from url and store in dynamodb."""
     try:
         with urlopen(url) as response:
-            return json.loads(response.read())
+            body = response.read()
+            tracing.count("feed_bytes", len(body))
+            return json.loads(body)
     except BaseException as e:
         print(e)
         return {"status": "failure", "events": [], "metrics": []}
 
 
+@tracing.traced()
 def parse_data(data: StatusData):
     """Verify data contents and format."""
     try:
@@ -92,6 +111,8 @@ def parse_data(data: StatusData):
                     ).strftime(TIMESTAMP_FMT)
             return metric
         
+        tracing.count("metrics", len(metrics))
+        tracing.count("events", len(events))
         return {
             "status": data["status"],
             "events": [parse_event(event) for event in events if event["alert_id"] not in alert_ids],
@@ -102,25 +123,68 @@ def parse_data(data: StatusData):
         return {"status": "failure", "events": [], "metrics": []}
 
 
+def load_detector() -> detector.Detector:
+    if DETECTOR_BUCKET is None:
+        return detector.Detector()
+    try:
+        body = s3.get_object(Bucket=DETECTOR_BUCKET, Key=DETECTOR_KEY)["Body"].read()
+        return detector.Detector.from_bytes(body)
+    except s3.exceptions.NoSuchKey:
+        return detector.Detector()
+
+
+@tracing.traced()
+def detect(data: StatusData, timestamp: str) -> list[detector.Alert]:
+    """Update the detector with a parsed fetch, a failing detector never blocks storing the data"""
+    global DETECTOR, DETECTOR_UPDATES
+    try:
+        if DETECTOR is None:
+            DETECTOR = load_detector()
+        metrics = data["metrics"]
+        alerts = DETECTOR.update([m["name"] for m in metrics], [float(m["value"]) for m in metrics], timestamp)
+        DETECTOR_UPDATES += 1
+        if DETECTOR_BUCKET is not None and (alerts or DETECTOR_UPDATES % DETECTOR_WRITE_EVERY == 0):
+            s3.put_object(Bucket=DETECTOR_BUCKET, Key=DETECTOR_KEY, Body=DETECTOR.to_bytes())
+        tracing.count("alerts", len(alerts))
+        if alerts:
+            print(json.dumps({"alerts": alerts}))
+        return alerts
+    except BaseException as e:
+        print(e)
+        return []
+
+
 def fetch_test_data():
     """Load test json"""
     with open("data.json") as f:
         return json.load(f)
 
 
-def put_item(tablename, data: StatusData):
-    """Add item to table. Store timestamp with year, month, date, hour, minute."""
+@tracing.traced()
+def put_item(tablename, data: StatusData, timestamp: str = None):
+    """
+    Add item to table. Store timestamp with year, month, date, hour, minute, now by default.
+    Metrics are packed against a name dictionary (see shared/codec.py) unless ITEM_VERSION is 1.
+    """
     table = dynamodb.Table(tablename)
-    timestamp = str(datetime.now().strftime(TIMESTAMP_FMT))
-    return timestamp, table.put_item(
-        Item={
-            "date": timestamp[:10],
-            "timestamp": timestamp,
-            "status": data["status"],
-            "metrics": data["metrics"],
-            "events": data["events"],
-        }
-    )
+    timestamp = str(datetime.now().strftime(TIMESTAMP_FMT)) if timestamp is None else timestamp
+    item = {
+        "date": timestamp[:10],
+        "timestamp": timestamp,
+        "status": data["status"],
+        "events": data["events"],
+    }
+    if ITEM_VERSION == 1 or not data["metrics"]:
+        item["metrics"] = data["metrics"]
+    else:
+        names, packed = codec.encode_metrics(data["metrics"], timestamp)
+        if packed["names"] not in NAMES_WRITTEN:
+            # written before the items that reference it, rewriting an existing one is harmless
+            table.put_item(Item=codec.encode_names(names))
+            NAMES_WRITTEN.add(packed["names"])
+        item.update(packed)
+        tracing.count("item_bytes", len(packed["metrics"]))
+    return timestamp, table.put_item(Item=item)
 
 
 def delete_item(tablename, timestamp):
@@ -129,33 +193,37 @@ def delete_item(tablename, timestamp):
     return table.delete_item(Key={"date": timestamp[:10], "timestamp": timestamp})
 
 
+@tracing.invocation("fetch")
 def lambda_handler(event: EventBridgeData, context):
-    tablename = create_table_if_not_exists(tablename=tablename)
+    table_name = create_table_if_not_exists(tablename=tablename)
     if event["action"] == "test":
         data = parse_data(fetch_test_data())
         print(data)
-        timestamp, db_response = put_item(tablename, data)
-        db_response = delete_item(tablename, timestamp)
+        timestamp, db_response = put_item(table_name, data)
+        db_response = delete_item(table_name, timestamp)
         return {
             "statusCode": 200,
             "body": {"status": data["status"], "db": db_response, "event": event},
         }
     elif event["action"] == "fetch":
         data = parse_data(fetch_data(url=event["url"]))
-        timestamp, db_response = put_item(tablename, data)
+        timestamp = datetime.now().strftime(TIMESTAMP_FMT)
+        alerts = detect(data, timestamp)
+        timestamp, db_response = put_item(table_name, data, timestamp)
         response = {
             "statusCode": 200,
-            "body": {"status": data["status"], "db": db_response, "event": event},
+            "body": {"status": data["status"], "db": db_response, "event": event, "alerts": alerts},
         }
         print(response)
         return response
 
 
-lambda_handler(
-    {
-        "action": "test",
-        "url": "https://status-feed-streedkusq-ue.a.run.app/",
-        "tablename": tablename,
-    },
-    None,
-)
+if __name__ == "__main__":
+    lambda_handler(
+        {
+            "action": "test",
+            "url": "https://status-feed-streedkusq-ue.a.run.app/",
+            "tablename": tablename,
+        },
+        None,
+    )
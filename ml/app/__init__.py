@@ -14,9 +14,16 @@ from app.preprocessing import (
     normalize_training_data,
     generate_sliding_window,
     clip_data,
+    RunningStats,
 )
-from app.compile import compile_and_fit
+from app.compile import compile_and_fit, compile_model, PipelineProfiler
 from app.window import WindowGenerator, get_predict_window_dataset
-from app.schema import Config, Event
-from app.storage import Store
+from app.schema import Config, Event, Pipeline, Search
+from app.storage import Store, DataSource
+from app.parallel import run_folds, fit_fold, build_model, SharedFrame, worker_pool
+from app.search import TrialSearch, sample_trials, fit_trial, pareto_front
+from app.frequency import welch_spectrum, dominant_periods, frequencies_from_columns
+from app.registry import Registry, Artifact
+from app.publish import Publisher, Forecast, forecast_origin
+from app.backtest import score, score_table
 from app.flow import ModelFlow
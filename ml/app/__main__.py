@@ -1,47 +1,173 @@
 from datetime import datetime
+from time import perf_counter
 import app
+import app.storage
+import pandas as pd
 import os
 
+from shared import tracing
+
 bucketname = os.environ.get("MJ_STATUS_BUCKET")
 
 
+# kept across warm invocations, the model itself is cached by the registry
+WARM = {"invocations": 0}
+
+
+@tracing.invocation("ml")
 def lambda_handler(event, context):
-    """"""
+    """
+    Serve predictions. The model, its stats and the decoded days of the window stay in memory
+    between warm invocations, only days that aren't cached yet are fetched.
+    """
+    t0 = perf_counter()
+    cold = WARM["invocations"] == 0
+    WARM["invocations"] += 1
     event = app.Event(**event)
     # storage
     store = app.Store(
         s3_bucket=bucketname,
         models_path=event.paths.models,
         metrics_path=event.paths.metrics,
+        events_path=event.paths.events,
     )
-    data = store.download_s3_files(start=event.action.start, end=event.action.end)
-    # load model
-    flow = app.ModelFlow(event)
-    df = flow.process_metrics([d["data"] for d in sorted(data, key=lambda x: x["path"])])
-    # main(event)
+    source = app.DataSource(store, start=event.action.start, end=event.action.end)
+    artifact = app.Registry(store).load(event.model, event.version)
+    t_model = perf_counter()
+    # load data, forget days that left the window
+    flow = app.ModelFlow(event.dict(), source)
+    flow.frequencies = artifact["meta"]["frequencies"]
+    reads = sum(app.storage.READS.values())
+    df = flow.load_data()
+    app.storage.retain(source.paths(store.metrics_path) + source.paths(store.events_path))
+    t_data = perf_counter()
+    # predict
+    model, std, mean = artifact["model"], artifact["std"], artifact["mean"]
+    if event.action.origins > 1:
+        origins = df.index[-event.action.origins:] + pd.Timedelta(minutes=app.Config.MINUTES_PER_SAMPLE)
+        forecasts = flow.predict_batch(df, model, std, mean, origins)
+        prediction = {
+            str(origin): g.pivot(index="horizon", columns="label", values="value").astype(float).to_dict(orient="list")
+            for origin, g in forecasts.groupby("origin")
+        }
+    else:
+        forecast = flow.predict(df, model, std, mean)
+        prediction = forecast.astype(float).to_dict(orient="list")
+        if event.publish:
+            publisher = app.Publisher(store, event.paths.output)
+            prediction = publisher.publish(forecast, event.model, artifact["version"], app.forecast_origin(df))
+    t1 = perf_counter()
+    latency_ms = (t1 - t0) * 1000
+    timing = {
+        "model_ms": (t_model - t0) * 1000,
+        "data_ms": (t_data - t_model) * 1000,
+        "predict_ms": (t1 - t_data) * 1000,
+        "latency_ms": latency_ms,
+        "files_read": sum(app.storage.READS.values()) - reads,
+    }
+    print({"cold": cold, "version": artifact["version"], **timing})
+    return {
+        "statusCode": 200,
+        "body": {
+            "model": event.model,
+            "version": artifact["version"],
+            "cold": cold,
+            "within_budget": event.budget_ms is None or latency_ms <= event.budget_ms,
+            "timing": timing,
+            "prediction": prediction,
+        },
+    }
 
 
 def main(event: app.Event):
     # setup
     event = app.Event(**event)
-    store = app.Store(models_path=event.paths.models, metrics_path=event.paths.metrics)
-    data = store.load_local_files(start=event.action.start, end=event.action.end)
-    data = sorted(data, key=lambda x: x["path"])
+    store = app.Store(
+        models_path=event.paths.models,
+        metrics_path=event.paths.metrics,
+        events_path=event.paths.events,
+    )
+    source = app.DataSource(store, start=event.action.start, end=event.action.end)
+    registry = app.Registry(store)
     # load model
-    flow = app.ModelFlow(event)
-    df = flow.process_metrics([d["data"] for d in data])
+    flow = app.ModelFlow(event.dict(), source)
+    if flow.is_predict or event.action.type == "update":
+        artifact = registry.load(event.model, event.version, cache=flow.is_predict)
+        model, std, mean = artifact["model"], artifact["std"], artifact["mean"]
+        # time features must match the ones the model was trained with
+        flow.frequencies = artifact["meta"]["frequencies"]
+        print("Model version:", artifact["version"])
+    # a fit's stats end with the last fold's train rows, load everything after them plus the history before
+    if event.action.type == "update" and artifact["meta"].get("stats_until"):
+        start = max(event.action.start, flow.update_days(artifact["meta"]["stats_until"]))
+        source = flow.source = app.DataSource(store, start=start, end=event.action.end)
+    # out of core fit, the series never gets loaded as a whole
+    if event.action.type == "fit" and flow.out_of_core:
+        model, stats, perf = flow.fit_out_of_core(source, f"{event.paths.models}/{event.model}_series.npy")
+        print(perf)
+        print("Model version:", registry.save(model, stats.std, stats.mean, flow.metadata(source, perf), stats))
+        return
+    df = flow.load_data()
+    print("I/O:", source.io_stats())
+    # sweep
+    if event.action.type == "sweep":
+        leaderboard = flow.sweep(df)
+        print(leaderboard)
+        leaderboard.to_csv(f"{event.paths.models}/leaderboard.csv", index=False)
+        return
+    # hyperparameter search
+    if event.action.type == "search":
+        leaderboard = flow.search(df)
+        print(leaderboard.drop(columns="params").to_string())
+        print("Pareto front:")
+        print(leaderboard[leaderboard["pareto"]][["model", "params", "input_width", "val_mae", "test_mae", "latency_ms"]].to_string())
+        leaderboard.to_csv(f"{event.paths.models}/search.csv", index=False)
+        return
+    # incremental update, falls back to a full fit when validation loss degrades
+    if event.action.type == "update":
+        model, stats, perf, ok = flow.update(df, model, artifact["stats"], artifact["meta"].get("stats_until"))
+        print(perf)
+        if ok:
+            meta = flow.metadata(source, perf, parent=artifact["version"])
+            print("Model version:", registry.save(model, stats.std, stats.mean, meta, stats))
+            return
+        print("Validation loss degraded, retraining from scratch")
+        # same number of days as the model was trained on, up to the newest data
+        first, last = (pd.Timestamp(day) for day in artifact["meta"]["training_range"])
+        fit = {"type": "fit", "start": (last - first).days + 1, "end": 0}
+        return main({**event.dict(), "action": fit, "frequencies": artifact["meta"]["frequencies"]})
     # fit
     if not flow.is_predict:
         model, std, mean, perf = flow.fit(df)
         print(perf)
-        perf.mean().to_csv(f"{event.paths.models}/{event.model}.csv")
-        store.store_local_models(model, std, mean)
+        stats = flow.training_stats(df)
+        print("Model version:", registry.save(model, std, mean, flow.metadata(source, perf), stats))
+        return
+    # score forecasts of past origins against what happened
+    if event.action.type == "backtest":
+        t0 = perf_counter()
+        # the training range is whole days, origins from the day after it are out of sample
+        after = pd.Timestamp(artifact["meta"]["training_range"][1]) + pd.Timedelta(days=1)
+        scores = flow.backtest(df, model, std, mean, event.action.origins, after=after)
+        print(f"Backtested up to {event.action.origins} origins in {perf_counter() - t0:.1f}s")
+        print(scores.groupby("label", observed=True)[["mae", "rmse", "mape", "hit_rate", "false_alarm"]].mean())
+        scores.to_csv(f"{event.paths.output}/{event.model}_{artifact['version']}_backtest.csv", index=False, float_format="%.5g")
         return
     # predict
-    model, std, mean = store.load_local_models(event.model)
-    prediction = flow.predict(df, model, std, mean)
     date = datetime.now().strftime("%Y-%m-%d")
+    if event.action.origins > 1:
+        # the index has no freq, days can be missing, each origin is the sample after one of the last ones
+        origins = df.index[-event.action.origins:] + pd.Timedelta(minutes=app.Config.MINUTES_PER_SAMPLE)
+        forecasts = flow.predict_batch(df, model, std, mean, origins)
+        forecasts.to_csv(f"{event.paths.output}/{event.model}_{date}_batch.csv", index=False)
+        return
+    prediction = flow.predict(df, model, std, mean)
     prediction.to_csv(f"{event.paths.output}/{event.model}_{date}.csv", index=False)
+    if event.publish:
+        forecast = app.Publisher(store, event.paths.output).publish(
+            prediction, event.model, artifact["version"], app.forecast_origin(df)
+        )
+        print("Published:", forecast["json"])
     #
     # local testing storage
     #
@@ -61,6 +187,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="Time Series Forecasting")
     parser.add_argument("--model", default="dense", type=str, help="Model name: dense, cnn, lstm")
     parser.add_argument("--predict", action="store_true")
+    parser.add_argument("--publish", action="store_true", help="Write the forecast under forecasts/")
+    parser.add_argument("--origins", default=1, type=int, help="Batched predict over the last N sample origins")
+    parser.add_argument("--version", default=None, type=str, help="Model version, latest by default")
+    parser.add_argument("--update", action="store_true", help="Fine-tune the stored model on the newest day")
+    parser.add_argument("--backtest", action="store_true", help="Score forecasts over the last --days, --origins of them (all by default)")
+    parser.add_argument("--sweep", action="store_true", help="Train all models and write a leaderboard")
+    parser.add_argument("--search", default=None, choices=("halving", "median"), help="Hyperparameter search with this pruning scheduler")
+    parser.add_argument("--trials", default=12, type=int, help="Configurations sampled by --search")
+    parser.add_argument("--batch-size", default=32, type=int, help="Training batch size")
+    parser.add_argument("--cache", default="memory", type=str, help="Dataset cache: memory, none or a directory")
+    parser.add_argument("--frequencies", default=None, type=str, help="'auto' to pick time features by FFT")
+    parser.add_argument("--out-of-core", action="store_true", help="Fit from a memory mapped series")
+    parser.add_argument("--days", default=28, type=int, help="Days of history to fit on")
+    parser.add_argument("--workers", default=1, type=int, help="Processes used to train folds")
+    parser.add_argument("--profile", action="store_true", help="Report input vs compute time per epoch")
     argv = parser.parse_args()
     paths = {
         "bucket": bucketname,
@@ -69,14 +210,42 @@ if __name__ == "__main__":
         "events": "metrics/events",
         "output": "predictions",
     }
+    pipeline = {
+        "batch_size": argv.batch_size,
+        "cache": {"memory": True, "none": False}.get(argv.cache, argv.cache),
+        "profile": argv.profile,
+    }
     fit = {
         "model": argv.model,
-        "action": {"type": "fit", "start": 28, "end": 0},
+        "action": {"type": "fit", "start": argv.days, "end": 0},
         "paths": paths,
+        "pipeline": pipeline,
+        "out_of_core": argv.out_of_core,
+        "workers": argv.workers,
+        "frequencies": argv.frequencies,
     }
     predict = {
         "model": argv.model,
-        "action": {"type": "predict", "start": 1, "end": 0},
+        "version": argv.version,
+        "action": {
+            "type": "predict",
+            "start": 1 + argv.origins // app.Config.SAMPLES_PER_DAY,
+            "end": 0,
+            "origins": argv.origins,
+        },
         "paths": paths,
+        "pipeline": pipeline,
+        "publish": argv.publish,
     }
-    main(predict if argv.predict else fit)
+    sweep = {**fit, "action": {**fit["action"], "type": "sweep"}}
+    search = {**fit, "action": {**fit["action"], "type": "search"}, "search": {"scheduler": argv.search or "halving", "trials": argv.trials}}
+    update = {**fit, "action": {"type": "update", "start": 7, "end": 0}}
+    backtest = {**predict, "action": {"type": "backtest", "start": argv.days, "end": 0, "origins": argv.origins if argv.origins > 1 else argv.days * app.Config.SAMPLES_PER_DAY}}
+    main(
+        predict if argv.predict
+        else backtest if argv.backtest
+        else sweep if argv.sweep
+        else search if argv.search
+        else update if argv.update
+        else fit
+    )
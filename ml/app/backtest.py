@@ -0,0 +1,61 @@
+"""
+Forecast accuracy against realized metrics.
+
+Forecasts and realized values are (origins, horizon, labels) arrays, every score reduces over the
+origins axis so results are per horizon and label.
+"""
+import pandas as pd
+import numpy as np
+
+from app.schema import Config
+
+
+def realized(values: np.ndarray, positions: np.ndarray, steps: int) -> np.ndarray:
+    """(origins, steps, labels) values that followed each origin position"""
+    windows = np.lib.stride_tricks.sliding_window_view(values, steps, axis=0)
+    return windows[positions].transpose(0, 2, 1)
+
+
+def _ratio(num: np.ndarray, den: np.ndarray) -> np.ndarray:
+    """num / den, NaN where den is 0"""
+    return np.divide(num, den, out=np.full(num.shape, np.nan), where=den > 0)
+
+
+def score(
+    forecast: np.ndarray, actual: np.ndarray, threshold: float = Config.SLOW_WAIT
+) -> dict[str, np.ndarray]:
+    """
+    MAE, RMSE, MAPE (over nonzero actuals) and slow wait detection per (horizon, label).
+    A wait is slow at or above threshold. hit_rate is the share of slow waits that were forecast as
+    slow, false_alarm the share of normal waits forecast as slow.
+    """
+    error = forecast - actual
+    absolute = np.abs(error)
+    nonzero = actual != 0
+    slow = actual >= threshold
+    forecast_slow = forecast >= threshold
+    return {
+        "mae": absolute.mean(axis=0),
+        "rmse": np.sqrt((error**2).mean(axis=0)),
+        "mape": _ratio(
+            np.where(nonzero, absolute / np.where(nonzero, np.abs(actual), 1), 0).sum(axis=0),
+            nonzero.sum(axis=0),
+        ),
+        "slow": slow.sum(axis=0),
+        "hit_rate": _ratio((slow & forecast_slow).sum(axis=0), slow.sum(axis=0)),
+        "false_alarm": _ratio((~slow & forecast_slow).sum(axis=0), (~slow).sum(axis=0)),
+    }
+
+
+def score_table(scores: dict[str, np.ndarray], labels: list[str]) -> pd.DataFrame:
+    """Long table with one row per label and horizon (samples ahead, from 1)"""
+    steps = next(iter(scores.values())).shape[0]
+    table = pd.DataFrame(
+        {
+            "label": pd.Categorical(np.tile(labels, steps), categories=labels),
+            "horizon": np.repeat(np.arange(1, steps + 1, dtype=np.int16), len(labels)),
+        }
+    )
+    for name, values in scores.items():
+        table[name] = values.reshape(-1).astype(np.int32 if name == "slow" else np.float32)
+    return table.sort_values(["label", "horizon"], ignore_index=True)
@@ -1,20 +1,66 @@
+from time import perf_counter
 import tensorflow as tf
 
 
-def compile_and_fit(model, window, patience=2, max_epocs=20):
-    early_stopping = tf.keras.callbacks.EarlyStopping(
-        monitor="val_loss", patience=patience, mode="min"
-    )
+class PipelineProfiler(tf.keras.callbacks.Callback):
+    """Split each epoch into time waiting for input batches and time computing them."""
+
+    def __init__(self):
+        super().__init__()
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.input_time = self.compute_time = 0.0
+        self.batches = 0
+        self.mark = perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        now = perf_counter()
+        self.input_time += now - self.mark
+        self.mark = now
+
+    def on_train_batch_end(self, batch, logs=None):
+        now = perf_counter()
+        self.compute_time += now - self.mark
+        self.batches += 1
+        self.mark = now
+
+    def on_epoch_end(self, epoch, logs=None):
+        total = self.input_time + self.compute_time
+        report = {
+            "epoch": epoch,
+            "batches": self.batches,
+            "input_s": round(self.input_time, 4),
+            "compute_s": round(self.compute_time, 4),
+            "bound": "input" if self.input_time > self.compute_time else "compute",
+            "input_ratio": round(self.input_time / total, 3) if total > 0 else 0.0,
+        }
+        self.epochs.append(report)
+        print(report)
+
+
+def compile_model(model):
     model.compile(
         loss=tf.keras.losses.MeanSquaredError(),
         optimizer=tf.keras.optimizers.Adam(),
         metrics=[tf.keras.metrics.MeanAbsoluteError()],
     )
+    return model
+
+
+def compile_and_fit(model, window, patience=2, max_epocs=20, profile=False):
+    early_stopping = tf.keras.callbacks.EarlyStopping(
+        monitor="val_loss", patience=patience, mode="min"
+    )
+    callbacks = [early_stopping]
+    if profile:
+        callbacks.append(PipelineProfiler())
+    compile_model(model)
     history = model.fit(
         window.train,
         epochs=max_epocs,
         validation_data=window.val,
-        callbacks=[early_stopping],
+        callbacks=callbacks,
         verbose=0,
     )
     return history
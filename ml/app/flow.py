@@ -1,17 +1,28 @@
+from contextlib import nullcontext
+from time import perf_counter
 import pandas as pd
 import numpy as np
+import json
 
 from app.preprocessing import (
     clip_data,
     add_time_features,
     generate_sliding_window,
-    normalize_training_data,
+    RunningStats,
 )
 from app.window import get_predict_window_dataset, WindowGenerator
 from app.models import Model
-from app.compile import compile_and_fit
-from app.schema import Event, Models, Config
-from app.storage import Store
+from app.frequency import dominant_periods
+from app.outofcore import write_series, streaming_stats, MemmapWindowGenerator
+from app.compile import compile_and_fit, compile_model
+from app.parallel import run_folds, build_model, model_params, SharedFrame
+from app.search import TrialSearch, sample_trials
+from app.schema import Event, Models, Config, Search
+from app.storage import DataSource
+from app.backtest import realized, score, score_table
+from shared import tracing
+from shared.resample import fill
+from shared.series import TimeMatrix
 
 
 class ModelFlow:
@@ -19,80 +30,386 @@ class ModelFlow:
 
     MODELS = Models.MODELS
     
-    def __init__(self, event: dict):
-        """Initialize model variables and read data files based on date offset start and end."""
+    def __init__(self, event: dict, source: DataSource = None):
+        """Initialize model variables, data is read lazily from source when the stages need it."""
         e = Event(**event)
-        store = Store(models_path=e.paths.models, metrics_path=e.paths.metrics)
-        # get metrics data
-        metrics = store.load_local_files(path=e.paths.metrics, start=e.action.start, end=e.action.end)
-        metrics = sorted(metrics, key=lambda x: x["path"])
-        # get events data
-        events = store.load_local_files(path=e.paths.events, start=e.action.start, end=e.action.end)
-        events = sorted(events, key=lambda x: x["path"])
+        self.source = source
         # steps
         self.steps = e.steps
         self.model_name = e.model
-        self.is_predict = e.action.type == "predict"
+        self.is_predict = e.action.type in ("predict", "backtest")
+        self.pipeline = e.pipeline
+        self.workers = e.workers
+        self.frequencies = e.frequencies
+        self.out_of_core = e.out_of_core
+        self.search_options = e.search
+        # samples that were really fetched, set by process_metrics
+        self.valid: np.ndarray | None = None
+        # time of the last sample merged into the running statistics, set by training_stats and update
+        self.stats_until: str | None = None
 
-    def process_metrics(self, data: list[dict]):
-        """Compute dataframe from data"""
-        df = pd.concat([pd.DataFrame(d) for d in data])
-        df = clip_data(df)
-        return add_time_features(df)
-    
+    @tracing.traced()
+    def load_data(self, source: DataSource = None) -> pd.DataFrame:
+        """Metrics, events and time features from the lazily loaded days"""
+        source = self.source if source is None else source
+        if len(source.paths(source.store.metrics_path)) == 0:
+            raise ValueError("No data files in range")
+        return self.combine_data(self.process_metrics(source.series), self.process_events(source.events))
+
+    @tracing.traced()
+    def process_metrics(self, series: TimeMatrix):
+        """
+        Compute clipped metrics dataframe from the days of series, indexed by sample time.
+        Days are Config.SAMPLES_PER_DAY samples, days without a validity mask (written before
+        resampling) are trusted up to their length. Gaps are forward filled and flagged in self.valid.
+        """
+        values = series.values
+        filled = np.nan_to_num(fill(values, ~np.isnan(values), "ffill"), copy=False)
+        self.valid = series.valid.copy()
+        return clip_data(pd.DataFrame(filled, index=pd.DatetimeIndex(series.index), columns=list(series.labels), copy=False))
+
+    @tracing.traced()
     def process_events(self, data: list[dict]):
-        index_df = pd.DataFrame({"index": np.arange(0, Config.SAMPLES_PER_DAY, 1)})
-        # concatenate same-length data using index_df to fill empty events
-        df = pd.concat([index_df.join(pd.DataFrame(d).set_index('index'), on="index") if len(d.keys()) > 0 else index_df for d in data])
-        df = df.fillna(0).drop(columns=['index']).reset_index(drop=True)
-        # drop all columns that have only zeroes
-        df = df.loc[:, (df != 0).any(axis=0)]
+        """
+        Scatter the sparse daily events (an 'index' list of samples plus one list per event column)
+        into one preallocated float32 (days * samples, events) array.
+        Only error and warning columns are kept, all-zero columns are dropped.
+        """
+        columns = {}
+        rows, cols, values = [], [], []
+        for day, d in enumerate(data):
+            if len(d.keys()) == 0:
+                continue
+            index = np.asarray(d["index"], dtype=np.int64) + day * Config.SAMPLES_PER_DAY
+            for name, v in d.items():
+                if name.split("_")[0] not in ("error", "warning"):
+                    continue
+                rows.append(index)
+                cols.append(np.full(index.shape, columns.setdefault(name, len(columns))))
+                values.append(np.asarray(v, dtype=np.float32))
+        out = np.zeros((len(data) * Config.SAMPLES_PER_DAY, len(columns)), dtype=np.float32)
+        if columns:
+            # several events in one sample keep the largest value, as in the daily extraction
+            np.maximum.at(out, (np.concatenate(rows), np.concatenate(cols)), np.concatenate(values))
+        names = np.array(list(columns), dtype=object)
+        # errors first, then warnings, without columns that have only zeroes
+        order = [i for prefix in ("error", "warning") for i, c in enumerate(names) if c.split("_")[0] == prefix]
+        order = [i for i in order if out[:, i].any()]
         # convert to 'how long ago' the event happened in days
-        df = (df / (60 * 60 * 24))
-        # filter
-        # success = [c for c in df if c.split("_")[0] == "success"]
-        errors = [c for c in df if c.split("_")[0] == "error"]
-        warnings = [c for c in df if c.split("_")[0] == "warning"]
-        return df[[*errors, *warnings]]
+        out = out[:, order] / np.float32(60 * 60 * 24)
+        return pd.DataFrame(out, columns=names[order].tolist())
 
-    def combine_data(self, metrics: pd.DataFrame, events: pd.DataFrame):
-        """Combine metrics and events data"""
-        df = metrics.join(events)
-        df_frame = df.iloc[0:0]
-        return add_time_features(df)
+    @tracing.traced()
+    def combine_data(self, metrics: pd.DataFrame, events: pd.DataFrame = None):
+        """Combine metrics and events data and add time features"""
+        df = metrics
+        if events is not None and events.shape[1] > 0:
+            # events always cover whole days, align them to the metric samples by position
+            events = events.reindex(range(metrics.shape[0]), fill_value=0).set_axis(metrics.index)
+            df = metrics.join(events)
+        if self.frequencies == "auto":
+            # spectrum of the first fold's train rows, the ones before every validation and test split
+            train, _, _ = next(generate_sliding_window(population_size=metrics.shape[0]))
+            self.frequencies = dominant_periods(metrics.iloc[train])
+            print("Frequencies:", self.frequencies)
+        return add_time_features(df, self.frequencies)
 
+    def make_tasks(self, data, population_size: int, model_name: str, params: dict = None):
+        """One task per sliding window fold, only the last fold keeps its weights."""
+        folds = list(generate_sliding_window(population_size=population_size))
+        return [
+            {
+                "fold": i,
+                "model_name": model_name,
+                "params": params or {},
+                "steps": self.steps,
+                "pipeline": self.pipeline.dict(),
+                "data": data,
+                "train": train,
+                "val": val,
+                "test": test,
+                "keep_weights": i == len(folds) - 1,
+                "valid": self.valid if self.valid is not None and len(self.valid) == population_size else None,
+            }
+            for i, (train, val, test) in enumerate(folds)
+        ]
 
+    @tracing.traced()
     def fit(self, df: pd.DataFrame):
-        """Fit the model."""
+        """Fit a fresh model per fold, folds run in parallel when workers > 1."""
+        with SharedFrame(df) if self.workers > 1 else nullcontext(df) as data:
+            tasks = self.make_tasks(data, df.shape[0], self.model_name)
+            print(f"Fitting model on {len(tasks)} folds with {self.workers} workers...")
+            results = run_folds(tasks, workers=self.workers)
+        # the last fold has the most recent training data
+        last = results[-1]
+        model = build_model(self.model_name, df.shape[1], self.steps, last["weights"])
+        perf = pd.DataFrame([r["perf"] for r in results], index=[r["fold"] for r in results])
+        return model, last["std"], last["mean"], perf
+
+    @tracing.traced()
+    def fit_out_of_core(self, source: DataSource, path: str):
+        """
+        Fit like `fit` from a memory mapped copy of the series, for histories that don't fit in memory.
+        Returns model, the running statistics of the last fold's train rows and perf.
+        """
+        frequencies = None if self.frequencies == "auto" else self.frequencies
+        if self.frequencies == "auto":
+            print("Frequencies 'auto' needs the full series in memory, using Config.FREQUENCIES")
+        series, columns = write_series(source, path, frequencies)
         perf = []
-        model = self.MODELS[self.model_name](df.shape[1], self.steps, self.model_name)
-        print("Fitting model...")
-        for train, val, test in generate_sliding_window(population_size=df.shape[0]):
-            train_df, val_df, test_df, std, mean = normalize_training_data(
-                df.iloc[train], df.iloc[val], df.iloc[test]
-            )
-            window = WindowGenerator(
-                train_df,
-                val_df,
-                test_df,
+        print("Fitting model out of core...")
+        for i, (train, val, test) in enumerate(generate_sliding_window(population_size=series.shape[0])):
+            train, val, test = [slice(int(r[0]), int(r[-1]) + 1) for r in (train, val, test)]
+            stats = streaming_stats(series, train, columns)
+            model = build_model(self.model_name, series.shape[1], self.steps)
+            window = MemmapWindowGenerator(
+                series,
+                columns,
+                train,
+                val,
+                test,
+                stats.mean,
+                stats.std,
                 input_width=self.steps,
                 label_width=self.steps,
                 shift=self.steps,
+                pipeline=self.pipeline,
             )
-            compile_and_fit(model, window, patience=4, max_epocs=40)
+            compile_and_fit(model, window, patience=4, max_epocs=40, profile=self.pipeline.profile)
             perf.append(
                 {
                     "val": model.evaluate(window.val, verbose=0)[1],
                     "test": model.evaluate(window.test, verbose=0)[1],
                 }
             )
-        return model, std, mean, pd.DataFrame(perf)
+        # timestamp of the last train row, days are Config.SAMPLES_PER_DAY rows in path order
+        day, sample = divmod(train.stop - 1, Config.SAMPLES_PER_DAY)
+        last = source.store.path_date(source.paths(source.store.metrics_path)[day])
+        self.stats_until = str(pd.Timestamp(last) + pd.Timedelta(minutes=sample * Config.MINUTES_PER_SAMPLE))
+        return model, stats, pd.DataFrame(perf)
+
+    def metadata(self, source: DataSource, perf: pd.DataFrame, **extra) -> dict:
+        """Registry metadata of a model trained by this flow on source"""
+        paths = source.paths(source.store.metrics_path)
+        return {
+            "steps": self.steps,
+            "params": model_params(self.model_name),
+            "frequencies": Config.FREQUENCIES if self.frequencies in (None, "auto") else self.frequencies,
+            "training_range": [str(source.store.path_date(paths[0]).date()), str(source.store.path_date(paths[-1]).date())],
+            "metrics": perf.mean().to_dict(),
+            **({} if self.stats_until is None else {"stats_until": self.stats_until}),
+            **extra,
+        }
+
+    def training_stats(self, df: pd.DataFrame) -> RunningStats:
+        """Running statistics of the rows the fitted (last fold) model was normalized with."""
+        *_, (train, _, _) = generate_sliding_window(population_size=df.shape[0])
+        self.stats_until = str(df.index[train[-1]])
+        return RunningStats.from_frame(df.iloc[train])
+
+    def update_days(self, since: str) -> int:
+        """Days of data `update` needs, the samples after since plus the train and validation history before them."""
+        width = 2 * self.steps
+        new_samples = (pd.Timestamp.now() - pd.Timestamp(since)) // pd.Timedelta(minutes=Config.MINUTES_PER_SAMPLE)
+        return -(-(max(new_samples, width) + 2 * width) // Config.SAMPLES_PER_DAY) + 1
+
+    @tracing.traced()
+    def update(self, df: pd.DataFrame, model: Model, stats: RunningStats, since: str = None):
+        """
+        Fine-tune a trained model on the samples of df after since, the last sample merged into stats
+        (the newest day for artifacts saved without it). Only those samples are merged into stats.
+        The last steps samples are held out as the test horizon, no train window has them as labels.
+        Train windows cover the new samples up to it, validation windows are the history before them.
+        Returns model, updated stats, perf and whether validation loss stayed within tolerance.
+        """
+        if stats is None:
+            raise ValueError("The model was saved without running statistics and can't be updated, fit it again")
+        df = df.reindex(columns=stats.columns, fill_value=0)
+        if since is None:
+            new_samples = min(Config.SAMPLES_PER_DAY, df.shape[0])
+        else:
+            if pd.Timestamp(since) < df.index[0]:
+                print(f"Samples from {since} to {df.index[0]} are older than the update range and not merged")
+            new_samples = int((df.index > pd.Timestamp(since)).sum())
+            if new_samples == 0:
+                raise ValueError(f"No samples after {since}, the model is up to date")
+        width, held_out = 2 * self.steps, self.steps
+        span = max(new_samples, width)
+        if df.shape[0] < span + 2 * width:
+            raise ValueError(f"Need at least {span + 2 * width} samples to update, got {df.shape[0]}")
+        stats.update(df.iloc[-new_samples:])
+        self.stats_until = str(df.index[-1])
+        norm = (df - stats.mean) / stats.std
+        train = slice(-(span + width), -held_out)
+        val = slice(-(span + 2 * width), -(span + width - held_out))
+        test = slice(-width, None)
+        valid = self.valid if self.valid is not None and len(self.valid) == df.shape[0] else None
+        window = WindowGenerator(
+            norm.iloc[train],
+            norm.iloc[val],
+            norm.iloc[test],
+            input_width=self.steps,
+            label_width=self.steps,
+            shift=self.steps,
+            pipeline=self.pipeline,
+            valid=None if valid is None else {"train": valid[train], "val": valid[val], "test": valid[test]},
+        )
+        before = compile_model(model).evaluate(window.val, verbose=0)[0]
+        compile_and_fit(model, window, patience=2, max_epocs=5, profile=self.pipeline.profile)
+        after = model.evaluate(window.val, verbose=0)[0]
+        perf = pd.DataFrame([{"val_before": before, "val_after": after, "test": model.evaluate(window.test, verbose=0)[1]}])
+        return model, stats, perf, after <= before * (1 + Config.UPDATE_TOLERANCE)
 
+    @tracing.traced()
+    def sweep(self, df: pd.DataFrame, variants: dict[str, list[dict]] = None):
+        """Train every model variant over the same folds, preprocessed once and shared between workers."""
+        variants = Models.SWEEP if variants is None else variants
+        with SharedFrame(df) as data:
+            tasks = [
+                task
+                for model_name in self.MODELS
+                for params in variants.get(model_name, [{}])
+                for task in self.make_tasks(data, df.shape[0], model_name, params)
+            ]
+            print(f"Sweeping {len(tasks)} fold tasks with {self.workers} workers...")
+            results = run_folds(tasks, workers=self.workers, fresh_workers=True)
+        rows = pd.DataFrame(
+            [
+                {
+                    "model": r["model_name"],
+                    "params": json.dumps(r["params"], sort_keys=True),
+                    "fold": r["fold"],
+                    **r["perf"],
+                    "seconds": r["seconds"],
+                    "peak_rss_mb": r["peak_rss_mb"],
+                }
+                for r in results
+            ]
+        )
+        return (
+            rows.groupby(["model", "params"])
+            .agg(
+                val=("val", "mean"),
+                test=("test", "mean"),
+                seconds=("seconds", "sum"),
+                peak_rss_mb=("peak_rss_mb", "max"),
+                folds=("fold", "count"),
+            )
+            .sort_values("val")
+            .reset_index()
+        )
+
+    @tracing.traced()
+    def search(self, df: pd.DataFrame, search: Search = None, models: dict[str, dict[str, list]] = None):
+        """
+        Search model hyperparameters and input widths on the last fold, the one `fit` keeps.
+        Returns every trial, completed ones ranked by val MAE with the accuracy vs latency Pareto front marked.
+        """
+        search = self.search_options if search is None else search
+        *_, (train, val, test) = generate_sliding_window(population_size=df.shape[0])
+        valid = self.valid if self.valid is not None and len(self.valid) == df.shape[0] else None
+        trials = sample_trials(search, {name: space for name, space in (models or Models.SEARCH).items() if name in self.MODELS})
+        leaderboard = TrialSearch(search, self.steps, self.pipeline, self.workers).run(
+            df, {"train": train, "val": val, "test": test, "valid": valid}, trials
+        )
+        epochs = leaderboard["epochs"].sum()
+        print(f"Trained {epochs} of {len(trials) * search.max_epochs} epochs a full search would ({epochs / (len(trials) * search.max_epochs):.0%})")
+        return leaderboard
+
+    @tracing.traced()
     def predict(
         self, df: pd.DataFrame, model: Model, std: np.ndarray, mean: np.ndarray
     ):
         """Predict using the model."""
-        y_pred = model.predict(get_predict_window_dataset((df - mean) / std))
+        df = df.reindex(columns=mean.index, fill_value=0)
+        y_pred = model.predict(
+            get_predict_window_dataset((df - mean) / std, batch_size=self.pipeline.batch_size)
+        )
         Y = y_pred[0, :, 0:6] * std[0:6].values + mean[0:6].values
         Y = clip_data(Y)
         return pd.DataFrame(Y, columns=df.columns[0:6])
+
+    @tracing.traced()
+    def predict_batch(
+        self,
+        df: pd.DataFrame,
+        model: Model,
+        std: pd.Series,
+        mean: pd.Series,
+        origins: np.ndarray | pd.DatetimeIndex,
+        labels: int = 6,
+    ) -> pd.DataFrame:
+        """
+        Forecast many origins with one forward pass.
+        An origin is the first forecast sample: a position in df or, for a DatetimeIndex, a timestamp
+        (rounded up to the next sample, so the sample right after the data is a valid origin).
+        Returns a tidy frame of origin, horizon (samples ahead, from 1), label and value.
+        """
+        df = df.reindex(columns=mean.index, fill_value=0)
+        positions = (
+            df.index.searchsorted(origins)
+            if isinstance(df.index, pd.DatetimeIndex)
+            else np.asarray(origins, dtype=int)
+        )
+        if np.any(positions < self.steps) or np.any(positions > df.shape[0]):
+            raise ValueError(f"Origins need {self.steps} samples of history inside the data")
+        values = ((df - mean) / std).to_numpy(dtype=np.float32)
+        # (windows, features, steps) strided view, no copy until the origins are gathered
+        windows = np.lib.stride_tricks.sliding_window_view(values, self.steps, axis=0)
+        X = windows[positions - self.steps].transpose(0, 2, 1)
+        t0 = perf_counter()
+        y_pred = model.predict(X, batch_size=self.pipeline.batch_size, verbose=0)
+        elapsed = perf_counter() - t0
+        print(f"Predicted {len(positions)} windows in {elapsed:.3f}s ({len(positions) / max(elapsed, 1e-9):.1f} windows/s)")
+        Y = y_pred[:, :, 0:labels] * std[0:labels].values + mean[0:labels].values
+        Y = clip_data(Y)
+        n, steps, _ = Y.shape
+        origin_values = (
+            df.index[positions - 1] + pd.Timedelta(minutes=Config.MINUTES_PER_SAMPLE)
+            if isinstance(df.index, pd.DatetimeIndex)
+            else positions
+        )
+        return pd.DataFrame(
+            {
+                "origin": np.repeat(origin_values, steps * labels),
+                "horizon": np.tile(np.repeat(np.arange(1, steps + 1), labels), n),
+                "label": np.tile(df.columns[0:labels], n * steps),
+                "value": Y.reshape(-1),
+            }
+        )
+
+    @tracing.traced()
+    def backtest(
+        self,
+        df: pd.DataFrame,
+        model: Model,
+        std: pd.Series,
+        mean: pd.Series,
+        origins: int,
+        labels: int = 6,
+        after: pd.Timestamp = None,
+    ) -> pd.DataFrame:
+        """
+        Score forecasts of the last `origins` origins that are followed by a full horizon of data,
+        one forward pass for all of them. Returns one row per label and horizon.
+        Origins before `after`, the end of the model's training range, are in-sample and skipped.
+        """
+        available = df.shape[0] - 2 * self.steps + 1
+        if available < 1:
+            raise ValueError(f"Backtests need at least {2 * self.steps} samples")
+        df = df.reindex(columns=mean.index, fill_value=0)
+        positions = np.arange(df.shape[0] - self.steps - min(origins, available) + 1, df.shape[0] - self.steps + 1)
+        if after is not None and isinstance(df.index, pd.DatetimeIndex):
+            out_of_sample = df.index[positions] >= after
+            if not out_of_sample.any():
+                raise ValueError(f"No origin with a full horizon after the training range, which ends at {after}")
+            if not out_of_sample.all():
+                print(f"Skipping {(~out_of_sample).sum()} origins inside the training range")
+            positions = positions[out_of_sample]
+        forecasts = self.predict_batch(
+            df, model, std, mean, df.index[positions] if isinstance(df.index, pd.DatetimeIndex) else positions, labels
+        )
+        forecast = forecasts["value"].to_numpy().reshape(len(positions), self.steps, labels)
+        actual = realized(df.iloc[:, 0:labels].to_numpy(dtype=np.float32), positions, self.steps)
+        return score_table(score(forecast, actual), df.columns[0:labels].tolist())
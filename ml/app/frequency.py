@@ -0,0 +1,68 @@
+"""
+Frequency analysis for time feature selection.
+"""
+import pandas as pd
+import numpy as np
+
+from app.schema import Config
+
+
+def welch_spectrum(
+    df: pd.DataFrame,
+    segment: int = Config.SAMPLES_PER_DAY * Config.DAYS_PER_CYCLE * 2,
+    batch: int = 64,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Welch averaged power spectrum over all columns.
+    Hann windowed segments with 50% overlap are transformed `batch` at a time with one rfft each,
+    every column is normalized to unit power so no metric dominates the average.
+    Returns periods in hours and the averaged power, DC excluded.
+    """
+    values = np.asarray(df, dtype=np.float32)
+    segment = min(segment, values.shape[0])
+    step = max(segment // 2, 1)
+    starts = np.arange(0, values.shape[0] - segment + 1, step)
+    window = np.hanning(segment).astype(np.float32)[None, :, None]
+    windows = np.lib.stride_tricks.sliding_window_view(values, segment, axis=0)
+    power = np.zeros((segment // 2 + 1, values.shape[1]))
+    for i in range(0, len(starts), batch):
+        # (segments, samples, columns)
+        chunk = windows[starts[i : i + batch]].transpose(0, 2, 1)
+        chunk = (chunk - chunk.mean(axis=1, keepdims=True)) * window
+        power += (np.abs(np.fft.rfft(chunk, axis=1)) ** 2).sum(axis=0)
+    total = power[1:].sum(axis=0)
+    power = (power[1:] / np.where(total > 0, total, 1)).mean(axis=1)
+    periods = segment * Config.MINUTES_PER_SAMPLE / 60 / np.arange(1, segment // 2 + 1)
+    return periods, power
+
+
+def cycle_periods(min_hours: int = 1) -> np.ndarray:
+    """Periods in hours that divide the time feature cycle, so features stay continuous across cycles"""
+    hours = Config.DAYS_PER_CYCLE * 24
+    return np.array([h for h in range(min_hours, hours + 1) if hours % h == 0])
+
+
+def dominant_periods(df: pd.DataFrame, top_k: int = len(Config.FREQUENCIES), **kwargs) -> list[int]:
+    """Top-k spectral peaks snapped to cycle periods, strongest first, for add_time_features"""
+    periods, power = welch_spectrum(df, **kwargs)
+    # local maxima only, so one wide peak doesn't take several slots
+    padded = np.concatenate([[-np.inf], power, [-np.inf]])
+    peaks = np.flatnonzero((power >= padded[:-2]) & (power >= padded[2:]))
+    candidates = cycle_periods()
+    selected = []
+    for i in peaks[np.argsort(power[peaks])[::-1]]:
+        if periods[i] < candidates[0] / 2:
+            continue
+        # nearest in log scale, periods are ratios
+        hours = int(candidates[np.abs(np.log(candidates / periods[i])).argmin()])
+        if hours not in selected:
+            selected.append(hours)
+        if len(selected) == top_k:
+            break
+    return selected
+
+
+def frequencies_from_columns(columns: list[str]) -> list[int | float]:
+    """Recover the frequencies of a trained model from its '{hours}_hours_sin' feature columns"""
+    hours = [c[: -len("_hours_sin")] for c in columns if c.endswith("_hours_sin")]
+    return [int(h) if float(h).is_integer() else float(h) for h in hours]
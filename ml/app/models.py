@@ -3,7 +3,7 @@ from typing import TypeAlias, Callable
 
 
 Model: TypeAlias = tf.keras.Sequential
-ModelGetter: TypeAlias = Callable[[int, int, str], Model]
+ModelGetter: TypeAlias = Callable[..., Model]
 
 
 def load_model(filepath: str):
@@ -24,11 +24,11 @@ def get_repeatbaseline_model(*args):
 
 
 
-def get_multidense_model(num_features: int, out_steps=24, name: str = "dense"):
+def get_multidense_model(num_features: int, out_steps=24, name: str = "dense", units: int = 512):
     multi_dense_model = tf.keras.Sequential(
         [
             tf.keras.layers.Lambda(lambda x: x[:, -1:, :]),
-            tf.keras.layers.Dense(512, activation="swish"),
+            tf.keras.layers.Dense(units, activation="swish"),
             tf.keras.layers.Dense(
                 out_steps * num_features, kernel_initializer=tf.initializers.zeros()
             ),
@@ -39,12 +39,13 @@ def get_multidense_model(num_features: int, out_steps=24, name: str = "dense"):
     return multi_dense_model
 
 
-def get_convolution_model(num_features: int, outsteps=24, name: str = "cnn"):
-    conv_width = 3
+def get_convolution_model(
+    num_features: int, outsteps=24, name: str = "cnn", filters: int = 256, conv_width: int = 3
+):
     multi_conv_model = tf.keras.Sequential(
         [
             tf.keras.layers.Lambda(lambda x: x[:, -conv_width:, :]),
-            tf.keras.layers.Conv1D(256, activation="relu", kernel_size=(conv_width)),
+            tf.keras.layers.Conv1D(filters, activation="relu", kernel_size=(conv_width)),
             tf.keras.layers.Dense(
                 outsteps * num_features, kernel_initializer=tf.initializers.zeros()
             ),
@@ -55,10 +56,10 @@ def get_convolution_model(num_features: int, outsteps=24, name: str = "cnn"):
     return multi_conv_model
 
 
-def get_lstm_model(num_features: int, outsteps=24, name: str = "lstm"):
+def get_lstm_model(num_features: int, outsteps=24, name: str = "lstm", units: int = 32):
     lstm_model = tf.keras.Sequential(
         [
-            tf.keras.layers.LSTM(32, return_sequences=False),
+            tf.keras.layers.LSTM(units, return_sequences=False),
             tf.keras.layers.Dense(
                 outsteps * num_features, kernel_initializer=tf.initializers.zeros()
             ),
@@ -0,0 +1,167 @@
+"""
+Out-of-core training over long histories.
+
+The preprocessed series is written once, day by day, to a float32 `.npy` memory map. Normalization
+statistics are computed in a streaming pass and training windows are gathered batch by batch from
+the memory map, so peak memory doesn't grow with the length of the history.
+"""
+from pathlib import Path
+import tensorflow as tf
+import pandas as pd
+import numpy as np
+
+from app.preprocessing import add_time_features, clip_data, RunningStats
+from app.schema import Config, Pipeline
+from app.storage import DataSource
+from app.window import WindowGenerator
+from shared.resample import fill
+from shared.series import TimeMatrix
+
+
+def event_days(source: DataSource) -> tuple[dict, list[str]]:
+    """
+    Events days of the metrics days by date, each file read once, and their error and warning columns
+    that have a positive value, errors first, like ModelFlow.process_events. Events days are sparse,
+    only the sampled events are kept in memory.
+    """
+    dates = {source.store.path_date(p) for p in source.paths(source.store.metrics_path)}
+    days, positive = {}, {}
+    for path in source.paths(source.store.events_path):
+        date = source.store.path_date(path)
+        if date not in dates:
+            continue
+        days[date] = source.peek(path)
+        for name, values in days[date].items():
+            if name.split("_")[0] in ("error", "warning"):
+                positive[name] = positive.get(name, False) or bool((np.asarray(values, dtype=np.float32) > 0).any())
+    return days, [c for prefix in ("error", "warning") for c in positive if c.split("_")[0] == prefix and positive[c]]
+
+
+def day_block(metrics: TimeMatrix, events: dict, metric_names: list[str], event_names: list[str]) -> np.ndarray:
+    """(samples per day, metrics + events) float32 block of one day, clipped and scaled like ModelFlow"""
+    n = Config.SAMPLES_PER_DAY
+    block = np.zeros((n, len(metric_names) + len(event_names)), dtype=np.float32)
+    values = metrics.select(metric_names)
+    # gaps of resampled days are NaN, forward filled within the day like ModelFlow.process_metrics
+    block[:, : len(metric_names)] = clip_data(np.nan_to_num(fill(values, ~np.isnan(values), "ffill")))
+    if events:
+        index = np.asarray(events["index"], dtype=np.int64)
+        for j, name in enumerate(event_names, start=len(metric_names)):
+            if name in events:
+                np.maximum.at(block[:, j], index, np.asarray(events[name], dtype=np.float32))
+        block[:, len(metric_names) :] /= np.float32(60 * 60 * 24)
+    return block
+
+
+def write_series(source: DataSource, path: str | Path, frequencies: list = None):
+    """Stream every day of the source into a float32 memory map. Returns the memory map and its columns."""
+    paths = source.paths(source.store.metrics_path)
+    if len(paths) == 0:
+        raise ValueError("No data files in range")
+    events, event_names = event_days(source)
+    first = source.peek_day(paths[0])
+    metric_names = list(first.labels)
+    n = Config.SAMPLES_PER_DAY
+    time_names = add_time_features(pd.DataFrame(index=range(1)), frequencies).columns.tolist()
+    columns = metric_names + event_names + time_names
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    series = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=(len(paths) * n, len(columns))
+    )
+    for day, p in enumerate(paths):
+        metrics = first if day == 0 else source.peek_day(p)
+        time_df = add_time_features(pd.DataFrame(index=range(n)), frequencies, offset=day * n)
+        series[day * n : (day + 1) * n] = np.hstack(
+            [
+                day_block(metrics, events.get(source.store.path_date(p), {}), metric_names, event_names),
+                time_df.to_numpy(np.float32),
+            ]
+        )
+    series.flush()
+    return series, columns
+
+
+def streaming_stats(series: np.ndarray, rows: slice, columns: list[str], chunk: int = Config.SAMPLES_PER_DAY * 7) -> RunningStats:
+    """Normalization statistics of a row range, one chunk in memory at a time"""
+    stats = RunningStats(columns)
+    for i in range(rows.start, rows.stop, chunk):
+        stats.update(pd.DataFrame(series[i : min(i + chunk, rows.stop)], columns=columns))
+    return stats
+
+
+class MemmapWindowGenerator(WindowGenerator):
+    """
+    WindowGenerator over row ranges of a memory mapped series, windows are normalized per batch.
+    Train windows are gathered in a new random order every epoch, or in order through a shuffle buffer
+    when Pipeline.shuffle_buffer is set. They are never cached, a cache would hold the whole history,
+    Pipeline.cache applies to the validation and test windows that are read every epoch.
+    """
+
+    def __init__(
+        self,
+        series: np.ndarray,
+        columns: list[str],
+        train: slice,
+        val: slice,
+        test: slice,
+        mean: pd.Series,
+        std: pd.Series,
+        input_width: int,
+        label_width: int,
+        shift: int,
+        pipeline: Pipeline = None,
+        seed: int = None,
+    ):
+        super().__init__(None, None, None, input_width, label_width, shift, pipeline=pipeline)
+        self.series = series
+        self.column_indices = {name: i for i, name in enumerate(columns)}
+        self.rows = {"train": train, "val": val, "test": test}
+        self.mean = mean.to_numpy(np.float32)
+        self.std = std.to_numpy(np.float32)
+        self.rng = np.random.default_rng(seed)
+
+    def normalize_split(self, windows):
+        return self.split_window((windows - self.mean) / self.std)
+
+    def make_dataset(self, rows: slice, name: str = "train", shuffle=True):
+        p = self.pipeline
+        starts = np.arange(rows.start, rows.stop - self.total_window_size + 1)
+        offsets = np.arange(self.total_window_size)
+        permute = shuffle and p.shuffle_buffer is None
+
+        def batches():
+            order = self.rng.permutation(starts) if permute else starts
+            for i in range(0, len(order), p.batch_size):
+                # gathers only this batch of windows from the memory map
+                yield self.series[order[i : i + p.batch_size, None] + offsets]
+
+        ds = tf.data.Dataset.from_generator(
+            batches,
+            output_signature=tf.TensorSpec(
+                shape=(None, self.total_window_size, self.series.shape[1]), dtype=tf.float32
+            ),
+        )
+        if not shuffle and p.cache is not False:
+            ds = ds.cache() if p.cache is True else ds.cache(f"{p.cache}/{self.cache_id}_{name}")
+        if shuffle and p.shuffle_buffer is not None:
+            ds = ds.unbatch().shuffle(p.shuffle_buffer, reshuffle_each_iteration=True).batch(p.batch_size)
+        ds = ds.map(
+            self.normalize_split,
+            num_parallel_calls=p.parallel_calls if p.parallel_calls != 0 else None,
+            deterministic=p.deterministic,
+        )
+        if p.prefetch != 0:
+            ds = ds.prefetch(p.prefetch)
+        return ds
+
+    @property
+    def train(self):
+        return self.make_dataset(self.rows["train"], "train")
+
+    @property
+    def val(self):
+        return self.make_dataset(self.rows["val"], "val", shuffle=False)
+
+    @property
+    def test(self):
+        return self.make_dataset(self.rows["test"], "test", shuffle=False)
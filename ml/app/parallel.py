@@ -0,0 +1,212 @@
+"""
+Process pool scheduling for independent training jobs.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from time import perf_counter
+from typing import TypedDict
+import multiprocessing as mp
+import inspect
+import pandas as pd
+import numpy as np
+import resource
+import os
+
+import tensorflow as tf
+
+from app.compile import compile_and_fit
+from app.preprocessing import normalize_training_data
+from app.schema import Models, Pipeline
+from app.window import WindowGenerator
+
+
+class SharedFrame:
+    """Float32 DataFrame values in shared memory, workers attach by name instead of unpickling copies."""
+
+    def __init__(self, df: pd.DataFrame):
+        values = np.ascontiguousarray(df.values, dtype=np.float32)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=np.float32, buffer=self.shm.buf)[:] = values
+        self.name = self.shm.name
+        self.shape = values.shape
+        self.columns = list(df.columns)
+        self.owner = True
+
+    def __getstate__(self):
+        return {"name": self.name, "shape": self.shape, "columns": self.columns}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = None
+        self.owner = False
+
+    def frame(self) -> pd.DataFrame:
+        """Zero-copy DataFrame view over the shared block."""
+        if self.shm is None:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+        values = np.ndarray(self.shape, dtype=np.float32, buffer=self.shm.buf)
+        return pd.DataFrame(values, columns=self.columns, copy=False)
+
+    def detach(self):
+        """Drop a worker's attachment once its rows are copied out, the owner keeps the block until close."""
+        if not self.owner:
+            self.close()
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FoldTask(TypedDict):
+    fold: int
+    model_name: str
+    params: dict
+    steps: int
+    pipeline: dict
+    data: pd.DataFrame | SharedFrame
+    train: np.ndarray
+    val: np.ndarray
+    test: np.ndarray
+    keep_weights: bool
+    valid: np.ndarray | None  # per row validity, windows over invalid rows are skipped
+
+
+def threads_per_worker(workers: int) -> int:
+    """Split the available cores between workers so they don't oversubscribe."""
+    return max((os.cpu_count() or 1) // max(workers, 1), 1)
+
+
+def init_worker(threads: int):
+    """Pin TF thread pools before the runtime is initialized in the worker."""
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1 if threads < 4 else 2)
+
+
+def cpu_sets(workers: int) -> list[set[int]]:
+    """Split the cores this process may run on into one set per worker, shared round robin when there are fewer cores."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    if len(cores) < workers:
+        return [{cores[i % len(cores)]} for i in range(workers)]
+    size = len(cores) // workers
+    return [set(cores[i * size : (i + 1) * size]) for i in range(workers)]
+
+
+def pin_worker(cores, threads: int):
+    """Bind the worker to the next core set of the queue so workers don't migrate onto each other's cores."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores.get())
+    init_worker(threads)
+
+
+def worker_pool(workers: int, fresh_workers: bool = False, pin: bool = False) -> ProcessPoolExecutor:
+    """
+    Spawned process pool with TF thread pools sized per worker.
+    pin binds each worker to its own cores, only for long lived workers: a replaced worker would find no core set left.
+    """
+    if pin and fresh_workers:
+        raise ValueError("Pinned workers can't be replaced after every task")
+    context = mp.get_context("spawn")
+    threads = threads_per_worker(workers)
+    initializer, initargs = init_worker, (threads,)
+    if pin:
+        cores = context.Queue()
+        for cores_set in cpu_sets(workers):
+            cores.put(cores_set)
+        initializer, initargs = pin_worker, (cores, threads)
+    # fork is not safe once TF has been initialized in the parent
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=initializer,
+        initargs=initargs,
+        max_tasks_per_child=1 if fresh_workers else None,
+    )
+
+
+def build_model(
+    model_name: str, num_features: int, steps: int, weights: list = None, params: dict = None
+):
+    """Build a fresh model and optionally load weights from another process."""
+    model = Models.MODELS[model_name](num_features, steps, model_name, **(params or {}))
+    if weights is not None:
+        model(np.zeros((1, steps, num_features), dtype=np.float32))
+        model.set_weights(weights)
+    return model
+
+
+def model_params(model_name: str, params: dict = None) -> dict:
+    """Factory keyword arguments of a model with the defaults filled in, as recorded in the registry."""
+    factory = inspect.signature(Models.MODELS[model_name]).parameters
+    # the first three are the number of features, the steps and the name
+    defaults = {k: p.default for k, p in list(factory.items())[3:] if p.default is not inspect.Parameter.empty}
+    return {**defaults, **(params or {})}
+
+
+def task_splits(task: FoldTask) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Train, val and test rows of a task as float32 copies, the dtype of shared frames, so in process
+    and pooled runs train on the same values. Shared memory is detached once the rows are copied.
+    """
+    data = task["data"]
+    df = data.frame() if isinstance(data, SharedFrame) else data
+    splits = tuple(df.iloc[task[name]].astype(np.float32) for name in ("train", "val", "test"))
+    del df
+    if isinstance(data, SharedFrame):
+        data.detach()
+    return splits
+
+
+def fit_fold(task: FoldTask) -> dict:
+    """Normalize and train one fold on a freshly built model."""
+    t0 = perf_counter()
+    train_df, val_df, test_df, std, mean = normalize_training_data(*task_splits(task))
+    steps = task["steps"]
+    model = build_model(task["model_name"], train_df.shape[1], steps, params=task["params"])
+    valid = task.get("valid")
+    window = WindowGenerator(
+        train_df,
+        val_df,
+        test_df,
+        input_width=steps,
+        label_width=steps,
+        shift=steps,
+        pipeline=Pipeline(**task["pipeline"]),
+        valid=None if valid is None else {name: valid[task[name]] for name in ("train", "val", "test")},
+    )
+    compile_and_fit(model, window, patience=4, max_epocs=40, profile=window.pipeline.profile)
+    perf = {
+        "val": model.evaluate(window.val, verbose=0)[1],
+        "test": model.evaluate(window.test, verbose=0)[1],
+    }
+    return {
+        "fold": task["fold"],
+        "model_name": task["model_name"],
+        "params": task["params"],
+        "perf": perf,
+        "seconds": perf_counter() - t0,
+        # ru_maxrss is in KiB on linux, the peak of the process so per task only in fresh workers
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "weights": model.get_weights() if task["keep_weights"] else None,
+        "std": std,
+        "mean": mean,
+    }
+
+
+def run_folds(tasks: list[FoldTask], workers: int = 1, fresh_workers: bool = False) -> list[dict]:
+    """
+    Run fold tasks in a spawned process pool, results keep the order of tasks.
+    With fresh_workers each task gets its own process so peak memory is per task, even with one worker.
+    """
+    if workers <= 1 and not fresh_workers:
+        return [fit_fold(task) for task in tasks]
+    with worker_pool(max(workers, 1), fresh_workers) as pool:
+        return list(pool.map(fit_fold, tasks))
@@ -5,12 +5,12 @@ import numpy as np
 from app.schema import Config
 
 
-def add_time_features(df: pd.DataFrame, frequencies: list = None):
-    """Add time features to dataframe"""
-    time_cycle = df.reset_index().index // (
+def add_time_features(df: pd.DataFrame, frequencies: list = None, offset: int = 0):
+    """Add time features to dataframe, offset is the sample position of the first row"""
+    time_cycle = (df.reset_index().index + offset) // (
         Config.SAMPLES_PER_DAY * Config.DAYS_PER_CYCLE
     )
-    time_minutes = df.reset_index().index * Config.MINUTES_PER_SAMPLE
+    time_minutes = (df.reset_index().index + offset) * Config.MINUTES_PER_SAMPLE
     time_minutes_cycle = time_minutes - (time_cycle * Config.DAYS_PER_CYCLE * 24 * 60)
     time_seconds = time_minutes_cycle * 60
     # add
@@ -34,7 +34,7 @@ def clip_data(
     return (
         clipped
         if isinstance(data, np.ndarray)
-        else pd.DataFrame(clipped, columns=data.columns)
+        else pd.DataFrame(clipped, columns=data.columns, index=data.index)
     )
 
 
@@ -58,6 +58,45 @@ def normalize_training_data(train_df, val_df, test_df):
     return train_df, val_df, test_df, std, mean
 
 
+class RunningStats:
+    """Streaming mean and variance per column (Welford / Chan batch update)."""
+
+    def __init__(self, columns: list[str], count: int = 0, mean: np.ndarray = None, m2: np.ndarray = None):
+        self.columns = list(columns)
+        self.count = count
+        self.m = np.zeros(len(self.columns)) if mean is None else np.asarray(mean, dtype=np.float64)
+        self.m2 = np.zeros(len(self.columns)) if m2 is None else np.asarray(m2, dtype=np.float64)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame):
+        return cls(df.columns).update(df)
+
+    def update(self, df: pd.DataFrame):
+        """Merge the moments of a new batch of rows."""
+        x = np.asarray(df[self.columns], dtype=np.float64)
+        n = x.shape[0]
+        if n == 0:
+            return self
+        batch_mean = x.mean(axis=0)
+        batch_m2 = ((x - batch_mean) ** 2).sum(axis=0)
+        total = self.count + n
+        delta = batch_mean - self.m
+        self.m = self.m + delta * (n / total)
+        self.m2 = self.m2 + batch_m2 + delta**2 * (self.count * n / total)
+        self.count = total
+        return self
+
+    @property
+    def mean(self) -> pd.Series:
+        return pd.Series(self.m, index=self.columns)
+
+    @property
+    def std(self) -> pd.Series:
+        """Sample standard deviation, same as DataFrame.std, zeros replaced by one."""
+        var = self.m2 / max(self.count - 1, 1)
+        return pd.Series(np.sqrt(var), index=self.columns).replace(0, 1)
+
+
 def generate_sliding_window(
     population_size: int, sample_size=96, cycles=3, step_size=2
 ):
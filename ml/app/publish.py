@@ -0,0 +1,101 @@
+"""
+Published forecasts for the front end.
+
+A forecast is written once under `forecasts/{model}/` in two encodings of the same values:
+`{origin}_{version}_{digest}.json` uses the positional layout of the `metrics/{kind}/` day files, one
+list per label with a sample every 15 minutes from the origin. `{origin}_{version}_{digest}.bin` holds
+the same values as little endian float32, label after label. The digest is a hash of the binary
+encoding, so both keys never change content and are cached for good. `latest.json` is the only key that gets overwritten. It is a small pointer to the newest
+forecast, cached briefly.
+"""
+from datetime import datetime, timedelta
+from typing import TypedDict
+from pathlib import Path
+import hashlib
+import json
+
+import pandas as pd
+import numpy as np
+
+from app.schema import Config
+from app.storage import Store
+from shared import tracing
+
+
+class Forecast(TypedDict):
+    model: str
+    version: str
+    origin: str  # timestamp of the first sample
+    minutes_per_sample: int
+    labels: list[str]  # order of the label lists, also the row order of the binary variant
+    samples: int
+    json: str
+    binary: str
+
+
+def encode_json(prediction: pd.DataFrame) -> bytes:
+    """{label: [value, ...]} positional layout, same as the metrics day files"""
+    return json.dumps(prediction.astype(float).to_dict(orient="list")).encode()
+
+
+def encode_binary(prediction: pd.DataFrame) -> bytes:
+    """Little endian float32 (labels, samples), each label contiguous"""
+    return np.ascontiguousarray(prediction.to_numpy(dtype="<f4").T).tobytes()
+
+
+def decode_binary(body: bytes, labels: list[str]) -> pd.DataFrame:
+    values = np.frombuffer(body, dtype="<f4").reshape(len(labels), -1)
+    return pd.DataFrame(values.T, columns=labels)
+
+
+class Publisher:
+    PREFIX = "forecasts"
+    IMMUTABLE = "public, max-age=31536000, immutable"
+    POINTER = "public, max-age=60, must-revalidate"
+
+    def __init__(self, store: Store, local_path: str = ".") -> None:
+        """Writes to the store's bucket, or under local_path when it has none"""
+        self.store = store
+        self.local_path = Path(local_path)
+
+    def put(self, key: str, body: bytes, content_type: str, cache_control: str):
+        if self.store.bucket is None:
+            path = self.local_path / key
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(body)
+            return
+        self.store.client.put_object(
+            Bucket=self.store.bucket,
+            Key=key,
+            Body=body,
+            ContentType=content_type,
+            CacheControl=cache_control,
+        )
+
+    @tracing.traced()
+    def publish(self, prediction: pd.DataFrame, model_name: str, version: str, origin: datetime) -> Forecast:
+        """Write both encodings of a forecast, then point latest to it. Returns the pointer."""
+        prefix = f"{self.PREFIX}/{model_name}"
+        binary = encode_binary(prediction)
+        # new values get a new key, a recomputed forecast never reuses a cached one
+        name = f"{origin:%Y-%m-%dT%H-%M}_{version}_{hashlib.sha256(binary).hexdigest()[:12]}"
+        forecast: Forecast = {
+            "model": model_name,
+            "version": version,
+            "origin": origin.isoformat(timespec="minutes"),
+            "minutes_per_sample": Config.MINUTES_PER_SAMPLE,
+            "labels": prediction.columns.tolist(),
+            "samples": prediction.shape[0],
+            "json": f"{prefix}/{name}.json",
+            "binary": f"{prefix}/{name}.bin",
+        }
+        self.put(forecast["json"], encode_json(prediction), "application/json", self.IMMUTABLE)
+        self.put(forecast["binary"], binary, "application/octet-stream", self.IMMUTABLE)
+        # pointer last, clients never see a forecast that isn't fully written
+        self.put(f"{prefix}/latest.json", json.dumps(forecast).encode(), "application/json", self.POINTER)
+        return forecast
+
+
+def forecast_origin(df: pd.DataFrame) -> datetime:
+    """First sample after the data"""
+    return (df.index[-1] + timedelta(minutes=Config.MINUTES_PER_SAMPLE)).to_pydatetime()
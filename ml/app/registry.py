@@ -0,0 +1,165 @@
+"""
+Versioned model artifacts.
+
+Each version lives in `{models_path}/{model}/{version}/` as plain arrays and json: `weights.npz`,
+`stats.npz` (normalization statistics) and `meta.json`. The version is a content hash of the arrays,
+`{models_path}/{model}/latest.json` points to the newest one, a warm process reads it from s3 at most
+once per Config.LATEST_TTL. Nothing is unpickled on load, models
+are rebuilt from their factory and the weights are assigned.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from time import monotonic
+from typing import TypedDict
+from pathlib import Path
+import hashlib
+import json
+import io
+
+import pandas as pd
+import numpy as np
+
+from app.models import Model
+from app.parallel import build_model
+from app.preprocessing import RunningStats
+from app.schema import Config
+from app.storage import Store
+from shared import tracing
+
+
+class Artifact(TypedDict):
+    version: str
+    model: Model
+    std: pd.Series
+    mean: pd.Series
+    stats: RunningStats | None
+    meta: dict
+
+
+# loaded artifacts kept across calls in a warm process, least recently used evicted first
+CACHE: OrderedDict[tuple[str, str, str], Artifact] = OrderedDict()
+CACHE_SIZE = 4
+# latest version of each model as resolved from s3, with the time it was resolved
+LATEST: dict[tuple[str, str], tuple[float, str]] = {}
+
+
+def _npz_bytes(**arrays) -> bytes:
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+class Registry:
+    FILES = ("weights.npz", "stats.npz", "meta.json")
+
+    def __init__(self, store: Store) -> None:
+        self.store = store
+        self.root = store.models_path
+
+    def version_path(self, model_name: str, version: str) -> Path:
+        return self.root / model_name / version
+
+    @tracing.traced()
+    def save(
+        self,
+        model: Model,
+        std: pd.Series,
+        mean: pd.Series,
+        meta: dict,
+        stats: RunningStats = None,
+    ) -> str:
+        """Store a new version and point latest to it. Returns the version."""
+        weights = _npz_bytes(**{f"w{i}": w for i, w in enumerate(model.get_weights())})
+        arrays = {"columns": np.array(mean.index, dtype=str), "mean": mean.to_numpy(), "std": std.to_numpy()}
+        if stats is not None:
+            arrays.update(count=np.array(stats.count), m=stats.m, m2=stats.m2)
+        stats_bytes = _npz_bytes(**arrays)
+        version = hashlib.sha256(weights + stats_bytes).hexdigest()[:12]
+        meta = {
+            "model": model.name,
+            "version": version,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "columns": mean.index.tolist(),
+            **meta,
+        }
+        path = self.version_path(model.name, version)
+        path.mkdir(parents=True, exist_ok=True)
+        (path / "weights.npz").write_bytes(weights)
+        (path / "stats.npz").write_bytes(stats_bytes)
+        (path / "meta.json").write_text(json.dumps(meta, indent=2, default=str))
+        (self.root / model.name / "latest.json").write_text(json.dumps({"version": version}))
+        if self.store.bucket is not None:
+            self.push(model.name, version)
+            LATEST[(str(self.root), model.name)] = (monotonic(), version)
+        return version
+
+    def push(self, model_name: str, version: str):
+        """Upload a version and then the latest pointer to s3"""
+        path = self.version_path(model_name, version)
+        for name in self.FILES:
+            self.store.client.upload_file(str(path / name), self.store.bucket, (path / name).as_posix())
+        latest = self.root / model_name / "latest.json"
+        self.store.client.upload_file(str(latest), self.store.bucket, latest.as_posix())
+
+    def pull_latest(self, model_name: str, max_age: float = Config.LATEST_TTL) -> str:
+        """Latest version from the s3 pointer, a warm process reuses it for max_age seconds"""
+        key = (str(self.root), model_name)
+        if key in LATEST and monotonic() - LATEST[key][0] < max_age:
+            return LATEST[key][1]
+        latest = self.root / model_name / "latest.json"
+        latest.parent.mkdir(parents=True, exist_ok=True)
+        self.store.client.download_file(self.store.bucket, latest.as_posix(), str(latest))
+        version = json.loads(latest.read_text())["version"]
+        LATEST[key] = (monotonic(), version)
+        return version
+
+    def pull(self, model_name: str, version: str = None) -> str:
+        """Download a version (latest by default) from s3 unless it is already local"""
+        if version is None:
+            version = self.pull_latest(model_name)
+        path = self.version_path(model_name, version)
+        if not all((path / name).is_file() for name in self.FILES):
+            path.mkdir(parents=True, exist_ok=True)
+            for name in self.FILES:
+                self.store.client.download_file(self.store.bucket, (path / name).as_posix(), str(path / name))
+        return version
+
+    def latest(self, model_name: str) -> str:
+        return json.loads((self.root / model_name / "latest.json").read_text())["version"]
+
+    def versions(self, model_name: str) -> pd.DataFrame:
+        """Metadata of every local version, newest first"""
+        metas = [json.loads(p.read_text()) for p in (self.root / model_name).glob("*/meta.json")]
+        return pd.DataFrame(metas).sort_values("created", ascending=False) if metas else pd.DataFrame()
+
+    @tracing.traced()
+    def load(self, model_name: str, version: str = None, cache: bool = True) -> Artifact:
+        """
+        Load a version, the latest by default. Cached artifacts skip deserialization and s3,
+        pass cache=False when the model will be modified (e.g. fine-tuned), it also re-reads latest.
+        """
+        if version is None and self.store.bucket is not None:
+            version = self.pull_latest(model_name, Config.LATEST_TTL if cache else 0)
+        version = self.latest(model_name) if version is None else version
+        key = (str(self.root), model_name, version)
+        if cache and key in CACHE:
+            CACHE.move_to_end(key)
+            return CACHE[key]
+        if self.store.bucket is not None:
+            self.pull(model_name, version)
+        path = self.version_path(model_name, version)
+        meta = json.loads((path / "meta.json").read_text())
+        with np.load(path / "weights.npz", allow_pickle=False) as f:
+            weights = [f[f"w{i}"] for i in range(len(f.files))]
+        with np.load(path / "stats.npz", allow_pickle=False) as f:
+            columns = f["columns"].tolist()
+            std = pd.Series(f["std"], index=columns)
+            mean = pd.Series(f["mean"], index=columns)
+            stats = RunningStats(columns, count=int(f["count"]), mean=f["m"], m2=f["m2"]) if "count" in f.files else None
+        model = build_model(meta["model"], len(columns), meta["steps"], weights, meta.get("params"))
+        artifact: Artifact = {"version": version, "model": model, "std": std, "mean": mean, "stats": stats, "meta": meta}
+        if cache:
+            CACHE[key] = artifact
+            if len(CACHE) > CACHE_SIZE:
+                CACHE.popitem(last=False)
+        return artifact
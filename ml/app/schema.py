@@ -1,16 +1,19 @@
 """
 Constants and control flow for the project.
 """
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from app.models import ModelGetter, get_multidense_model, get_convolution_model, get_lstm_model
 
 from typing import Literal
 
+from shared import waits
+
 class Config:
     SAMPLES_PER_DAY = 96
     MINUTES_PER_SAMPLE = 15
-    CLIP_CEILING = 15
+    CLIP_CEILING = waits.CLIP_CEILING
     CLIP_SOFTNESS = 0.2
+    SLOW_WAIT = waits.SLOW_WAIT  # minutes, waits at or above count as slow in backtests
     DAYS_PER_CYCLE = 7  # week
     FREQUENCIES = [ # in hours
         1,
@@ -20,6 +23,22 @@ class Config:
         24,
         7 * 24,
     ]
+    UPDATE_TOLERANCE = 0.1  # allowed relative val loss increase before a full retrain
+    LATEST_TTL = 60  # seconds a warm process serves the latest model version it resolved
+    BATCH_SIZE = 32
+    PREFETCH = -1  # tf.data.AUTOTUNE
+
+
+class Pipeline(BaseModel):
+    """Input pipeline options for WindowGenerator datasets."""
+    batch_size: int = Config.BATCH_SIZE
+    shuffle_buffer: int | None = None  # None shuffles over all windows
+    cache: bool | str = True  # True for memory, str for a cache file path
+    prefetch: int = Config.PREFETCH  # 0 to disable
+    parallel_calls: int = Config.PREFETCH  # 0 to map sequentially
+    deterministic: bool = False
+    profile: bool = False  # report input vs compute time per epoch
+
 
 class Models:
     MODELS: dict[str, ModelGetter] = {
@@ -28,11 +47,38 @@ class Models:
         "cnn": get_convolution_model,
         "lstm": get_lstm_model,
     }
+    # hyperparameter variants trained by the sweep, {} is the factory default
+    SWEEP: dict[str, list[dict]] = {
+        "dense": [{}, {"units": 128}],
+        "cnn": [{}, {"filters": 64}],
+        "lstm": [{}, {"units": 64}],
+    }
+    # hyperparameter choices of the search, factory keyword arguments per model
+    SEARCH: dict[str, dict[str, list]] = {
+        "dense": {"units": [32, 128, 512]},
+        "cnn": {"filters": [32, 64, 256], "conv_width": [3, 6]},
+        "lstm": {"units": [16, 32, 64]},
+    }
+
+
+class Search(BaseModel):
+    """Hyperparameter search options, trials are sampled from Models.SEARCH and input_widths."""
+    trials: int = 12  # configurations sampled, all of them when the space is smaller
+    scheduler: Literal["halving", "median"] = "halving"
+    min_epochs: int = 2  # budget of the first halving rung, epochs before median pruning starts
+    max_epochs: int = 40
+    eta: int = 3  # a halving rung keeps 1 / eta of its trials
+    patience: int = 4
+    input_widths: list[int] = [24, 48, 96]  # WindowGenerator input widths in samples
+    pin: bool = True  # bind every worker process to its own cores
+    seed: int = 0
+
 
 class Action(BaseModel):
-    type: Literal["fit", "predict"]
+    type: Literal["fit", "predict", "sweep", "search", "update", "backtest"]
     start: int
     end: int
+    origins: int = 1  # forecast origins for batched predict and backtest, one every sample
 
 
 class EventPaths(BaseModel):
@@ -45,6 +91,22 @@ class EventPaths(BaseModel):
 
 class Event(BaseModel):
     model: str
+    version: str | None = None  # registry version, latest when None
     action: Action
     paths: EventPaths
-    steps: int = Config.SAMPLES_PER_DAY
\ No newline at end of file
+    steps: int = Config.SAMPLES_PER_DAY
+    pipeline: Pipeline = Pipeline()
+    workers: int = 1  # processes used to train folds
+    frequencies: list[int | float] | Literal["auto"] | None = None  # None uses Config.FREQUENCIES
+    budget_ms: int | None = None  # serving latency budget reported by lambda_handler
+    publish: bool = False  # write the forecast under forecasts/ for the front end
+    out_of_core: bool = False  # fit from a memory mapped series instead of an in-memory frame
+    search: Search = Search()
+
+    @validator("publish")
+    def publish_single_origin(cls, publish, values):
+        """Published forecasts have one origin, a batch would move the latest pointer once per origin"""
+        action = values.get("action")
+        if publish and action is not None and action.type == "predict" and action.origins > 1:
+            raise ValueError("publish needs a single forecast origin, batched predictions are not published")
+        return publish
\ No newline at end of file
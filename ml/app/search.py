@@ -0,0 +1,286 @@
+"""
+Hyperparameter search over the model factories and the input window width.
+
+Trials train on one sliding window fold and are scored by val_loss. Bad trials stop after a few
+epochs. Successive halving trains every trial for a small budget and gives eta times more epochs to
+the best 1 / eta of them. Median pruning stops a trial once its best val_loss is worse than the
+median of the completed trials at the same epoch. Trials run in a process pool. The report ranks the
+completed trials by validation MAE and marks the accuracy vs inference latency Pareto front.
+"""
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from itertools import product
+from time import perf_counter
+from typing import TypedDict
+import json
+
+import tensorflow as tf
+import pandas as pd
+import numpy as np
+
+from app.compile import compile_model
+from app.parallel import SharedFrame, build_model, task_splits, threads_per_worker, worker_pool
+from app.preprocessing import normalize_training_data
+from app.schema import Models, Pipeline, Search
+from app.window import WindowGenerator
+
+
+class Trial(TypedDict):
+    trial: int
+    model_name: str
+    params: dict
+    input_width: int
+
+
+class TrialTask(TypedDict):
+    trial: Trial
+    steps: int
+    pipeline: dict
+    data: pd.DataFrame | SharedFrame
+    train: np.ndarray
+    val: np.ndarray
+    test: np.ndarray
+    valid: np.ndarray | None
+    initial_epoch: int
+    epochs: int  # train up to this epoch
+    weights: list | None  # resume from an earlier rung
+    patience: int
+    reference: list[list[float]]  # val_loss curves of completed trials, median pruning only
+    warmup: int
+    final: bool  # evaluate on the test split
+
+
+def trial_space(models: dict[str, dict[str, list]], input_widths: list[int]) -> list[Trial]:
+    """Every combination of factory arguments and input width, convolutions need inputs as wide as their kernel"""
+    trials = []
+    for model_name, space in models.items():
+        for values in product(*space.values(), input_widths):
+            params = dict(zip(space, values[:-1]))
+            if params.get("conv_width", 0) > values[-1]:
+                continue
+            trials.append({"trial": len(trials), "model_name": model_name, "params": params, "input_width": values[-1]})
+    return trials
+
+
+def sample_trials(search: Search, models: dict[str, dict[str, list]] = None) -> list[Trial]:
+    space = trial_space(Models.SEARCH if models is None else models, search.input_widths)
+    if search.trials >= len(space):
+        return space
+    rng = np.random.default_rng(search.seed)
+    return [space[i] for i in sorted(rng.choice(len(space), search.trials, replace=False))]
+
+
+class MedianPruning(tf.keras.callbacks.Callback):
+    """Stop when the best val_loss so far is worse than the median of the reference curves at that epoch."""
+
+    def __init__(self, reference: list[list[float]], warmup: int, min_reference: int = 2):
+        super().__init__()
+        # running best of each reference, curves that stopped early keep their last best
+        self.reference = [np.minimum.accumulate(curve) for curve in reference if len(curve)]
+        self.warmup = warmup
+        self.min_reference = min_reference
+        self.best = np.inf
+        self.pruned = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.best = min(self.best, logs["val_loss"])
+        if epoch + 1 < self.warmup:
+            return
+        at = [curve[min(epoch, len(curve) - 1)] for curve in self.reference]
+        if len(at) >= self.min_reference and self.best > np.median(at):
+            self.pruned = True
+            self.model.stop_training = True
+
+
+def inference_ms(model, input_width: int, num_features: int, repeats: int = 20) -> float:
+    """Median latency of one forecast window through the model, after a warm up call"""
+    X = tf.zeros((1, input_width, num_features))
+    model(X, training=False)
+    times = []
+    for _ in range(repeats):
+        t0 = perf_counter()
+        model(X, training=False)
+        times.append((perf_counter() - t0) * 1000)
+    return float(np.median(times))
+
+
+def fit_trial(task: TrialTask) -> dict:
+    """Train a trial from its initial epoch up to its epoch budget, in a worker process."""
+    t0 = perf_counter()
+    tf.keras.backend.clear_session()
+    train_df, val_df, test_df, _, _ = normalize_training_data(*task_splits(task))
+    trial, steps = task["trial"], task["steps"]
+    model = build_model(trial["model_name"], train_df.shape[1], steps, params=trial["params"])
+    model(np.zeros((1, trial["input_width"], train_df.shape[1]), dtype=np.float32))
+    if task["weights"] is not None:
+        model.set_weights(task["weights"])
+    valid = task["valid"]
+    window = WindowGenerator(
+        train_df,
+        val_df,
+        test_df,
+        input_width=trial["input_width"],
+        label_width=steps,
+        shift=steps,
+        pipeline=Pipeline(**task["pipeline"]),
+        valid=None if valid is None else {name: valid[task[name]] for name in ("train", "val", "test")},
+    )
+    early_stopping = tf.keras.callbacks.EarlyStopping(
+        monitor="val_loss", patience=task["patience"], mode="min", restore_best_weights=True
+    )
+    pruning = MedianPruning(task["reference"], task["warmup"])
+    history = compile_model(model).fit(
+        window.train,
+        initial_epoch=task["initial_epoch"],
+        epochs=task["epochs"],
+        validation_data=window.val,
+        callbacks=[early_stopping, pruning],
+        verbose=0,
+    )
+    val_loss, val_mae = model.evaluate(window.val, verbose=0)
+    return {
+        "trial": trial["trial"],
+        "curve": history.history["val_loss"],
+        "val_loss": val_loss,
+        "val_mae": val_mae,
+        "test_mae": model.evaluate(window.test, verbose=0)[1] if task["final"] else None,
+        "converged": early_stopping.stopped_epoch > 0 and not pruning.pruned,
+        "pruned": pruning.pruned,
+        "latency_ms": inference_ms(model, trial["input_width"], train_df.shape[1]) if task["final"] else None,
+        "size": model.count_params(),
+        "seconds": perf_counter() - t0,
+        "weights": model.get_weights(),
+    }
+
+
+def pareto_front(error: np.ndarray, latency: np.ndarray) -> np.ndarray:
+    """Mask of the points no other point beats on both error and latency"""
+    order = np.lexsort((error, latency))
+    front = np.zeros(len(error), dtype=bool)
+    best = np.inf
+    for i in order:
+        if error[i] < best:
+            front[i] = True
+            best = error[i]
+    return front
+
+
+class TrialSearch:
+    """Runs sampled trials through a scheduler and keeps the state of every trial between rungs."""
+
+    def __init__(self, search: Search, steps: int, pipeline: Pipeline, workers: int = 1) -> None:
+        self.search = search
+        self.steps = steps
+        self.pipeline = pipeline
+        self.workers = workers
+        self.state: dict[int, dict] = {}
+
+    def task(self, trial: Trial, fold: dict, epochs: int, final: bool, reference: list = None) -> TrialTask:
+        state = self.state.get(trial["trial"], {})
+        return {
+            "trial": trial,
+            "steps": self.steps,
+            "pipeline": self.pipeline.dict(),
+            **fold,
+            "initial_epoch": state.get("epochs", 0),
+            "epochs": epochs,
+            "weights": state.get("weights"),
+            "patience": self.search.patience,
+            "reference": reference or [],
+            "warmup": self.search.min_epochs,
+            "final": final,
+        }
+
+    def record(self, trial: Trial, result: dict, epochs: int):
+        state = self.state.setdefault(trial["trial"], {**trial, "epochs": 0, "curve": [], "seconds": 0.0})
+        state.update({k: v for k, v in result.items() if k not in ("trial", "curve", "seconds")})
+        state["epochs"] = min(epochs, state["epochs"] + len(result["curve"]))
+        state["curve"] = state["curve"] + result["curve"]
+        state["seconds"] += result["seconds"]
+
+    def successive_halving(self, trials: list[Trial], fold: dict, run) -> None:
+        """
+        Rungs of min_epochs * eta^i epochs, the best 1 / eta (at least eta) trials go on to the next one.
+        The last rung trains the survivors up to max_epochs and scores them on the test split.
+        """
+        search, alive, budget = self.search, list(trials), self.search.min_epochs
+        while True:
+            final = len(alive) <= search.eta or budget >= search.max_epochs
+            epochs = search.max_epochs if final else budget
+            # trials that stopped improving keep their weights, the last rung only scores them
+            converged = {t["trial"] for t in alive if self.state.get(t["trial"], {}).get("converged")}
+            training = [t for t in alive if final or t["trial"] not in converged]
+            tasks = [
+                self.task(t, fold, self.state[t["trial"]]["epochs"] if t["trial"] in converged else epochs, final)
+                for t in training
+            ]
+            for trial, result in zip(training, run(tasks)):
+                self.record(trial, result, epochs)
+            print(f"Rung of {epochs} epochs: {len(training)} of {len(alive)} trials trained")
+            if final:
+                break
+            alive.sort(key=lambda t: self.state[t["trial"]]["val_loss"])
+            keep = max(len(alive) // search.eta, search.eta)
+            for trial in alive[keep:]:
+                self.state[trial["trial"]]["pruned"] = True
+            alive = alive[:keep]
+            budget *= search.eta
+
+    def median_pruning(self, trials: list[Trial], fold: dict, pool) -> None:
+        """Trials train to max_epochs unless pruned, each one starts with the curves of the trials completed so far."""
+        pending, running = list(trials), {}
+        while pending or running:
+            while pending and (pool is None or len(running) < self.workers):
+                trial = pending.pop(0)
+                # pruned trials are the worst ones, their curves would make the median too lenient
+                reference = [s["curve"] for s in self.state.values() if not s["pruned"]]
+                task = self.task(trial, fold, self.search.max_epochs, True, reference)
+                if pool is None:
+                    self.record(trial, fit_trial(task), self.search.max_epochs)
+                else:
+                    running[pool.submit(fit_trial, task)] = trial
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.record(running.pop(future), future.result(), self.search.max_epochs)
+
+    def run(self, df: pd.DataFrame, fold: dict, trials: list[Trial]) -> pd.DataFrame:
+        """Leaderboard of every trial, completed ones ranked by validation MAE"""
+        pool = worker_pool(self.workers, pin=self.search.pin) if self.workers > 1 else None
+        with SharedFrame(df) if pool else nullcontext(df) as data, pool or nullcontext():
+            fold = {**fold, "data": data}
+            print(f"Searching {len(trials)} trials with {self.workers} workers, {threads_per_worker(self.workers)} threads each...")
+            if self.search.scheduler == "median":
+                self.median_pruning(trials, fold, pool)
+            elif pool:
+                self.successive_halving(trials, fold, lambda tasks: list(pool.map(fit_trial, tasks)))
+            else:
+                self.successive_halving(trials, fold, lambda tasks: [fit_trial(task) for task in tasks])
+        return self.leaderboard()
+
+    def leaderboard(self) -> pd.DataFrame:
+        rows = pd.DataFrame(
+            [
+                {
+                    "trial": s["trial"],
+                    "model": s["model_name"],
+                    "params": json.dumps(s["params"], sort_keys=True),
+                    "input_width": s["input_width"],
+                    "status": "pruned" if s["pruned"] else "completed",
+                    "epochs": s["epochs"],
+                    "val_loss": s["val_loss"],
+                    "val_mae": s["val_mae"],
+                    "test_mae": s["test_mae"],
+                    "latency_ms": s["latency_ms"],
+                    "size": s["size"],
+                    "seconds": s["seconds"],
+                }
+                for s in self.state.values()
+            ]
+        )
+        completed = (rows["status"] == "completed").to_numpy()
+        rows["pareto"] = False
+        rows.loc[completed, "pareto"] = pareto_front(
+            rows.loc[completed, "val_mae"].to_numpy(), rows.loc[completed, "latency_ms"].to_numpy(dtype=float)
+        )
+        return rows.sort_values(["status", "val_mae"], ignore_index=True)
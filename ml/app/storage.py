@@ -1,12 +1,14 @@
 from datetime import datetime, timedelta
+from collections import Counter
 from typing import Generator, TypedDict
 from pathlib import Path
-import pickle as pkl
-import numpy as np
 import boto3
 import json
 
-from app.models import Model, load_model
+from app.schema import Config
+from shared import tracing
+from shared.resample import VALID_KEY
+from shared.series import TimeMatrix, valid_key
 
 
 class FileData(TypedDict):
@@ -21,66 +23,177 @@ class Store:
         if s3_bucket is not None:
             self.client = boto3.client("s3")
         self.bucket = s3_bucket
+        # ETag (s3) or mtime and size (local) of every listed file, a rewritten file gets a new one
+        self.versions: dict[str, str] = {}
         self.models_path = Path(models_path)
         self.metrics_path = Path(metrics_path)
         self.events_path = Path(events_path)
 
+    @staticmethod
+    def path_date(path: str) -> datetime:
+        """Parse the first date of a '{before}_{after}.json' file name"""
+        return datetime.strptime(Path(path).stem.split("_")[0], "%Y-%m-%d")
+
     def compute_time(self, start: int, end: int) -> tuple[datetime, datetime]:
         """Compute start and end time"""
         t0 = datetime.now() - timedelta(days=start + 1)
         t1 = datetime.now() - timedelta(days=end)
         return [t0, t1]
 
-    def store_local_models(self, model: Model, std: np.ndarray, mean: np.ndarray):
-        """Store model locally"""
-        if not self.models_path.is_dir():
-            self.models_path.mkdir(parents=True)
-        # store
-        model.save(self.models_path / f"{model.name}.h5")
-        # store mean as pickle file
-        with open(self.models_path / f"{model.name}_mean.pkl", "wb") as f:
-            pkl.dump(mean, f)
-        # store std as pickle file
-        with open(self.models_path / f"{model.name}_std.pkl", "wb") as f:
-            pkl.dump(std, f)
-
-    def load_local_models(self, model_name: str):
-        """Load models from local storage"""
-        with open(self.models_path / f"{model_name}_mean.pkl", "rb") as f:
-            mean = pkl.load(f)
-        # load std from pickle file
-        with open(self.models_path / f"{model_name}_std.pkl", "rb") as f:
-            std = pkl.load(f)
-        # load model
-        model = load_model(self.models_path / f"{model_name}.h5")
-        return model, std, mean
+    @tracing.traced()
+    def list_files(self, path: Path, start: int, end: int) -> list[str]:
+        """Paths (local) or keys (s3) of the day files between start and end, in date order"""
+        t0, t1 = self.compute_time(start, end)
+        if self.bucket is None:
+            if not path.is_dir():
+                raise ValueError("Path does not exist")
+            files = []
+            for file in path.glob("*.json"):
+                stat = file.stat()
+                self.versions[str(file)] = f"{stat.st_mtime_ns}-{stat.st_size}"
+                files.append(str(file))
+        else:
+            try:
+                pages = self.client.get_paginator("list_objects_v2").paginate(
+                    Bucket=self.bucket, Prefix=str(path)
+                )
+                contents = [c for page in pages for c in page.get("Contents", [])]
+            except BaseException as e:
+                raise ValueError(e)
+            self.versions.update({c["Key"]: f"{c['ETag']}-{c['LastModified'].isoformat()}" for c in contents})
+            files = [c["Key"] for c in contents]
+        return sorted(f for f in files if t0 <= self.path_date(f) < t1)
+
+    @tracing.traced()
+    def read_file(self, key: str) -> dict:
+        """Read and decode one day file from local storage or s3"""
+        if self.bucket is None:
+            with open(key, "rb") as f:
+                data = json.load(f)
+        else:
+            data = json.load(self.client.get_object(Bucket=self.bucket, Key=key)["Body"])
+        # counted once read, a missing validity companion is not a read
+        READS[key] += 1
+        tracing.count("files_read")
+        return data
+
+    def read_valid(self, key: str) -> list[int] | None:
+        """Validity mask of a metrics day from its companion file, None for days written without one"""
+        missing = (FileNotFoundError,) if self.bucket is None else (self.client.exceptions.NoSuchKey,)
+        try:
+            return self.read_file(valid_key(key))[VALID_KEY]
+        except missing:
+            return None
 
     def load_local_files(self, path: Path, start: int, end: int) -> Generator[FileData, None, None]:
-        """Compute date and load local files"""
-        if not path.is_dir():
-            raise ValueError("Path does not exist")
-        # glob and filter by date
-        t0, t1 = self.compute_time(start, end)
-        for file in path.glob("*.json"):
-            date = datetime.strptime(file.stem.split("_")[0], "%Y-%m-%d")
-            if date >= t0 and date < t1:
-                with open(file, "rb") as f:
-                    yield {"path": str(file), "data": json.load(f)}
+        """Compute date and load local files, in date order"""
+        for file in self.list_files(Path(path), start, end):
+            yield {"path": file, "data": self.read_file(file)}
 
     def download_s3_files(
         self, start: int, end: int
     ) -> Generator[FileData, None, None]:
         """Locate files in s3 bucket based on date start and end."""
-        try:
-            response = self.client.list_objects_v2(
-                Bucket=self.bucket, Prefix=str(self.metrics_path)
-            )
-        except BaseException as e:
-            raise ValueError(e)
-        # go over directory and filter by date
-        t0, t1 = self.compute_time(start, end)
-        for file in response["Contents"]:
-            date = datetime.strptime(Path(file["Key"]).stem.split("_")[0], "%Y-%m-%d")
-            if date >= t0 and date < t1:
-                data = self.client.get_object(Bucket=self.bucket, Key=file["Key"])
-                yield {"path": file["Key"], "data": json.load(data["Body"])}
+        for key in self.list_files(self.metrics_path, start, end):
+            yield {"path": key, "data": self.read_file(key)}
+
+
+# decoded day files (metrics days as TimeMatrix, events as dicts) by key with the version they were read at,
+# and read counts, shared by every DataSource in the process
+DAYS: dict[str, tuple[str | None, TimeMatrix | dict]] = {}
+READS: Counter = Counter()
+
+
+def retain(keys: list[str]):
+    """Drop decoded days that are not in keys, bounds the cache of long lived processes"""
+    for key in set(DAYS) - set(keys):
+        del DAYS[key]
+
+
+class DataSource:
+    """
+    Lazy handle over the metrics and events days of a date range.
+    Nothing is read until the days are requested, each file is read and decoded once per process and version.
+    """
+
+    def __init__(self, store: Store, start: int, end: int) -> None:
+        self.store = store
+        self.start = start
+        self.end = end
+        self._paths = {}
+
+    def paths(self, path: Path) -> list[str]:
+        if path not in self._paths:
+            self._paths[path] = self.store.list_files(path, self.start, self.end)
+        return self._paths[path]
+
+    def cached(self, key: str) -> TimeMatrix | dict | None:
+        """Memoized day of key, None when missing or when the file was rewritten since it was read"""
+        version, data = DAYS.get(key, (None, None))
+        return data if data is not None and version == self.store.versions.get(key) else None
+
+    def load(self, key: str) -> dict:
+        data = self.cached(key)
+        if data is None:
+            data = self.store.read_file(key)
+            DAYS[key] = (self.store.versions.get(key), data)
+        return data
+
+    def decode_day(self, key: str) -> TimeMatrix:
+        """Metrics day file and its validity mask as exactly Config.SAMPLES_PER_DAY samples from the day in its name"""
+        return TimeMatrix.from_day(
+            self.store.read_file(key),
+            self.store.path_date(key),
+            periods=Config.SAMPLES_PER_DAY,
+            valid=self.store.read_valid(key),
+        )
+
+    def day(self, key: str) -> TimeMatrix:
+        data = self.cached(key)
+        if data is None:
+            data = self.decode_day(key)
+            DAYS[key] = (self.store.versions.get(key), data)
+        return data
+
+    def peek(self, key: str) -> dict:
+        """Memoized day if already loaded, otherwise read it without memoizing"""
+        data = self.cached(key)
+        return self.store.read_file(key) if data is None else data
+
+    def peek_day(self, key: str) -> TimeMatrix:
+        data = self.cached(key)
+        return self.decode_day(key) if data is None else data
+
+    @property
+    def metrics(self) -> list[TimeMatrix]:
+        """Metrics days in date order"""
+        return [self.day(p) for p in self.paths(self.store.metrics_path)]
+
+    @property
+    def series(self) -> TimeMatrix:
+        """
+        Every metrics day concatenated into one new matrix. The decoded days stay memoized in DAYS for
+        warm reuse, so the samples are held twice while the result is alive.
+        """
+        return TimeMatrix.concat(self.metrics)
+
+    @property
+    def events(self) -> list[dict]:
+        """Events day for each metrics day, empty when missing"""
+        events = {self.store.path_date(p): p for p in self.paths(self.store.events_path)}
+        dates = [self.store.path_date(p) for p in self.paths(self.store.metrics_path)]
+        return [self.load(events[d]) if d in events else {} for d in dates]
+
+    @property
+    def first_date(self) -> datetime | None:
+        paths = self.paths(self.store.metrics_path)
+        return self.store.path_date(paths[0]) if paths else None
+
+    @staticmethod
+    def io_stats() -> dict:
+        """Files read, total reads and the most reads of a single file in this process"""
+        return {
+            "files": len(READS),
+            "reads": sum(READS.values()),
+            "max_reads_per_file": max(READS.values(), default=0),
+        }
@@ -1,20 +1,31 @@
+from uuid import uuid4
 import tensorflow as tf
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
+from app.schema import Config, Pipeline
 
-def get_predict_window_dataset(df: pd.DataFrame):
+
+def get_predict_window_dataset(df: pd.DataFrame, batch_size: int = Config.BATCH_SIZE):
     return tf.keras.utils.timeseries_dataset_from_array(
         data=np.array(df, dtype=np.float32),
         targets=None,
         sequence_length=df.shape[0],
         sequence_stride=1,
-        shuffle=True,
-        batch_size=32,
+        shuffle=False,
+        batch_size=batch_size,
     )
 
 
+def _is_complete(window, ok):
+    return ok
+
+
+def _drop_mask(window, ok):
+    return window
+
+
 class WindowGenerator:
     def __init__(
         self,
@@ -25,6 +36,8 @@ class WindowGenerator:
         label_width: int,
         shift: int,
         label_columns=None,
+        pipeline: Pipeline = None,
+        valid: dict[str, np.ndarray] = None,
     ):
         """
         ## Data Windowing
@@ -36,7 +49,13 @@ class WindowGenerator:
         - The width (number of time steps) of the input and label windows.
         - The time offset between them.
         - Which features are used as inputs, labels, or both.
+
+        The `pipeline` options control batching, shuffling, caching and prefetching of the datasets.
+        `valid` holds per split sample masks, windows that cover an invalid sample are skipped.
         """
+        self.pipeline = Pipeline() if pipeline is None else pipeline
+        self.valid = {} if valid is None else valid
+        self.cache_id = uuid4().hex
         # Store the raw data.
         self.train_df = train_df
         self.val_df = val_df
@@ -78,19 +97,42 @@ class WindowGenerator:
             ]
         )
 
-    def make_dataset(self, data):
+    def make_dataset(self, data, name: str = "train", shuffle=True):
+        """Build a windowed dataset: cache unbatched windows, reshuffle every epoch, batch, split and prefetch."""
+        p = self.pipeline
         data = np.array(data, dtype=np.float32)
         ds = tf.keras.utils.timeseries_dataset_from_array(
             data=data,
             targets=None,
             sequence_length=self.total_window_size,
             sequence_stride=1,
-            shuffle=True,
-            batch_size=32,
+            shuffle=False,
+            batch_size=None,
         )
-
-        ds = ds.map(self.split_window)
-
+        complete = (
+            np.lib.stride_tricks.sliding_window_view(self.valid[name], self.total_window_size).all(axis=1)
+            if name in self.valid
+            else None
+        )
+        if complete is not None and not complete.any():
+            print(f"No {name} window without gaps, keeping all of them")
+        elif complete is not None and not complete.all():
+            ds = tf.data.Dataset.zip((ds, tf.data.Dataset.from_tensor_slices(complete)))
+            ds = ds.filter(_is_complete).map(_drop_mask)
+        # windows are computed once, the shuffle after the cache keeps epochs different
+        if p.cache is not False:
+            ds = ds.cache() if p.cache is True else ds.cache(f"{p.cache}/{self.cache_id}_{name}")
+        if shuffle:
+            buffer = p.shuffle_buffer or max(len(data) - self.total_window_size + 1, 1)
+            ds = ds.shuffle(buffer, reshuffle_each_iteration=True)
+        ds = ds.batch(p.batch_size)
+        ds = ds.map(
+            self.split_window,
+            num_parallel_calls=p.parallel_calls if p.parallel_calls != 0 else None,
+            deterministic=p.deterministic,
+        )
+        if p.prefetch != 0:
+            ds = ds.prefetch(p.prefetch)
         return ds
 
     def split_window(self, features):
@@ -114,15 +156,15 @@ class WindowGenerator:
 
     @property
     def train(self):
-        return self.make_dataset(self.train_df)
+        return self.make_dataset(self.train_df, "train")
 
     @property
     def val(self):
-        return self.make_dataset(self.val_df)
+        return self.make_dataset(self.val_df, "val", shuffle=False)
 
     @property
     def test(self):
-        return self.make_dataset(self.test_df)
+        return self.make_dataset(self.test_df, "test", shuffle=False)
 
     @property
     def example(self):
@@ -0,0 +1,114 @@
+"""
+Benchmarks for the ML data path, run from the ml directory:
+
+    python benchmark.py io --metrics metrics/relax --events metrics/events --days 28
+    python benchmark.py lambda --model dense --cold 5 --warm 50
+    python benchmark.py resample --days 365
+"""
+from time import perf_counter
+import subprocess
+import argparse
+import json
+import sys
+
+import app
+
+
+def bench_io(metrics: str, events: str, days: int) -> dict:
+    """Load the same range through every stage that needs it, each file must be read once"""
+    store = app.Store(models_path="models", metrics_path=metrics, events_path=events)
+    source = app.DataSource(store, start=days, end=0)
+    event = {
+        "model": "dense",
+        "action": {"type": "fit", "start": days, "end": 0},
+        "paths": {"bucket": "", "models": "models", "metrics": metrics, "events": events, "output": "predictions"},
+    }
+    t0 = perf_counter()
+    fit_df = app.ModelFlow(event, source).load_data()
+    first = perf_counter() - t0
+    # predict and a second source over a sub range reuse the decoded days
+    t0 = perf_counter()
+    app.ModelFlow(event, source).load_data()
+    app.ModelFlow(event, app.DataSource(store, start=1, end=0)).load_data()
+    warm = perf_counter() - t0
+    stats = source.io_stats()
+    assert stats["max_reads_per_file"] <= 1, f"files read more than once: {stats}"
+    return {"rows": fit_df.shape[0], "columns": fit_df.shape[1], "first_s": first, "warm_s": warm, **stats}
+
+
+def percentiles(values: list[float]) -> dict:
+    import numpy as np
+
+    return {"n": len(values), "p50_ms": float(np.percentile(values, 50)), "p99_ms": float(np.percentile(values, 99))}
+
+
+def bench_lambda(event: dict, cold: int, warm: int) -> dict:
+    """
+    Invoke the ML lambda_handler locally. Cold invocations run in a fresh interpreter each and include
+    imports, warm invocations repeat in this process after one priming call.
+    """
+    script = (
+        "import json, sys, time; t0 = time.perf_counter(); "
+        "from app.__main__ import lambda_handler; "
+        "lambda_handler(json.loads(sys.argv[1]), None); "
+        "print(json.dumps((time.perf_counter() - t0) * 1000))"
+    )
+    cold_ms = [
+        json.loads(subprocess.run([sys.executable, "-c", script, json.dumps(event)], capture_output=True, text=True, check=True).stdout.splitlines()[-1])
+        for _ in range(cold)
+    ]
+    from app.__main__ import lambda_handler
+
+    lambda_handler(event, None)
+    warm_ms = []
+    for _ in range(warm):
+        t0 = perf_counter()
+        lambda_handler(event, None)
+        warm_ms.append((perf_counter() - t0) * 1000)
+    return {"cold": percentiles(cold_ms), "warm": percentiles(warm_ms)}
+
+
+def bench_resample(days: int, metrics: int = 10, missed: float = 0.02, seed: int = 0) -> dict:
+    """Resample `days` of long format fetches with missed and duplicate fetches, every fill policy"""
+    import numpy as np
+    from shared.resample import resample, SAMPLES_PER_DAY
+
+    rng = np.random.default_rng(seed)
+    periods = days * SAMPLES_PER_DAY
+    start = np.datetime64("2024-01-01T00:00:00")
+    fires = np.where(rng.random(periods) < missed, 0, 1) + (rng.random(periods) < missed)
+    fetched = np.repeat(np.arange(periods), fires)
+    timestamps = np.repeat(start + fetched * np.timedelta64(900, "s") + rng.integers(0, 600, len(fetched)).astype("timedelta64[s]"), metrics)
+    columns = np.tile(np.arange(metrics), len(fetched))
+    values = rng.random(len(timestamps))
+    result = {"days": days, "samples": len(timestamps)}
+    for policy in ("nan", "ffill", "interpolate"):
+        t0 = perf_counter()
+        _, valid = resample(timestamps, values, start, columns=columns, n_columns=metrics, periods=periods, policy=policy)
+        result[f"{policy}_ms"] = (perf_counter() - t0) * 1000
+    result["valid"] = float(valid.all(axis=1).mean())
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="ML benchmarks")
+    parser.add_argument("bench", choices=["io", "lambda", "resample"])
+    parser.add_argument("--metrics", default="metrics/relax", type=str)
+    parser.add_argument("--events", default="metrics/events", type=str)
+    parser.add_argument("--models", default="models", type=str)
+    parser.add_argument("--model", default="dense", type=str)
+    parser.add_argument("--days", default=28, type=int)
+    parser.add_argument("--cold", default=5, type=int)
+    parser.add_argument("--warm", default=50, type=int)
+    argv = parser.parse_args()
+    if argv.bench == "io":
+        print(json.dumps(bench_io(argv.metrics, argv.events, argv.days)))
+    elif argv.bench == "resample":
+        print(json.dumps(bench_resample(argv.days)))
+    else:
+        event = {
+            "model": argv.model,
+            "action": {"type": "predict", "start": 1, "end": 0},
+            "paths": {"bucket": "", "models": argv.models, "metrics": argv.metrics, "events": argv.events, "output": "predictions"},
+        }
+        print(json.dumps(bench_lambda(event, argv.cold, argv.warm)))
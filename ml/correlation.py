@@ -1,37 +1,63 @@
-from scipy.stats import spearmanr, pearsonr, kendalltau
-from typing import Callable
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import rankdata, kendalltau
 import pandas as pd
+import numpy as np
 
 
-def _make_correlation_table(
-    df: pd.DataFrame, func: Callable, index: int
-) -> pd.DataFrame:
-    """Use scipy correlation methods"""
-    table = []
-    cols = set(df.columns)
-    for c1 in cols:
-        cols = cols - {c1}
-        for c2 in cols:
-            result = func(df[c1], df[c2])[index]
-            table.append((c1, c2, result))
+def _pairs_table(columns: pd.Index, matrix: np.ndarray) -> pd.DataFrame:
+    """Long form table of the upper triangle of a correlation matrix, sorted descending"""
+    i, j = np.triu_indices(len(columns), k=1)
     return (
-        pd.DataFrame(table, columns=["A", "B", "score"])
-        .sort_values("score", ascending=False)
-        .reset_index()
-        .drop(columns=["index"])
+        pd.DataFrame({"A": columns[i], "B": columns[j], "score": matrix[i, j]})
+        .sort_values("score", ascending=False, kind="mergesort")
+        .reset_index(drop=True)
     )
 
 
+def _kendall_pair(args: tuple[np.ndarray, np.ndarray]) -> float:
+    return kendalltau(*args)[0]
+
+
+def pearson_matrix(df: pd.DataFrame) -> np.ndarray:
+    """Pearson correlation of all columns in one corrcoef call"""
+    return np.corrcoef(np.asarray(df, dtype=np.float64), rowvar=False)
+
+
+def spearman_matrix(df: pd.DataFrame) -> np.ndarray:
+    """Spearman correlation, ranking every column once then correlating the ranks"""
+    ranks = rankdata(np.asarray(df, dtype=np.float64), axis=0)
+    return np.corrcoef(ranks, rowvar=False)
+
+
+def kendalltau_matrix(df: pd.DataFrame, workers: int = 1) -> np.ndarray:
+    """
+    Kendall tau-b for every pair. Columns are ranked once, scipy counts discordant
+    pairs with a merge sort (O(n log n) per pair). Pairs run in a process pool when workers > 1.
+    """
+    ranks = rankdata(np.asarray(df, dtype=np.float64), axis=0)
+    n = ranks.shape[1]
+    i, j = np.triu_indices(n, k=1)
+    pairs = [(ranks[:, a], ranks[:, b]) for a, b in zip(i, j)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            scores = list(pool.map(_kendall_pair, pairs, chunksize=max(len(pairs) // (workers * 4), 1)))
+    else:
+        scores = [_kendall_pair(p) for p in pairs]
+    matrix = np.eye(n)
+    matrix[i, j] = matrix[j, i] = scores
+    return matrix
+
+
 def make_spearman_table(df: pd.DataFrame) -> pd.DataFrame:
     """Create a table of spearman correlation for all columns and sort descending"""
-    return _make_correlation_table(df, spearmanr, 0)
+    return _pairs_table(df.columns, spearman_matrix(df))
 
 
 def make_pearson_table(df: pd.DataFrame) -> pd.DataFrame:
     """Create a table of pearson correlation for all columns and sort descending"""
-    return _make_correlation_table(df, pearsonr, 0)
+    return _pairs_table(df.columns, pearson_matrix(df))
 
 
-def make_kendalltau_table(df: pd.DataFrame) -> pd.DataFrame:
+def make_kendalltau_table(df: pd.DataFrame, workers: int = 1) -> pd.DataFrame:
     """Create a table of kendalltau correlation for all columns and sort descending"""
-    return _make_correlation_table(df, kendalltau, 0)
+    return _pairs_table(df.columns, kendalltau_matrix(df, workers=workers))
@@ -0,0 +1,183 @@
+"""
+Streaming lead-lag correlation between metrics and event features.
+
+Day files are consumed one at a time (as yielded by `Store.load_local_files`). For every lag up to
+`max_lag` samples the co-moments of feature x[t - lag] and target y[t] are accumulated, so memory is
+bounded by lags x features x targets no matter how long the history is.
+"""
+from collections import deque
+from typing import Iterable
+import pandas as pd
+import numpy as np
+
+from app.schema import Config
+from app.storage import FileData, Store
+
+
+def day_matrix(metrics: dict, events: dict | None, columns: list[str]) -> np.ndarray:
+    """
+    Dense (samples, columns) float64 matrix from a metrics day and its sparse events day.
+    Short days are padded to Config.SAMPLES_PER_DAY rows, metrics that were not sampled are NaN.
+    """
+    out = np.zeros((Config.SAMPLES_PER_DAY, len(columns)))
+    for j, name in enumerate(columns):
+        if name in metrics:
+            values = np.asarray(metrics[name], dtype=np.float64)[: Config.SAMPLES_PER_DAY]
+            out[: len(values), j] = values
+            out[len(values) :, j] = np.nan
+        elif events and name in events:
+            out[np.asarray(events["index"], dtype=int), j] = events[name]
+    return out
+
+
+class Moments:
+    """
+    Co-moment accumulators per lag, feature and target over the pairs where both samples are valid:
+    counts, sums, sums of squares and cross products
+    """
+
+    def __init__(self, lags: int, features: int, targets: int):
+        shape = (lags, features, targets)
+        self.n = np.zeros(shape)
+        self.sx = np.zeros(shape)
+        self.sxx = np.zeros(shape)
+        self.sy = np.zeros(shape)
+        self.syy = np.zeros(shape)
+        self.sxy = np.zeros(shape)
+
+    def add(self, n, sx, sxx, sy, syy, sxy):
+        self.n += n
+        self.sx += sx
+        self.sxx += sxx
+        self.sy += sy
+        self.syy += syy
+        self.sxy += sxy
+
+    def correlation(self) -> np.ndarray:
+        """Pearson r as (lags, features, targets)"""
+        n = self.n
+        cov = n * self.sxy - self.sx * self.sy
+        var_x = n * self.sxx - self.sx**2
+        var_y = n * self.syy - self.sy**2
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return cov / np.sqrt(var_x * var_y)
+
+
+class LeadLag:
+    """
+    Incremental lead-lag correlation, feature x leading target y by 0..max_lag samples.
+    A separate accumulator is reset every `period` samples to track drift (weekly by default),
+    the last `keep` period snapshots are retained.
+    """
+
+    def __init__(
+        self,
+        targets: list[str],
+        features: list[str],
+        max_lag: int = Config.SAMPLES_PER_DAY,
+        period: int = Config.SAMPLES_PER_DAY * Config.DAYS_PER_CYCLE,
+        keep: int = 52,
+    ):
+        self.targets = list(targets)
+        self.features = list(features)
+        self.max_lag = max_lag
+        self.period = period
+        lags, f, t = max_lag + 1, len(self.features), len(self.targets)
+        self.total = Moments(lags, f, t)
+        self.current = Moments(lags, f, t)
+        self.current_start = 0
+        self.samples = 0
+        self.snapshots = deque(maxlen=keep)
+        # last max_lag samples of the features, invalid (masked out) until the stream is long enough
+        self.tail = np.zeros((max_lag, f))
+        self.tail_valid = np.zeros((max_lag, f))
+
+    def consume(self, metrics: dict, events: dict | None = None):
+        """Add one day of samples"""
+        columns = self.features + self.targets
+        data = day_matrix(metrics, events, columns)
+        valid = (~np.isnan(data)).astype(np.float64)
+        data = np.nan_to_num(data)
+        f = len(self.features)
+        x, y, vx, vy = data[:, :f], data[:, f:], valid[:, :f], valid[:, f:]
+        # split at the drift period boundary so snapshots line up with whole periods
+        while x.shape[0] > 0:
+            m = min(x.shape[0], self.period - (self.samples - self.current_start))
+            self._update(x[:m], y[:m], vx[:m], vy[:m])
+            x, y, vx, vy = x[m:], y[m:], vx[m:], vy[m:]
+            if self.samples - self.current_start >= self.period:
+                self._snapshot()
+
+    def _update(self, x: np.ndarray, y: np.ndarray, vx: np.ndarray, vy: np.ndarray):
+        """Add m samples, invalid ones are zero in x and y and in their masks vx and vy"""
+        L, m = self.max_lag, x.shape[0]
+        lags = np.arange(L + 1)
+        ext = np.concatenate([self.tail, x])  # (L + m, features)
+        ext_valid = np.concatenate([self.tail_valid, vx])
+        # sum_t a[t + s] * b[t] for every shift s via FFT, lag k is shift L - k
+        size = 1 << int(np.ceil(np.log2(L + 2 * m)))
+        fx, fxx, fvx = (np.fft.rfft(a, n=size, axis=0) for a in (ext, ext**2, ext_valid))
+        fy, fyy, fvy = (np.conj(np.fft.rfft(b, n=size, axis=0)) for b in (y, y**2, vy))
+
+        def cross(fa, fb):
+            return np.fft.irfft(fa[:, :, None] * fb[:, None, :], n=size, axis=0)[L - lags]
+
+        # each moment only over the pairs where both x[t - lag] and y[t] are valid
+        stats = (np.rint(cross(fvx, fvy)), cross(fx, fvy), cross(fxx, fvy), cross(fvx, fy), cross(fvx, fyy), cross(fx, fy))
+        self.total.add(*stats)
+        self.current.add(*stats)
+        if L > 0:
+            self.tail, self.tail_valid = ext[-L:], ext_valid[-L:]
+        self.samples += m
+
+    def _snapshot(self):
+        self.snapshots.append((self.current_start, self.current.correlation()))
+        self.current = Moments(*self.current.sxy.shape)
+        self.current_start = self.samples
+
+    def _long(self, r: np.ndarray) -> pd.DataFrame:
+        lags, features, targets = np.meshgrid(
+            np.arange(self.max_lag + 1), self.features, self.targets, indexing="ij"
+        )
+        return pd.DataFrame(
+            {
+                "feature": features.ravel(),
+                "target": targets.ravel(),
+                "lag": lags.ravel(),
+                "r": r.ravel(),
+            }
+        )
+
+    def table(self) -> pd.DataFrame:
+        """Correlation over the whole history for every feature, target and lag"""
+        return self._long(self.total.correlation())
+
+    def best_lags(self) -> pd.DataFrame:
+        """Lag with the strongest absolute correlation per feature and target, sorted descending"""
+        df = self.table().dropna()
+        best = df.loc[df["r"].abs().groupby([df["feature"], df["target"]]).idxmax()]
+        return best.sort_values("r", key=np.abs, ascending=False).reset_index(drop=True)
+
+    def drift(self) -> pd.DataFrame:
+        """Best lag and correlation per feature and target for every retained period"""
+        frames = []
+        for start, r in self.snapshots:
+            df = self._long(r).dropna()
+            best = df.loc[df["r"].abs().groupby([df["feature"], df["target"]]).idxmax()]
+            frames.append(best.assign(period_start=start))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def stream(
+    lead_lag: LeadLag, metrics: Iterable[FileData], events: Iterable[FileData] = ()
+) -> LeadLag:
+    """Feed date ordered metrics files, joined with the events file of the same date when present"""
+    events = iter(events)
+    pending = next(events, None)
+    for day in metrics:
+        date = Store.path_date(day["path"])
+        while pending is not None and Store.path_date(pending["path"]) < date:
+            pending = next(events, None)
+        match = pending if pending is not None and Store.path_date(pending["path"]) == date else None
+        lead_lag.consume(day["data"], match["data"] if match else None)
+    return lead_lag
@@ -0,0 +1,370 @@
+"""
+Incremental runs of ETL -> Analytics -> ML, driven by what changed instead of a fixed "yesterday".
+
+Every artifact of a day has a fingerprint:
+- dynamodb/{day}: hash of the fetched items of the day partition
+- postgres/{day}: hash of the metric sample and event rows of the day
+- analytics/{kind}/{day}: ETags of the metrics, validity and events day files in S3
+- model / forecast: ETags of the registry and published forecast pointers
+
+A step runs when the fingerprints of its inputs differ from the ones it was last built from, or its
+own output changed since, so a late fetch or a re-run upstream day flows down and nothing else
+recomputes. Days are independent and run in a thread pool, the steps of a day in order. The state,
+inputs and output of every built artifact plus a watermark per stage, is a JSON document in S3 or
+in a local file. Stages run through an executor: the deployed Lambdas, or in process for local runs.
+
+    python app.py --local --state state.json --lookback 7
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, TypedDict
+from pathlib import Path
+import importlib.util
+import threading
+import argparse
+import hashlib
+import json
+import sys
+import os
+
+from botocore.exceptions import ClientError
+from sqlalchemy import text
+import boto3
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))  # run as a script, the stages and this module import the shared modules
+from shared import tracing, db  # noqa: E402
+from shared.series import valid_key  # noqa: E402
+
+DB_URL = os.environ.get("MJ_ETL_DB")
+tablename = os.environ.get("MJ_STATUS_DYNAMODB_TABLE")
+bucketname = os.environ.get("MJ_STATUS_BUCKET")
+KINDS = tuple(os.environ.get("MJ_ORCHESTRATOR_KINDS", "relax").split(","))
+# deployed function of each stage
+FUNCTIONS = {
+    "etl": os.environ.get("MJ_ETL_FUNCTION"),
+    "analytics": os.environ.get("MJ_ANALYTICS_FUNCTION"),
+    "ml": os.environ.get("MJ_ML_FUNCTION"),
+}
+STATE_KEY = "orchestrator/state.json"
+GRACE = timedelta(hours=1)  # a day is complete once the last fetches of it had time to land
+dynamodb = boto3.client("dynamodb")
+s3 = boto3.client("s3")
+
+
+class Record(TypedDict):
+    inputs: dict[str, str]
+    output: str | None
+    built: str
+
+
+def digest(*parts: str | bytes) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode())
+    return h.hexdigest()[:20]
+
+
+def day_range(day: date) -> str:
+    """Date argument and file name stem of analytics, `{day}_{next day}`"""
+    return f"{day}_{day + timedelta(days=1)}"
+
+
+@tracing.traced()
+def dynamodb_fingerprint(day: date) -> str | None:
+    """Hash of every item of the day partition, None when nothing was fetched that day"""
+    items, key = [], None
+    while True:
+        response = dynamodb.query(
+            TableName=tablename,
+            KeyConditionExpression="#date = :dt",
+            ExpressionAttributeValues={":dt": {"S": day.isoformat()}},
+            ExpressionAttributeNames={"#date": "date"},
+            **({"ExclusiveStartKey": key} if key else {}),
+        )
+        items.extend(response["Items"])
+        key = response.get("LastEvaluatedKey")
+        if key is None:
+            break
+    if not items:
+        return None
+    items.sort(key=lambda item: item["timestamp"]["S"])
+    # packed items hold their samples in binary attributes
+    return digest(json.dumps(items, sort_keys=True, default=bytes.hex))
+
+
+POSTGRES_FINGERPRINT = text(
+    """
+    SELECT
+        (SELECT md5(string_agg(s::text, ',' ORDER BY s.ts, s.name_id))
+         FROM metric_samples s WHERE s.ts >= :start AND s.ts < :end),
+        (SELECT md5(string_agg(e::text, ',' ORDER BY e.timestamp_id, e.date))
+         FROM events e WHERE e.date_id = :day)
+    """
+)
+
+
+@tracing.traced()
+def postgres_fingerprint(day: date) -> str | None:
+    """Hash of the rows the ETL wrote for a day, None without metric samples"""
+    start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+    with db.connect(db.engine(DB_URL)) as conn:
+        # the ETL creates its tables on its first run
+        if conn.execute(text("SELECT to_regclass('metric_samples') IS NULL OR to_regclass('events') IS NULL")).scalar():
+            return None
+        metrics, events = conn.execute(
+            POSTGRES_FINGERPRINT, {"start": start, "end": start + timedelta(days=1), "day": day.isoformat()}
+        ).one()
+    return None if metrics is None else digest(metrics, events or "")
+
+
+def s3_etag(key: str) -> str | None:
+    try:
+        return s3.head_object(Bucket=bucketname, Key=key)["ETag"].strip('"')
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+@tracing.traced()
+def analytics_fingerprint(day: date, kind: str) -> str | None:
+    """ETags of the metrics, validity and events files analytics writes for a day, None until all exist"""
+    key = f"metrics/{kind}/{day_range(day)}.json"
+    etags = s3_etag(key), s3_etag(valid_key(key)), s3_etag(f"metrics/events/{day_range(day)}.json")
+    return None if None in etags else digest(*etags)
+
+
+class State:
+    """Inputs and output fingerprints of every built artifact, and the watermark of each stage"""
+
+    def __init__(self, path: str = None) -> None:
+        """Local JSON file at path, otherwise STATE_KEY in the status bucket"""
+        self.path = None if path is None else Path(path)
+        self.lock = threading.Lock()
+        self.artifacts: dict[str, Record] = {}
+        self.watermarks: dict[str, str] = {}
+
+    def load(self) -> "State":
+        if self.path is not None:
+            body = self.path.read_text() if self.path.exists() else None
+        else:
+            try:
+                body = s3.get_object(Bucket=bucketname, Key=STATE_KEY)["Body"].read()
+            except s3.exceptions.NoSuchKey:
+                body = None
+        data = json.loads(body) if body else {}
+        self.artifacts = data.get("artifacts", {})
+        self.watermarks = data.get("watermarks", {})
+        return self
+
+    def save(self):
+        with self.lock:
+            body = json.dumps({"artifacts": self.artifacts, "watermarks": self.watermarks}, indent=1, sort_keys=True)
+        if self.path is not None:
+            self.path.write_text(body)
+        else:
+            s3.put_object(Bucket=bucketname, Key=STATE_KEY, Body=body.encode(), ContentType="application/json")
+
+    def record(self, key: str, inputs: dict[str, str], output: str | None):
+        with self.lock:
+            self.artifacts[key] = {"inputs": inputs, "output": output, "built": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+
+    def stale(self, key: str, inputs: dict[str, str], output: str | None) -> bool:
+        """Never built, built from other inputs, or its output changed since"""
+        record = self.artifacts.get(key)
+        return record is None or record["inputs"] != inputs or record["output"] != output
+
+
+class LambdaExecutor:
+    """Invokes the deployed stage functions and waits for them"""
+
+    def __init__(self, functions: dict[str, str] = FUNCTIONS) -> None:
+        self.functions = functions
+        self.client = boto3.client("lambda")
+
+    def __call__(self, stage: str, event: dict) -> dict:
+        response = self.client.invoke(FunctionName=self.functions[stage], Payload=json.dumps(event).encode())
+        payload = json.loads(response["Payload"].read() or "null")
+        if "FunctionError" in response:
+            raise RuntimeError(f"{stage} failed: {payload}")
+        return payload
+
+
+class LocalExecutor:
+    """
+    Runs the stage handlers in this process, against the AWS endpoints and database of the
+    environment (moto, DynamoDB-local, MinIO and a local Postgres work). Needs the stage
+    requirements installed, ml only when a forecast step is configured.
+    """
+
+    def __init__(self, workers: int = 1, root: Path = ROOT) -> None:
+        self.root = root
+        # stages share one engine in process, a connection per worker
+        db.POOL_SIZE = max(db.POOL_SIZE, workers)
+        self.modules = {
+            "etl": self.load("mj_etl", root / "etl" / "app.py"),
+            "analytics": self.load("mj_analytics", root / "analytics" / "app.py"),
+        }
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load(name: str, path: Path):
+        """Import a stage script by path, etl and analytics are both called app.py"""
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def __call__(self, stage: str, event: dict) -> dict:
+        if stage == "ml":
+            with self.lock:
+                if "ml" not in self.modules:
+                    sys.path.insert(0, str(self.root / "ml"))
+                    import app.__main__
+
+                    self.modules["ml"] = app.__main__
+        return self.modules[stage].lambda_handler(event, None)
+
+
+class Orchestrator:
+    def __init__(
+        self,
+        run: Callable[[str, dict], dict],
+        state: State,
+        kinds: tuple[str] = KINDS,
+        workers: int = 4,
+        ml_event: dict = None,
+    ) -> None:
+        """run(stage, event) invokes a stage. ml_event is the ML predict event, no forecast step without it."""
+        self.run_stage = run
+        self.state = state
+        self.kinds = kinds
+        self.workers = workers
+        self.ml_event = ml_event
+
+    def step(self, key: str, inputs: dict[str, str], fingerprint: Callable[[], str | None], build: Callable[[], dict]):
+        """Build an artifact when stale. Returns its status and output fingerprint."""
+        output = fingerprint()
+        if not self.state.stale(key, inputs, output):
+            return "fresh", output
+        build()
+        output = fingerprint()
+        self.state.record(key, inputs, output)
+        return "built", output
+
+    def run_day(self, day: date) -> dict[str, str]:
+        """ETL then analytics of one day, each only when its inputs changed"""
+        status = {}
+        try:
+            source = dynamodb_fingerprint(day)
+            if source is None:
+                return {"etl": "empty", **{f"analytics/{kind}": "empty" for kind in self.kinds}}
+            status["etl"], rows = self.step(
+                f"postgres/{day}",
+                {f"dynamodb/{day}": source},
+                lambda: postgres_fingerprint(day),
+                lambda: self.run_stage("etl", {"date": day.isoformat()}),
+            )
+            for kind in self.kinds:
+                status[f"analytics/{kind}"], _ = self.step(
+                    f"analytics/{kind}/{day}",
+                    {f"postgres/{day}": rows},
+                    lambda: analytics_fingerprint(day, kind),
+                    lambda: self.run_stage("analytics", {"date": day_range(day), "kind": kind, "bucket": bucketname}),
+                )
+        except Exception as e:
+            print(f"{day}: {e!r}")
+            status["error"] = repr(e)
+        return status
+
+    def forecast(self) -> str:
+        """Forecast again when a day of the ML window or the model changed"""
+        event = self.ml_event
+        kind = Path(event["paths"]["metrics"]).name
+        now = datetime.now()
+        # same window as ml Store.compute_time
+        first, last = (now - timedelta(days=event["action"]["start"] + 1)).date(), (now - timedelta(days=event["action"]["end"])).date()
+        days = [first + timedelta(days=i) for i in range((last - first).days)]
+        inputs = {
+            f"analytics/{kind}/{d}": self.state.artifacts[f"analytics/{kind}/{d}"]["output"]
+            for d in days
+            if f"analytics/{kind}/{d}" in self.state.artifacts
+        }
+        inputs["model"] = s3_etag(f"{event['paths']['models']}/{event['model']}/latest.json")
+        status, _ = self.step(
+            f"forecast/{event['model']}",
+            inputs,
+            lambda: s3_etag(f"forecasts/{event['model']}/latest.json"),
+            lambda: self.run_stage("ml", {**event, "publish": True}),
+        )
+        return status
+
+    def days(self, today: date, lookback: int, start: date = None) -> list[date]:
+        """Days to check: the lookback window, everything after the oldest watermark, or from start"""
+        first = today - timedelta(days=lookback)
+        marks = [date.fromisoformat(self.state.watermarks[s]) for s in ("etl", *self.kinds) if s in self.state.watermarks]
+        if len(marks) == len(self.kinds) + 1:
+            first = min(first, min(marks) + timedelta(days=1))
+        if start is not None:
+            first = start
+        return [first + timedelta(days=i) for i in range((today - first).days + 1)]
+
+    def advance(self, results: dict[date, dict[str, str]], now: datetime):
+        """Move each watermark over the contiguous complete days that are up to date"""
+        for stage in ("etl", *self.kinds):
+            name = stage if stage == "etl" else f"analytics/{stage}"
+            mark = self.state.watermarks.get(stage)
+            for day in sorted(results):
+                if mark is not None and day <= date.fromisoformat(mark):
+                    continue
+                complete = datetime.combine(day + timedelta(days=1), datetime.min.time()) + GRACE <= now
+                if not complete or results[day].get(name) not in ("built", "fresh", "empty"):
+                    break
+                mark = day.isoformat()
+            if mark is not None:
+                self.state.watermarks[stage] = mark
+
+    def run(self, today: date = None, lookback: int = 3, start: date = None) -> dict:
+        now = datetime.now()
+        days = self.days(today or now.date(), lookback, start)
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = dict(zip(days, pool.map(self.run_day, days)))
+        self.advance(results, now)
+        report = {"days": {str(d): s for d, s in results.items()}}
+        if self.ml_event is not None:
+            try:
+                report["forecast"] = self.forecast()
+            except Exception as e:
+                print(f"forecast: {e!r}")
+                report["forecast"] = repr(e)
+        self.state.save()
+        report["counts"] = dict(Counter(s if step != "error" else "error" for status in results.values() for step, s in status.items()))
+        report["watermarks"] = dict(self.state.watermarks)
+        return report
+
+
+@tracing.invocation("orchestrator")
+def lambda_handler(event: dict, context):
+    """Scheduled run. Optional event keys: lookback (days), start (YYYY-MM-DD backfill), workers, ml (predict event)."""
+    orchestrator = Orchestrator(LambdaExecutor(), State().load(), workers=event.get("workers", 4), ml_event=event.get("ml"))
+    start = date.fromisoformat(event["start"]) if event.get("start") else None
+    report = orchestrator.run(lookback=event.get("lookback", 3), start=start)
+    print(json.dumps(report["counts"]), json.dumps(report["watermarks"]))
+    return {"statusCode": 200, "body": report}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Pipeline orchestrator")
+    parser.add_argument("--local", action="store_true", help="Run the stages in process instead of invoking the Lambdas")
+    parser.add_argument("--state", default=None, help="Local state file instead of the S3 state")
+    parser.add_argument("--lookback", default=3, type=int)
+    parser.add_argument("--start", default=None, type=date.fromisoformat, help="Check every day from this one")
+    parser.add_argument("--workers", default=4, type=int)
+    parser.add_argument("--ml-event", default=None, help="JSON file of the ML predict event")
+    argv = parser.parse_args()
+    executor = LocalExecutor(argv.workers) if argv.local else LambdaExecutor()
+    ml_event = json.loads(Path(argv.ml_event).read_text()) if argv.ml_event else None
+    orchestrator = Orchestrator(executor, State(argv.state).load(), workers=argv.workers, ml_event=ml_event)
+    print(json.dumps(orchestrator.run(lookback=argv.lookback, start=argv.start), indent=2))
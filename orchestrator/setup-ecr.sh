@@ -0,0 +1,9 @@
+#!/bin/bash
+# This script is used to build and push a temporary image to AWS ECR
+aws ecr get-login-password --region us-east-1 | docker login --username AWS --password-stdin $AWS_ACCOUNT_ID.dkr.ecr.us-east-1.amazonaws.com
+aws ecr delete-repository --repository-name $MJ_STATUS_ECR_ORCHESTRATOR --no-force
+var=`aws ecr create-repository --repository-name $MJ_STATUS_ECR_ORCHESTRATOR --query 'repository.repositoryUri' --output text`
+# build from the repository root, the image includes the shared modules
+docker build -t $MJ_STATUS_ECR_ORCHESTRATOR -f Dockerfile ..
+docker tag $MJ_STATUS_ECR_ORCHESTRATOR:latest $var:latest
+docker push $var:latest
\ No newline at end of file
@@ -0,0 +1,4 @@
+# create lambda function with image
+aws iam create-role --role-name $MJ_STATUS_LAMBDA_ROLE --assume-role-policy-document file://roles/trust-policy.json
+var=`aws ecr describe-repositories --repository-names $MJ_STATUS_ECR_ORCHESTRATOR --query 'repositories[0].repositoryUri' --output text`
+aws lambda create-function --function-name $MJ_STATUS_ECR_ORCHESTRATOR --package-type Image --code ImageUri=$var:latest --role arn:aws:iam::$AWS_ACCOUNT_ID:role/$MJ_STATUS_LAMBDA_ROLE
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""
+Compact encoding of the fetched samples stored in the status table.
+
+Version 1 items, the original layout, hold `metrics` as a list of maps of strings: the full metric
+name, the value formatted with 4 decimals and the sample date, repeated in every item. Version 2
+items reference a name dictionary, an item of its own in the `names` partition written once per set
+of names, and pack the samples into one binary attribute:
+
+    header: count (uint32), then per sample
+    values: float32, little endian, split into byte planes so the exponent bytes compress together
+    offsets: int32 seconds from the item timestamp to the sample date
+
+compressed with zstd when the zstandard package is installed, zlib otherwise, and stored as is when
+compression doesn't make it smaller. Events keep the version 1 layout, they are few and sparse.
+Stdlib only, the fetch package ships without the ETL dependencies.
+"""
+from datetime import datetime, timezone
+from array import array
+import hashlib
+import struct
+import zlib
+import sys
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+VERSION = 2
+NAMES_PARTITION = "names"  # `date` key of the name dictionary items
+TIMESTAMP_FMT = "%Y-%m-%dT%H:%M:%SZ"
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+HEADER = struct.Struct("<I")
+
+
+def _little(a: array) -> array:
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def _shuffle(body: bytes, size: int) -> bytes:
+    return b"".join(body[i::size] for i in range(size))
+
+
+def _unshuffle(body: bytes, size: int) -> bytes:
+    out = bytearray(len(body))
+    n = len(body) // size
+    for i in range(size):
+        out[i::size] = body[i * n : (i + 1) * n]
+    return bytes(out)
+
+
+def compress(body: bytes) -> tuple[str, bytes]:
+    """(codec, payload), the smallest of the available codec and no compression"""
+    if zstandard is not None:
+        codec, packed = "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    else:
+        codec, packed = "zlib", zlib.compress(body, ZLIB_LEVEL)
+    return (codec, packed) if len(packed) < len(body) else ("raw", body)
+
+
+def decompress(codec: str, payload: bytes) -> bytes:
+    if codec == "raw":
+        return payload
+    if codec == "zlib":
+        return zlib.decompress(payload)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compressed items need the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def names_id(names: list[str]) -> str:
+    """Dictionary key, a hash of the names in order"""
+    return hashlib.sha256("\n".join(names).encode()).hexdigest()[:16]
+
+
+def encode_names(names: list[str]) -> dict:
+    """Name dictionary item"""
+    codec, payload = compress("\n".join(names).encode())
+    return {"date": NAMES_PARTITION, "timestamp": names_id(names), "v": VERSION, "codec": codec, "names": payload}
+
+
+def decode_names(item: dict) -> list[str]:
+    body = decompress(item["codec"], bytes(item["names"])).decode()
+    return body.split("\n") if body else []
+
+
+def _seconds(timestamp: str) -> int:
+    return int(datetime.strptime(timestamp, TIMESTAMP_FMT).replace(tzinfo=timezone.utc).timestamp())
+
+
+def encode_metrics(metrics: list[dict[str, str]], timestamp: str) -> tuple[list[str], dict]:
+    """
+    Names and the packed attributes of parsed metrics ({name, value, date}) fetched at timestamp.
+    The dictionary item of the names has to be written before items that reference it.
+    """
+    names = [m["name"] for m in metrics]
+    at = _seconds(timestamp)
+    # the metrics of a fetch share a handful of sample dates
+    dates = {d: _seconds(d) - at for d in {m["date"] for m in metrics}}
+    # parsed values have 4 decimals, float32 keeps them below 1000 minutes
+    values = _little(array("f", (float(m["value"]) for m in metrics)))
+    offsets = _little(array("i", (dates[m["date"]] for m in metrics)))
+    codec, payload = compress(HEADER.pack(len(names)) + _shuffle(values.tobytes(), 4) + offsets.tobytes())
+    return names, {"v": VERSION, "names": names_id(names), "codec": codec, "metrics": payload}
+
+
+def decode_metrics(item: dict) -> tuple[array, array]:
+    """float32 values and int32 second offsets of a version 2 item, in dictionary order"""
+    body = decompress(item["codec"], bytes(item["metrics"]))
+    (n,) = HEADER.unpack_from(body)
+    values = array("f")
+    values.frombytes(_unshuffle(body[HEADER.size : HEADER.size + 4 * n], 4))
+    offsets = array("i")
+    offsets.frombytes(body[HEADER.size + 4 * n : HEADER.size + 8 * n])
+    return _little(values), _little(offsets)
+
+
+def version(item: dict) -> int:
+    return int(item.get("v", 1))
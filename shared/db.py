@@ -0,0 +1,100 @@
+"""
+Postgres access for the Lambdas, one engine and one schema check per warm container.
+
+Every Lambda container runs one invocation at a time, so the pool keeps a single connection that is
+pinged before reuse and recycled before the server or a NAT drops it. Set MJ_DB_POOL=null behind an
+external pooler (PgBouncer, RDS Proxy): connections are then opened per checkout and closed right
+after, the pooler keeps the server side ones.
+
+    engine = db.engine(DB_URL)
+    db.ensure_schema(engine, Base.metadata, TABLES)
+    with db.connect(engine) as conn:
+        ...
+"""
+from contextlib import contextmanager
+from time import perf_counter
+import os
+
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+
+from shared import tracing
+
+POOL = os.environ.get("MJ_DB_POOL", "queue")  # queue or null
+POOL_SIZE = int(os.environ.get("MJ_DB_POOL_SIZE", 1))
+MAX_OVERFLOW = int(os.environ.get("MJ_DB_MAX_OVERFLOW", 1))
+POOL_TIMEOUT = 10  # seconds to wait for a pooled connection
+POOL_RECYCLE = 300  # seconds, below the idle timeouts of poolers and NAT gateways
+CONNECT_TIMEOUT = 5
+
+# kept across warm invocations
+ENGINES: dict[tuple[str, str], Engine] = {}
+CHECKED: set[tuple[str, tuple[str, ...]]] = set()
+STATS = {"acquired": 0, "acquire_ms": 0.0, "max_acquire_ms": 0.0, "connects": 0, "schema_checks": 0}
+
+
+def _on_connect(dbapi_connection, connection_record):
+    STATS["connects"] += 1
+    tracing.count("db_connects")
+
+
+def engine(url: str, pool: str = None) -> Engine:
+    """Engine of a url, created once per container"""
+    pool = pool or POOL
+    key = (url, pool)
+    if key not in ENGINES:
+        options = (
+            {"poolclass": NullPool}
+            if pool == "null"
+            else {
+                "pool_size": POOL_SIZE,
+                "max_overflow": MAX_OVERFLOW,
+                "pool_timeout": POOL_TIMEOUT,
+                "pool_recycle": POOL_RECYCLE,
+                "pool_pre_ping": True,
+            }
+        )
+        ENGINES[key] = create_engine(
+            url,
+            connect_args={"connect_timeout": CONNECT_TIMEOUT, "application_name": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "mj")},
+            **options,
+        )
+        event.listen(ENGINES[key], "connect", _on_connect)
+    return ENGINES[key]
+
+
+@contextmanager
+def connect(engine: Engine):
+    """Connection of the engine, the time to get it (pool wait, ping, new connection) goes to STATS"""
+    t0 = perf_counter()
+    with tracing.span("db_acquire"):
+        conn = engine.connect()
+    ms = (perf_counter() - t0) * 1000
+    STATS["acquired"] += 1
+    STATS["acquire_ms"] += ms
+    STATS["max_acquire_ms"] = max(STATS["max_acquire_ms"], ms)
+    with conn:
+        yield conn
+
+
+def ensure_schema(engine: Engine, metadata, tables: list) -> bool:
+    """Create missing tables on the first call of a container, later calls return False right away"""
+    key = (engine.url.render_as_string(hide_password=True), tuple(t.name for t in tables))
+    if key in CHECKED:
+        return False
+    with tracing.span("db_schema"), connect(engine) as conn:
+        existing = set(inspect(conn).get_table_names())
+        if not {t.name for t in tables} <= existing:
+            metadata.create_all(conn, tables=tables)
+            conn.commit()
+    STATS["schema_checks"] += 1
+    CHECKED.add(key)
+    return True
+
+
+def stats() -> dict:
+    """Connection metrics of the container, with the pool status when pooled"""
+    out = dict(STATS, mean_acquire_ms=STATS["acquire_ms"] / STATS["acquired"] if STATS["acquired"] else 0.0)
+    out["pools"] = {key[1]: e.pool.status() for key, e in ENGINES.items()}
+    return out
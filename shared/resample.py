@@ -0,0 +1,98 @@
+"""
+Alignment of raw fetch timestamps onto the canonical 15 minute grid.
+
+Every sample falls in the grid bin that contains it, found with one searchsorted, duplicates in a bin
+keep the latest sample. Bins without a sample are filled by policy and flagged in a validity mask.
+"""
+from typing import Literal
+import numpy as np
+
+MINUTES_PER_SAMPLE = 15
+SAMPLES_PER_DAY = 24 * 60 // MINUTES_PER_SAMPLE
+VALID_KEY = "valid"  # per sample 0/1 mask in the companion validity file of a day file
+VALID_DIR = "valid"  # companion files of `metrics/{kind}/` days live under `metrics/valid/{kind}/`
+
+Policy = Literal["nan", "ffill", "interpolate"]
+
+
+def grid(start, periods: int = SAMPLES_PER_DAY, minutes: int = MINUTES_PER_SAMPLE) -> np.ndarray:
+    """Bin start times from start, datetime64[s]"""
+    return np.datetime64(start, "s") + np.arange(periods) * np.timedelta64(minutes * 60, "s")
+
+
+def bin_index(timestamps, start, periods: int = SAMPLES_PER_DAY, minutes: int = MINUTES_PER_SAMPLE) -> np.ndarray:
+    """Grid bin of every timestamp, -1 outside of the grid"""
+    edges = grid(start, periods + 1, minutes)
+    t = np.asarray(timestamps, dtype="datetime64[s]")
+    index = np.searchsorted(edges, t, side="right") - 1
+    return np.where((index >= 0) & (index < periods), index, -1)
+
+
+def _previous_valid(valid: np.ndarray) -> np.ndarray:
+    """Row of the last valid sample at or before each row, -1 before the first one"""
+    rows = np.where(valid, np.arange(valid.shape[0])[:, None], -1)
+    return np.maximum.accumulate(rows, axis=0)
+
+
+def fill(values: np.ndarray, valid: np.ndarray, policy: Policy = "ffill") -> np.ndarray:
+    """Fill invalid samples of a (samples, columns) array column by column, leading gaps stay NaN"""
+    if policy == "nan":
+        return values
+    n = values.shape[0]
+    cols = np.arange(values.shape[1])
+    previous = _previous_valid(valid)
+    before = values[np.clip(previous, 0, None), cols]
+    if policy == "ffill":
+        return np.where(valid, values, np.where(previous >= 0, before, np.nan))
+    if policy == "interpolate":
+        # next valid row, from the reversed running maximum
+        following = (n - 1) - _previous_valid(valid[::-1])[::-1]
+        following = np.where(following > n - 1, -1, following)
+        after = values[np.clip(following, 0, n - 1), cols]
+        span = np.where((previous >= 0) & (following >= 0), following - previous, 0)
+        weight = np.divide(np.arange(n)[:, None] - previous, span, out=np.zeros(values.shape), where=span > 0)
+        inner = before + (after - before) * weight
+        return np.where(valid, values, np.where(span > 0, inner, np.nan))
+    raise ValueError(f"Unknown fill policy {policy}")
+
+
+def resample(
+    timestamps,
+    values,
+    start,
+    columns: np.ndarray = None,
+    n_columns: int = None,
+    periods: int = SAMPLES_PER_DAY,
+    minutes: int = MINUTES_PER_SAMPLE,
+    policy: Policy = "ffill",
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Align samples onto `periods` bins from start.
+    Wide input is (samples, columns) values. Long input passes one value per sample with its
+    integer column code in `columns`. Returns the (periods, columns) float64 values, filled by
+    policy, and the boolean mask of the bins that got a sample.
+    """
+    t = np.asarray(timestamps, dtype="datetime64[s]")
+    values = np.asarray(values, dtype=np.float64)
+    if columns is None:
+        # wide to long, one entry per sample and column
+        values = values.reshape(len(t), -1)
+        n_columns = values.shape[1]
+        columns = np.tile(np.arange(n_columns), len(t))
+        t = np.repeat(t, n_columns)
+        values = values.reshape(-1)
+    else:
+        columns = np.asarray(columns, dtype=np.int64)
+        n_columns = int(columns.max()) + 1 if n_columns is None else n_columns
+    index = bin_index(t, start, periods, minutes)
+    inside = index >= 0
+    cells, t, values = (index * n_columns + columns)[inside], t[inside], values[inside]
+    # the latest sample of each (bin, column) cell wins, fetches usually arrive in time order already
+    order = np.argsort(cells, kind="stable") if np.all(t[1:] >= t[:-1]) else np.lexsort((t, cells))
+    cells, values = cells[order], values[order]
+    last = np.r_[cells[1:] != cells[:-1], True] if len(cells) else np.zeros(0, dtype=bool)
+    out = np.full((periods, n_columns), np.nan)
+    valid = np.zeros((periods, n_columns), dtype=bool)
+    out.reshape(-1)[cells[last]] = values[last]
+    valid.reshape(-1)[cells[last]] = True
+    return fill(out, valid, policy), valid
@@ -0,0 +1,199 @@
+"""
+Columnar in-memory time series, the one layout analytics and ML pass metrics around in.
+
+A TimeMatrix is a float32 (time, label) matrix stored column-major, so every label is one contiguous
+column, with a datetime64 index and a per sample validity mask. Label names are interned. Appends
+grow the buffers geometrically, slices by time are views, and NumPy, pandas and Arrow exports wrap
+the same memory without copying.
+
+Day files keep plain numeric label arrays, the validity mask of a day is a companion file at
+`valid_key(key)`:
+
+    day = TimeMatrix.from_day(json.load(f), start="2023-05-12", periods=96, valid=json.load(g)["valid"])
+    df = day.to_pandas()
+"""
+from pathlib import PurePosixPath
+from typing import Iterable
+import sys
+
+import numpy as np
+
+from shared.resample import MINUTES_PER_SAMPLE, VALID_DIR, VALID_KEY, fill
+
+INDEX_DTYPE = "datetime64[ns]"
+DECIMALS = 4  # fetched waits have 4 decimals, float32 keeps them exact below 1000 minutes
+
+
+def valid_key(key: str) -> str:
+    """Companion validity file of a day file, `metrics/{kind}/{day}.json` -> `metrics/valid/{kind}/{day}.json`"""
+    path = PurePosixPath(key)
+    return str(path.parent.parent / VALID_DIR / path.parent.name / path.name)
+
+
+class TimeMatrix:
+    __slots__ = ("_values", "_index", "_valid", "_length", "labels", "columns")
+
+    def __init__(self, values, index, labels: Iterable[str], valid=None) -> None:
+        """values (time, labels), taken without copy when already float32 column-major"""
+        values = np.asfortranarray(values, dtype=np.float32)
+        self._values = values[:, None] if values.ndim == 1 else values
+        self._index = np.asarray(index, dtype=INDEX_DTYPE)
+        self._valid = np.ones(len(index), dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+        self._length = len(self._index)
+        self.labels = tuple(sys.intern(str(label)) for label in labels)
+        self.columns = {label: i for i, label in enumerate(self.labels)}
+        if self._values.shape[1] != len(self.labels):
+            raise ValueError(f"{self._values.shape[1]} columns for {len(self.labels)} labels")
+
+    @classmethod
+    def empty(cls, labels: Iterable[str], capacity: int = 0) -> "TimeMatrix":
+        labels = list(labels)
+        out = cls(np.empty((0, len(labels)), dtype=np.float32, order="F"), np.empty(0, dtype=INDEX_DTYPE), labels)
+        out._reserve(capacity)
+        return out
+
+    @classmethod
+    def from_day(
+        cls, data: dict, start, periods: int = None, minutes: int = MINUTES_PER_SAMPLE, valid=None
+    ) -> "TimeMatrix":
+        """
+        A day file, {label: [value, ...]} with a sample every 15 minutes from start, and the mask of its
+        companion validity file, every sample is trusted without one. With periods the day is padded with
+        invalid NaN samples or cut.
+        """
+        labels = list(data)
+        # (labels, time) rows, the transpose is the column-major (time, labels) matrix
+        values = np.array([data[label] for label in labels], dtype=np.float32).reshape(len(labels), -1).T
+        valid = np.asarray(np.ones(values.shape[0]) if valid is None else valid, dtype=bool)[: values.shape[0]]
+        valid = np.r_[valid, np.zeros(values.shape[0] - len(valid), dtype=bool)]
+        if periods is not None and periods != values.shape[0]:
+            padded = np.full((periods, len(labels)), np.nan, dtype=np.float32, order="F")
+            padded[: min(periods, values.shape[0])] = values[:periods]
+            valid = np.r_[valid[:periods], np.zeros(max(periods - len(valid), 0), dtype=bool)]
+            values = padded
+        step = np.timedelta64(minutes * 60, "s")
+        index = np.datetime64(start, "s") + np.arange(values.shape[0]) * step
+        return cls(values, index, labels, valid)
+
+    @classmethod
+    def concat(cls, parts: list["TimeMatrix"]) -> "TimeMatrix":
+        """Parts one after the other in one allocation, labels missing from a part are NaN"""
+        labels = {}
+        for part in parts:
+            labels.update(dict.fromkeys(part.labels))
+        out = cls.empty(labels, sum(len(p) for p in parts))
+        for part in parts:
+            out.append(part.values, part.index, part.valid, part.labels)
+        return out
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __repr__(self) -> str:
+        span = f"{self.index[0]} .. {self.index[-1]}" if self._length else "empty"
+        return f"TimeMatrix({self._length} x {len(self.labels)}, {span})"
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self._length, len(self.labels)
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._values[: self._length]
+
+    @property
+    def index(self) -> np.ndarray:
+        return self._index[: self._length]
+
+    @property
+    def valid(self) -> np.ndarray:
+        return self._valid[: self._length]
+
+    @property
+    def nbytes(self) -> int:
+        return self._values.nbytes + self._index.nbytes + self._valid.nbytes
+
+    def _reserve(self, size: int):
+        capacity = len(self._index)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        values = np.empty((capacity, len(self.labels)), dtype=np.float32, order="F")
+        index = np.empty(capacity, dtype=INDEX_DTYPE)
+        valid = np.zeros(capacity, dtype=bool)
+        values[: self._length] = self.values
+        index[: self._length] = self.index
+        valid[: self._length] = self.valid
+        self._values, self._index, self._valid = values, index, valid
+
+    def append(self, values, index, valid=None, labels: Iterable[str] = None):
+        """Add a block of samples after the last one, labels default to the matrix labels"""
+        index = np.asarray(index, dtype=INDEX_DTYPE)
+        values = np.asarray(values, dtype=np.float32).reshape(len(index), -1)
+        if self._length and len(index) and index[0] <= self._index[self._length - 1]:
+            raise ValueError("Appended samples must come after the last sample")
+        n, k = self._length, len(index)
+        self._reserve(n + k)
+        if labels is None or tuple(labels) == self.labels:
+            self._values[n : n + k] = values
+        else:
+            self._values[n : n + k] = np.nan
+            self._values[n : n + k, [self.columns[label] for label in labels]] = values
+        self._index[n : n + k] = index
+        self._valid[n : n + k] = True if valid is None else valid
+        self._length = n + k
+
+    def slice(self, start=None, end=None) -> "TimeMatrix":
+        """Samples from start up to, not including, end, as a view"""
+        index = self.index
+        i = 0 if start is None else int(np.searchsorted(index, np.datetime64(start, "ns")))
+        j = self._length if end is None else int(np.searchsorted(index, np.datetime64(end, "ns")))
+        out = TimeMatrix.__new__(TimeMatrix)
+        out._values, out._index, out._valid = self._values[i:j], self._index[i:j], self._valid[i:j]
+        out._length = max(j - i, 0)
+        out.labels, out.columns = self.labels, self.columns
+        return out
+
+    def select(self, labels: list[str]) -> np.ndarray:
+        """(time, labels) copy in the given label order, NaN for labels the matrix doesn't have"""
+        out = np.full((self._length, len(labels)), np.nan, dtype=np.float32)
+        have = [(j, self.columns[label]) for j, label in enumerate(labels) if label in self.columns]
+        if have:
+            out[:, [j for j, _ in have]] = self.values[:, [i for _, i in have]]
+        return out
+
+    def to_numpy(self) -> np.ndarray:
+        return self.values
+
+    def to_pandas(self):
+        """DataFrame over the same float32 buffer indexed by sample time, writes to one show in the other"""
+        import pandas as pd
+
+        return pd.DataFrame(self.values, index=pd.DatetimeIndex(self.index), columns=list(self.labels), copy=False)
+
+    def to_arrow(self):
+        """pyarrow Table of a timestamp column and one float32 column per label, wrapping the buffers"""
+        import pyarrow as pa
+
+        n = self._length
+        arrays = [pa.Array.from_buffers(pa.timestamp("ns"), n, [None, pa.py_buffer(self.index.view(np.int64))])]
+        arrays += [pa.Array.from_buffers(pa.float32(), n, [None, pa.py_buffer(self.values[:, i])]) for i in range(len(self.labels))]
+        return pa.Table.from_arrays(arrays, names=["timestamp", *self.labels])
+
+    def to_day(self) -> dict:
+        """
+        Day file layout, {label: [value, ...]} rounded to DECIMALS. Samples still NaN after the fill policy
+        (gaps at the edges of the day) take the nearest sample of their label, 0 for labels never sampled,
+        the validity mask of to_valid flags them.
+        """
+        values = np.round(self.values.astype(np.float64), DECIMALS)
+        missing = np.isnan(values)
+        if missing.any():
+            values = fill(values, ~missing, "ffill")
+            values = fill(values[::-1], ~np.isnan(values[::-1]), "ffill")[::-1]
+            values = np.nan_to_num(values)
+        return {label: values[:, i].tolist() for i, label in enumerate(self.labels)}
+
+    def to_valid(self) -> dict:
+        """Companion validity file of to_day, a 0/1 flag per sample"""
+        return {VALID_KEY: self.valid.astype(int).tolist()}
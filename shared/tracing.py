@@ -0,0 +1,131 @@
+"""
+Timing spans and counters for the Lambdas, one JSON log line per invocation.
+
+Tracing is off unless MJ_TRACE is set before import (`1`, or `memory` to also record the tracemalloc
+peak). When off, `traced` returns the function itself and `span` and `count` return immediately.
+
+    @tracing.invocation("etl")
+    def lambda_handler(event, context):
+        with tracing.span("insert"):
+            ...
+        tracing.count("rows", len(rows))
+"""
+from contextlib import contextmanager, nullcontext
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+import tracemalloc
+import json
+import os
+
+MODE = os.environ.get("MJ_TRACE", "")
+ENABLED = MODE not in ("", "0")
+MEMORY = MODE == "memory"
+
+_NOOP = nullcontext()
+# trace of the running invocation, per thread (and task) so concurrent invocations don't mix
+_trace: ContextVar["Trace | None"] = ContextVar("trace", default=None)
+LAST: dict = {}  # record of the last finished invocation
+
+
+class Trace:
+    """Spans and counters of one invocation"""
+
+    __slots__ = ("name", "t0", "spans", "counters")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.t0 = perf_counter()
+        self.spans: defaultdict[str, list] = defaultdict(lambda: [0, 0.0])
+        self.counters: Counter = Counter()
+
+    def record(self, **fields) -> dict:
+        return {
+            "trace": self.name,
+            "ms": round((perf_counter() - self.t0) * 1000, 3),
+            "spans": {k: {"n": n, "ms": round(s * 1000, 3)} for k, (n, s) in self.spans.items()},
+            "counters": dict(self.counters),
+            **fields,
+        }
+
+
+class _Span:
+    __slots__ = ("trace", "name", "t0")
+
+    def __init__(self, trace: Trace, name: str) -> None:
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        entry = self.trace.spans[self.name]
+        entry[0] += 1
+        entry[1] += perf_counter() - self.t0
+        return False
+
+
+def span(name: str):
+    """Time a block, repeated spans of the same name add up"""
+    trace = _trace.get()
+    return _NOOP if trace is None else _Span(trace, name)
+
+
+def count(name: str, n: int = 1):
+    """Add to a counter, e.g. rows or bytes"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.counters[name] += n
+
+
+def traced(name: str = None):
+    """Decorator form of span, named after the function by default"""
+
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+        label = name or fn.__qualname__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(label):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def invocation(name: str, **fields):
+    """Collect spans for one invocation and print them as one JSON line. Works as a decorator too."""
+    global LAST
+    if not ENABLED:
+        yield None
+        return
+    trace = Trace(name)
+    token = _trace.set(trace)
+    if MEMORY:
+        started = tracemalloc.is_tracing()
+        if not started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    error = None
+    try:
+        yield trace
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        if MEMORY:
+            fields["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 3)
+            if not started:
+                tracemalloc.stop()
+        if error is not None:
+            fields["error"] = error
+        LAST = trace.record(**fields)
+        print(json.dumps(LAST, default=str))
+        _trace.reset(token)
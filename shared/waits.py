@@ -0,0 +1,6 @@
+"""
+Wait time thresholds shared by the fetch detector and the ML models, in minutes.
+"""
+CLIP_CEILING = 15  # waits are soft clipped towards this before training
+SLOW_FRACTION = 0.9  # waits at or above this fraction of CLIP_CEILING count as slow
+SLOW_WAIT = CLIP_CEILING * SLOW_FRACTION